@@ -1,3 +1,5 @@
+import io
+
 import gradio as gr
 from PIL import Image
 import os
@@ -9,6 +11,8 @@ except Exception:  # pragma: no cover - fallback for non-cog environments
     from pathlib import Path
 
 from predict import FluxDevKontextPredictor
+from flux.sampling import SAMPLERS
+from flux.schedules import DEFAULT_SCHEDULE
 from flux.util import ASPECT_RATIOS
 
 # Initialize predictor on startup
@@ -27,12 +31,21 @@ def gradio_predict(
     output_quality: int,
     disable_safety_checker: bool,
     go_fast: bool,
+    acceleration_level: str,
+    adaptive_threshold: float,
+    taylor_seer_scope: str,
+    taylor_seer_order: int,
+    sampler: str,
+    early_safety_check: bool,
+    preview_every: int,
 ):
     # Save input image to temporary path
     input_path = "gradio_input.png"
     input_image.save(input_path)
     seed = int(seed) if seed not in (None, "") else None
-    result_path = predictor.predict(
+    # keep outputs in memory instead of writing a file per request
+    outputs = predictor.generate_outputs(
+        "bytes",
         prompt=prompt,
         input_image=Path(input_path),
         aspect_ratio=aspect_ratio,
@@ -43,8 +56,20 @@ def gradio_predict(
         output_quality=output_quality,
         disable_safety_checker=disable_safety_checker,
         go_fast=go_fast,
+        acceleration_level=acceleration_level,
+        adaptive_threshold=adaptive_threshold,
+        taylor_seer_scope=taylor_seer_scope,
+        taylor_seer_order=int(taylor_seer_order),
+        sampler=sampler,
+        schedule=DEFAULT_SCHEDULE,
+        early_safety_check=early_safety_check,
+        num_outputs=1,
+        per_output_guidance="",
+        preview_every=int(preview_every),
     )
-    return Image.open(result_path)
+    # previews first, the final image last
+    for output in outputs:
+        yield Image.open(io.BytesIO(output))
 
 
 inputs = [
@@ -58,6 +83,17 @@ inputs = [
     gr.Slider(0, 100, value=80, step=1, label="Output Quality"),
     gr.Checkbox(value=False, label="Disable Safety Checker"),
     gr.Checkbox(value=True, label="Go Fast"),
+    gr.Dropdown(
+        choices=["default", "none", "go fast", "go really fast", "adaptive"],
+        value="default",
+        label="Acceleration Level",
+    ),
+    gr.Slider(0, 1, value=0.15, step=0.01, label="Adaptive Threshold"),
+    gr.Dropdown(choices=["model", "block"], value="model", label="TaylorSeer Scope"),
+    gr.Slider(1, 3, value=1, step=1, label="TaylorSeer Order"),
+    gr.Dropdown(choices=list(SAMPLERS.keys()), value="euler", label="Sampler"),
+    gr.Checkbox(value=False, label="Early Safety Check"),
+    gr.Slider(0, 50, value=4, step=1, label="Preview Every N Steps (0 disables previews)"),
 ]
 
 
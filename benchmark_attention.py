@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Time every registered attention backend on the joint sequence of each aspect ratio.
+
+The joint sequence is the text tokens, the generated image tokens and the Kontext
+conditioning tokens, with the conditioning image at the same size as the output.
+Backends that fail the probe for this device, or with `--masked` for a masked
+sequence, are skipped. Times are per attention call; a denoising step does one
+call per double and single block, 57 in total.
+
+    python benchmark_attention.py --txt_len 512
+    python benchmark_attention.py --txt_len 128 --masked
+"""
+
+import torch
+from fire import Fire
+
+from flux.math import ATTENTION_BACKENDS, probe_attention_backend
+from flux.util import ASPECT_RATIOS
+
+NUM_HEADS = 24
+HEAD_DIM = 128
+BLOCKS_PER_STEP = 57
+REPEATS = 10
+
+
+def time_backend(fn, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: torch.Tensor | None) -> float:
+    """Milliseconds per call, after a warm-up call."""
+    fn(q, k, v, mask)
+    start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+    start.record()
+    for _ in range(REPEATS):
+        fn(q, k, v, mask)
+    end.record()
+    torch.cuda.synchronize()
+    return start.elapsed_time(end) / REPEATS
+
+
+@torch.inference_mode()
+def main(txt_len: int = 512, masked: bool = False, dtype: str = "bfloat16"):
+    device = torch.device("cuda")
+    dtype = getattr(torch, dtype)
+
+    backends = [
+        backend
+        for backend in ATTENTION_BACKENDS.values()
+        if device.type in backend.devices and probe_attention_backend(backend, device, dtype, masked)
+    ]
+    print(f"Backends: {', '.join(backend.name for backend in backends)}")
+
+    print(f"{'aspect ratio':>13}{'tokens':>8}" + "".join(f"{backend.name:>12}" for backend in backends))
+    for aspect_ratio, (width, height) in ASPECT_RATIOS.items():
+        if width is None:
+            continue
+        seq_len = txt_len + 2 * (height // 16) * (width // 16)
+        q, k, v = (torch.randn(1, NUM_HEADS, seq_len, HEAD_DIM, device=device, dtype=dtype) for _ in range(3))
+        mask = None
+        if masked:
+            # half of the text bucket is padding
+            mask = torch.ones(1, 1, 1, seq_len, dtype=torch.bool, device=device)
+            mask[..., txt_len // 2 : txt_len] = False
+
+        times = [time_backend(backend.fn, q, k, v, mask) for backend in backends]
+        print(f"{aspect_ratio:>13}{seq_len:>8}" + "".join(f"{t:>10.2f}ms" for t in times))
+
+    print(f"Multiply by {BLOCKS_PER_STEP} for the attention time of a denoising step.")
+
+
+if __name__ == "__main__":
+    Fire(main)
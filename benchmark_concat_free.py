@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Numerical difference and per-block time of the concat-free blocks, see
+`Flux.set_concat_free`.
+
+A randomly initialised full size DoubleStreamBlock and SingleStreamBlock run on
+the joint sequence of a 1024x1024 Kontext request, 512 text tokens plus the
+generated and the conditioning image, once as usual and once concat-free. With
+`--fp8` (the default) the single block's linears are quantized like the real
+checkpoint. Quantizing the two parts of the linear2 input separately changes the
+rounding, so with FP8 the outputs are close but not identical. The script exits
+with an error if the relative difference exceeds the tolerance.
+
+    python benchmark_concat_free.py
+    python benchmark_concat_free.py --fp8 False
+"""
+
+import math
+import sys
+
+import torch
+from fire import Fire
+from torch import nn
+
+from benchmark_utils import relative_error
+from flux.modules.float8_linear import F8Linear
+from flux.modules.layers import DoubleStreamBlock, EmbedND, SingleStreamBlock
+from flux.position_cache import PositionCache
+
+HIDDEN_SIZE = 3072
+NUM_HEADS = 24
+TXT_LEN = 512
+SIZE = (64, 64)
+REPEATS = 20
+TOLERANCE = {True: 2e-2, False: 1e-2}
+
+
+def time_fn(fn) -> float:
+    """Milliseconds per call, after a warm-up call."""
+    fn()
+    start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+    start.record()
+    for _ in range(REPEATS):
+        fn()
+    end.record()
+    torch.cuda.synchronize()
+    return start.elapsed_time(end) / REPEATS
+
+
+@torch.inference_mode()
+def main(fp8: bool = True):
+    device = torch.device("cuda")
+    torch.manual_seed(0)
+    double = DoubleStreamBlock(HIDDEN_SIZE, NUM_HEADS, mlp_ratio=4.0, qkv_bias=True)
+    single = SingleStreamBlock(HIDDEN_SIZE, NUM_HEADS, mlp_ratio=4.0)
+    # F8Linear weights are only filled in by a checkpoint, initialise them like nn.Linear
+    for module in single.modules():
+        if isinstance(module, F8Linear):
+            nn.init.kaiming_uniform_(module.weight, a=math.sqrt(5))
+            nn.init.zeros_(module.bias)
+    double = double.to(device, torch.bfloat16).eval()
+    single = single.to(device, torch.bfloat16).eval()
+    if fp8:
+        for module in single.modules():
+            if isinstance(module, F8Linear):
+                module.quantize_weight()
+
+    position_cache = PositionCache(EmbedND(dim=HIDDEN_SIZE // NUM_HEADS, theta=10_000, axes_dim=[16, 56, 56]), device)
+    pe = position_cache.rope_table(TXT_LEN, SIZE, SIZE)
+    img_len = 2 * SIZE[0] * SIZE[1]
+    img = torch.randn(1, img_len, HIDDEN_SIZE, device=device, dtype=torch.bfloat16)
+    txt = torch.randn(1, TXT_LEN, HIDDEN_SIZE, device=device, dtype=torch.bfloat16)
+    vec = torch.randn(1, HIDDEN_SIZE, device=device, dtype=torch.bfloat16)
+    x = torch.cat((txt, img), dim=1)
+
+    blocks = {
+        "double": (double, lambda block: block(img=img, txt=txt, vec=vec, pe=pe)),
+        "single": (single, lambda block: block(x, vec=vec, pe=pe)),
+    }
+    failed = False
+    print(f"{'block':>8}{'error':>10}{'cat eager':>12}{'free eager':>12}{'cat compiled':>14}{'free compiled':>15}")
+    for name, (block, run) in blocks.items():
+        outputs, times = {}, {}
+        for concat_free in (False, True):
+            block.concat_free = concat_free
+            outputs[concat_free] = run(block)
+            times[concat_free, "eager"] = time_fn(lambda: run(block))
+            compiled = torch.compile(block)
+            times[concat_free, "compiled"] = time_fn(lambda: run(compiled))
+
+        if name == "double":
+            error = max(relative_error(a, b) for a, b in zip(outputs[True], outputs[False]))
+        else:
+            error = relative_error(outputs[True], outputs[False])
+        failed |= error > TOLERANCE[fp8]
+        print(
+            f"{name:>8}{error:>10.2e}{times[False, 'eager']:>10.2f}ms{times[True, 'eager']:>10.2f}ms"
+            f"{times[False, 'compiled']:>12.2f}ms{times[True, 'compiled']:>13.2f}ms"
+        )
+
+    if failed:
+        print("Concat-free output differs by more than the tolerance")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    Fire(main)
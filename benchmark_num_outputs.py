@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Throughput of `num_outputs` batches against the same images generated with
+sequential single-output calls.
+
+Output i of a batch uses seed + i, so it is compared, by PSNR, with the
+sequential call that uses that seed. Batched matmuls don't promise bit identical
+results, the PSNR should just be high.
+"""
+
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmark_utils import psnr
+from predict import FluxDevKontextPredictor
+
+BATCH_SIZES = [1, 2, 4]
+SEED = 42
+PREDICT_KWARGS = dict(
+    prompt="make him into an oil painting, exactly preserving his likeness and facial features",
+    input_image="lady.png",
+    aspect_ratio="match_input_image",
+    num_inference_steps=28,
+    guidance=2.5,
+    output_format="png",
+    output_quality=100,
+    disable_safety_checker=True,
+    go_fast=True,
+    acceleration_level="default",
+    adaptive_threshold=0.15,
+    taylor_seer_scope="model",
+    taylor_seer_order=1,
+    sampler="euler",
+    early_safety_check=False,
+    per_output_guidance="",
+    preview_every=0,
+)
+
+
+def run(predictor: FluxDevKontextPredictor, seed: int, num_outputs: int) -> tuple[list[np.ndarray], float]:
+    torch.cuda.synchronize()
+    t0 = time.time()
+    outputs = list(predictor.predict(seed=seed, num_outputs=num_outputs, **PREDICT_KWARGS))
+    elapsed = time.time() - t0
+    return [np.array(Image.open(output).convert("RGB")) for output in outputs], elapsed
+
+
+def main():
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    # the batch dimension is dynamic in the compiled graph, warm it up once
+    run(predictor, SEED, max(BATCH_SIZES))
+
+    print(f"{'outputs':>8}{'sequential (s)':>16}{'batched (s)':>13}{'images/s':>10}{'speedup':>9}{'min PSNR':>10}")
+    for num_outputs in BATCH_SIZES:
+        sequential, sequential_time = [], 0.0
+        for i in range(num_outputs):
+            images, elapsed = run(predictor, SEED + i, 1)
+            sequential += images
+            sequential_time += elapsed
+
+        batched, batched_time = run(predictor, SEED, num_outputs)
+        min_psnr = min(psnr(a, b) for a, b in zip(batched, sequential))
+        print(
+            f"{num_outputs:>8}{sequential_time:>16.2f}{batched_time:>13.2f}"
+            f"{num_outputs / batched_time:>10.2f}{sequential_time / batched_time:>8.2f}x{min_psnr:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
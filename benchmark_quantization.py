@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Memory, latency and output drift of quantization policies.
+
+Each policy, a built-in name ("bf16", "default") or a JSON/YAML file, is loaded
+into a fresh transformer from the bf16 checkpoint. The script reports the GPU
+memory of the transformer, the estimated size of its linear weights, the
+denoising time of one request and how far its output drifts from the first
+policy: the relative L2 error of the final latent and the PSNR of the decoded
+image, with the same prompt and seed.
+
+    python benchmark_quantization.py --policies bf16,default,quantization_policy.json
+"""
+
+import gc
+import time
+
+import torch
+from fire import Fire
+
+from benchmark_utils import parse_list, psnr
+from flux.quantization import estimate_weight_bytes, finish_quantization, load_policy
+from flux.sampling import denoise, get_schedule, unpack
+from flux.util import ASPECT_RATIOS
+from predict import FluxDevKontextPredictor, load_kontext_model
+
+
+@torch.inference_mode()
+def main(
+    policies: str | tuple = "bf16,default",
+    image: str = "lady.png",
+    prompt: str = "make him into an oil painting, exactly preserving his likeness and facial features",
+    aspect_ratio: str = "1:1",
+    num_inference_steps: int = 28,
+    guidance: float = 2.5,
+    seed: int = 42,
+    compile: bool = True,
+):
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    del predictor.model
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    width, height = ASPECT_RATIOS[aspect_ratio]
+    inp, height, width = predictor.encoding_stage(
+        prompt=prompt, img_cond_path=image, seed=seed, target_width=width, target_height=height
+    )
+    timesteps = get_schedule(num_inference_steps, inp["img"].shape[1], shift=True)
+
+    results = {}
+    reference = None
+    for policy_name in parse_list(policies):
+        policy = load_policy(policy_name)
+        before = torch.cuda.memory_allocated()
+        model = load_kontext_model(device=torch.device("cpu"), policy=policy).to(predictor.device)
+        methods = finish_quantization(model, policy)
+        gc.collect()
+        torch.cuda.empty_cache()
+        memory = torch.cuda.memory_allocated() - before
+        if compile:
+            model.step = torch.compile(model.step, dynamic=True)
+
+        def run() -> tuple[torch.Tensor, float]:
+            torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            x = denoise(model, **inp, timesteps=timesteps, guidance=guidance, precompute_modulation=True)
+            torch.cuda.synchronize()
+            return x.float(), time.perf_counter() - t0
+
+        # the first run compiles
+        run()
+        latent, elapsed = run()
+        with torch.autocast(device_type=predictor.device.type, dtype=torch.bfloat16):
+            decoded = predictor.ae.decode(unpack(latent, height, width))
+        if reference is None:
+            reference = (latent, decoded)
+        error = (torch.linalg.vector_norm(latent - reference[0]) / torch.linalg.vector_norm(reference[0])).item()
+        weight_bytes = estimate_weight_bytes(model, methods)
+        results[policy.name] = (memory, weight_bytes, elapsed, error, psnr(decoded.clamp(-1, 1), reference[1].clamp(-1, 1), data_range=2.0))
+        print(f"Benchmarked {policy.name}")
+
+        del model
+        gc.collect()
+        torch.cuda.empty_cache()
+        torch._dynamo.reset()
+
+    print(f"{'policy':<24}{'memory':>10}{'linears':>10}{'denoise':>10}{'latent err':>12}{'PSNR':>8}")
+    for name, (memory, weight_bytes, elapsed, error, image_psnr) in results.items():
+        print(
+            f"{name:<24}{memory / 1024**3:>8.2f}GB{weight_bytes / 1024**3:>8.2f}GB{elapsed:>9.2f}s"
+            f"{error:>12.4f}{image_psnr:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    Fire(main)
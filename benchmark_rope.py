@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Check `apply_rope_table` against the reference `apply_rope` and time both.
+
+q and k have the shape of a 1024x1024 Kontext request: 512 text tokens followed
+by the generated and the conditioning image tokens, with the position ids the
+predictor uses. The tables are tested in float32, where the result has to match
+the reference up to rounding of the bf16 output, and in bf16, where the tables
+themselves are rounded. The script exits with an error if either is off by more
+than the tolerance.
+
+Both versions are timed eager and under torch.compile, per attention call.
+"""
+
+import sys
+
+import torch
+
+from flux.math import RopeTable, apply_rope, apply_rope_table
+from flux.modules.layers import EmbedND
+from flux.position_cache import PositionCache
+
+NUM_HEADS = 24
+HEAD_DIM = 128
+TXT_LEN = 512
+SIZE = (64, 64)
+REPEATS = 20
+# max abs error relative to the max abs value of the output
+TOLERANCE = {torch.float32: 1e-2, torch.bfloat16: 2e-2}
+
+
+def time_fn(fn, *args) -> float:
+    """Milliseconds per call, after a warm-up call."""
+    fn(*args)
+    start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+    start.record()
+    for _ in range(REPEATS):
+        fn(*args)
+    end.record()
+    torch.cuda.synchronize()
+    return start.elapsed_time(end) / REPEATS
+
+
+@torch.inference_mode()
+def main():
+    device = torch.device("cuda")
+    position_cache = PositionCache(EmbedND(dim=HEAD_DIM, theta=10_000, axes_dim=[16, 56, 56]), device)
+    pe = position_cache.pe(TXT_LEN, SIZE, SIZE)
+    seq_len = pe.shape[2]
+
+    # q and k come out of a rearrange of the qkv projection, i.e. they are not contiguous
+    qkv = torch.randn(1, seq_len, 3, NUM_HEADS, HEAD_DIM, device=device, dtype=torch.bfloat16)
+    q, k = qkv[:, :, 0].transpose(1, 2), qkv[:, :, 1].transpose(1, 2)
+    q_ref, k_ref = apply_rope(q, k, pe)
+
+    failed = False
+    tables = {}
+    for dtype in (torch.float32, torch.bfloat16):
+        tables[dtype] = position_cache.rope_table(TXT_LEN, SIZE, SIZE, dtype=dtype)
+        q_out, k_out = apply_rope_table(q, k, tables[dtype])
+        error = max(
+            ((q_out.float() - q_ref.float()).abs().max() / q_ref.float().abs().max()).item(),
+            ((k_out.float() - k_ref.float()).abs().max() / k_ref.float().abs().max()).item(),
+        )
+        ok = error <= TOLERANCE[dtype]
+        failed |= not ok
+        print(f"{str(dtype):>15} table: relative max error {error:.2e} {'ok' if ok else 'FAILED'}")
+
+    # the text prefix must come through untouched
+    q_out, _ = apply_rope_table(q, k, tables[torch.bfloat16])
+    if not torch.equal(q_out[:, :, :TXT_LEN], q[:, :, :TXT_LEN]):
+        print("Text prefix was modified FAILED")
+        failed = True
+
+    full_table = RopeTable.from_pe(pe, torch.bfloat16)
+    variants = {
+        "apply_rope": (apply_rope, pe),
+        "table, full": (apply_rope_table, full_table),
+        "table, text skipped": (apply_rope_table, tables[torch.bfloat16]),
+    }
+    print(f"{'':>20}{'eager':>10}{'compiled':>10}")
+    for name, (fn, table) in variants.items():
+        # attention makes q and k contiguous afterwards, apply_rope_table's outputs already are
+        def run(fn=fn, table=table):
+            q_out, k_out = fn(q, k, table)
+            return q_out.contiguous(), k_out.contiguous()
+
+        eager = time_fn(run)
+        compiled = time_fn(torch.compile(run))
+        print(f"{name:>20}{eager:>8.3f}ms{compiled:>8.3f}ms")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Step count vs. quality for the samplers in `flux.sampling.SAMPLERS`.
+
+Quality is the PSNR against a 50 step Euler reference. The first table uses a
+tiny randomly initialised `Flux` on the CPU and compares final latents, the
+second one runs the real predictor on the Kontext checkpoint when it and a GPU
+are available and compares the decoded images.
+"""
+
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from benchmark_utils import TINY_PARAMS, psnr, tiny_model
+from flux.position_cache import get_img_ids, get_txt_ids
+from flux.sampling import SAMPLERS, denoise, get_schedule
+
+STEP_COUNTS = [4, 8, 12, 16, 20, 28]
+REFERENCE_STEPS = 50
+
+
+def print_table(results: dict[str, dict[int, float]]):
+    print(f"{'sampler':<10}" + "".join(f"{steps:>8}" for steps in STEP_COUNTS))
+    for name, row in results.items():
+        print(f"{name:<10}" + "".join(f"{row[steps]:>8.2f}" for steps in STEP_COUNTS))
+
+
+@torch.inference_mode()
+def benchmark_tiny_model():
+    model = tiny_model()
+    generator = torch.Generator().manual_seed(42)
+    height, width = 8, 8
+    inp = {
+        "img": torch.randn(1, height * width, TINY_PARAMS.in_channels, generator=generator),
+        "img_ids": get_img_ids(height, width),
+        "txt": torch.randn(1, 16, TINY_PARAMS.context_in_dim, generator=generator),
+        "txt_ids": get_txt_ids(16),
+        "vec": torch.randn(1, TINY_PARAMS.vec_in_dim, generator=generator),
+    }
+    seq_len = inp["img"].shape[1]
+
+    reference = denoise(model, **inp, timesteps=get_schedule(REFERENCE_STEPS, seq_len), guidance=2.5)
+    reference = reference.numpy()
+    data_range = float(reference.max() - reference.min())
+
+    results = {}
+    for name in SAMPLERS:
+        results[name] = {}
+        for steps in STEP_COUNTS:
+            x = denoise(model, **inp, timesteps=get_schedule(steps, seq_len), guidance=2.5, sampler=name)
+            results[name][steps] = psnr(x.numpy(), reference, data_range)
+
+    print("Tiny model on CPU, latent PSNR vs 50 step Euler")
+    print_table(results)
+
+
+def benchmark_checkpoint():
+    from predict import KONTEXT_WEIGHTS_PATH, FluxDevKontextPredictor
+
+    if not torch.cuda.is_available() or not os.path.exists(KONTEXT_WEIGHTS_PATH):
+        print("Skipping the checkpoint benchmark, it needs a GPU and the Kontext weights")
+        return
+
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    os.makedirs("output_images", exist_ok=True)
+
+    def run(sampler: str, steps: int) -> np.ndarray:
+        *_, result = predictor.predict(
+            prompt="make him into an oil painting, exactly preserving his likeness and facial features",
+            input_image="lady.png",
+            aspect_ratio="match_input_image",
+            num_inference_steps=steps,
+            guidance=2.5,
+            seed=42,
+            output_format="png",
+            output_quality=100,
+            disable_safety_checker=True,
+            go_fast=False,
+            acceleration_level="none",
+            adaptive_threshold=0.15,
+            taylor_seer_scope="model",
+            taylor_seer_order=1,
+            sampler=sampler,
+            early_safety_check=False,
+            num_outputs=1,
+            per_output_guidance="",
+            preview_every=0,
+        )
+        output_file = f"output_images/sampler_{sampler}_{steps}.png"
+        os.replace(result, output_file)
+        return np.array(Image.open(output_file).convert("RGB"))
+
+    reference = run("euler", REFERENCE_STEPS)
+    results = {}
+    for name in SAMPLERS:
+        results[name] = {}
+        for steps in STEP_COUNTS:
+            t0 = time.time()
+            image = run(name, steps)
+            print(f"{name} with {steps} steps took {time.time() - t0:.2f} seconds")
+            results[name][steps] = psnr(image, reference, 255.0)
+
+    print("Kontext checkpoint, image PSNR vs 50 step Euler")
+    print_table(results)
+
+
+if __name__ == "__main__":
+    benchmark_tiny_model()
+    benchmark_checkpoint()
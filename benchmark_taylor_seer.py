@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compare model-level and block-level TaylorSeer on a fixed seed.
+
+Every configuration is timed and compared, by PSNR, against a run without step
+skipping and against the current `go_fast` output (model level, first order).
+"""
+
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from benchmark_utils import psnr
+from predict import FluxDevKontextPredictor
+
+PROMPT = "make him into an oil painting, exactly preserving his likeness and facial features"
+INPUT_IMAGE = "lady.png"
+SEED = 42
+NUM_INFERENCE_STEPS = 28
+
+CONFIGS = {
+    "reference": {"acceleration_level": "none"},
+    "go_fast": {"acceleration_level": "go really fast", "taylor_seer_scope": "model", "taylor_seer_order": 1},
+    "model_order_2": {"acceleration_level": "go really fast", "taylor_seer_scope": "model", "taylor_seer_order": 2},
+    "block_order_1": {"acceleration_level": "go really fast", "taylor_seer_scope": "block", "taylor_seer_order": 1},
+    "block_order_2": {"acceleration_level": "go really fast", "taylor_seer_scope": "block", "taylor_seer_order": 2},
+    "block_order_3": {"acceleration_level": "go really fast", "taylor_seer_scope": "block", "taylor_seer_order": 3},
+}
+
+
+def main():
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    os.makedirs("output_images", exist_ok=True)
+
+    images = {}
+    timings = {}
+    for name, config in CONFIGS.items():
+        t0 = time.time()
+        *_, result = predictor.predict(
+            prompt=PROMPT,
+            input_image=INPUT_IMAGE,
+            aspect_ratio="match_input_image",
+            num_inference_steps=NUM_INFERENCE_STEPS,
+            guidance=2.5,
+            seed=SEED,
+            output_format="png",
+            output_quality=100,
+            disable_safety_checker=True,
+            go_fast=False,
+            adaptive_threshold=0.15,
+            taylor_seer_scope=config.get("taylor_seer_scope", "model"),
+            taylor_seer_order=config.get("taylor_seer_order", 1),
+            acceleration_level=config["acceleration_level"],
+            sampler="euler",
+            early_safety_check=False,
+            num_outputs=1,
+            per_output_guidance="",
+            preview_every=0,
+        )
+        timings[name] = time.time() - t0
+        output_file = f"output_images/taylor_seer_{name}.png"
+        os.replace(result, output_file)
+        images[name] = np.array(Image.open(output_file).convert("RGB"))
+
+    print(f"{'config':<16}{'time (s)':>10}{'PSNR vs reference':>20}{'PSNR vs go_fast':>18}")
+    for name in CONFIGS:
+        print(
+            f"{name:<16}{timings[name]:>10.2f}"
+            f"{psnr(images[name], images['reference']):>20.2f}"
+            f"{psnr(images[name], images['go_fast']):>18.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
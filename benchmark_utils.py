@@ -0,0 +1,84 @@
+"""
+Helpers shared by the benchmark, evaluation and check scripts: command line list
+parsing, PSNR and relative error, and a tiny randomly initialised Flux with the
+real block layout for CPU runs.
+"""
+
+import math
+
+import numpy as np
+import torch
+from torch import nn
+
+from flux.model import Flux, FluxParams
+from flux.modules.float8_linear import F8Linear
+from flux.position_cache import get_img_ids, get_txt_ids
+
+TINY_PARAMS = FluxParams(
+    in_channels=64,
+    out_channels=64,
+    vec_in_dim=32,
+    context_in_dim=48,
+    hidden_size=64,
+    mlp_ratio=2.0,
+    num_heads=2,
+    depth=2,
+    depth_single_blocks=2,
+    axes_dim=[8, 12, 12],
+    theta=10_000,
+    qkv_bias=True,
+    guidance_embed=True,
+)
+# latent height and width and text length of `tiny_kontext_inputs`
+TINY_SIZE = (4, 6)
+TINY_TXT_LEN = 8
+
+
+def parse_list(value: str | tuple) -> list[str]:
+    # fire already parses "1:1,16:9" into a tuple
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(v) for v in (value if isinstance(value, (list, tuple)) else [value])]
+
+
+def psnr(x: np.ndarray | torch.Tensor, reference: np.ndarray | torch.Tensor, data_range: float = 255.0) -> float:
+    """PSNR of two images or latents whose values span `data_range`, 255 for uint8 images."""
+    x, reference = (np.asarray(v.float().cpu()) if isinstance(v, torch.Tensor) else v for v in (x, reference))
+    mse = np.mean((x.astype(np.float64) - reference.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float("inf")
+    return float(10 * np.log10(data_range**2 / mse))
+
+
+def relative_error(x: torch.Tensor, reference: torch.Tensor) -> float:
+    """Max abs error relative to the max abs value of the reference."""
+    return ((x.float() - reference.float()).abs().max() / reference.float().abs().max()).item()
+
+
+def tiny_model(seed: int = 0) -> Flux:
+    """A randomly initialised float32 Flux with the real block layout, small enough for the CPU."""
+    torch.manual_seed(seed)
+    model = Flux(TINY_PARAMS)
+    # F8Linear weights are only filled in by a checkpoint, initialise them like nn.Linear. Unquantized
+    # they run as a plain linear
+    for module in model.modules():
+        if isinstance(module, F8Linear):
+            nn.init.kaiming_uniform_(module.weight, a=math.sqrt(5))
+            nn.init.zeros_(module.bias)
+    return model.to(torch.float32).eval()
+
+
+def tiny_kontext_inputs(seed: int) -> dict[str, torch.Tensor]:
+    """Noise, conditioning tokens and text of one request for `tiny_model`, like `prepare_kontext` with `bs=1`."""
+    generator = torch.Generator().manual_seed(seed)
+    h, w = TINY_SIZE
+    channels = TINY_PARAMS.in_channels
+    return {
+        "img": torch.randn(1, h * w, channels, generator=generator),
+        "img_ids": get_img_ids(h, w),
+        "img_cond_seq": torch.randn(1, h * w, channels, generator=generator),
+        "img_cond_seq_ids": get_img_ids(h, w, index=1),
+        "txt": torch.randn(1, TINY_TXT_LEN, TINY_PARAMS.context_in_dim, generator=generator),
+        "txt_ids": get_txt_ids(TINY_TXT_LEN),
+        "vec": torch.randn(1, TINY_PARAMS.vec_in_dim, generator=generator),
+    }
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Calibrate static input scales for the FP8 linears and report their error.
+
+Calibration runs the full denoising loop, so every timestep is covered, for
+every prompt at every calibration aspect ratio. Each run is one trial of
+`InputScaleCalibration`. The frozen scales, the largest input amax seen times
+`margin`, are written next to the weights where the predictor picks them up.
+
+The report comes from a validation run at an aspect ratio and seed that were
+not calibrated on. Every F8Linear output is compared with the output of the
+same input under dynamic scaling, which gives a relative L2 error per layer
+and the fraction of calls whose input exceeded the calibrated range and was
+clipped. The script also prints the denoising time and the final latent
+difference of the static scales against dynamic scaling.
+
+    python calibrate_fp8.py --aspect_ratios 1:1,16:9,9:16,4:3,3:4 --margin 1.0
+"""
+
+import json
+import time
+from collections import defaultdict
+
+import torch
+from fire import Fire
+
+from benchmark_utils import parse_list
+from flux.modules.float8_linear import InputScaleCalibration, f8_linears, save_input_scales
+from flux.sampling import denoise, get_schedule
+from flux.util import ASPECT_RATIOS
+from predict import FP8_INPUT_SCALES_PATH, FluxDevKontextPredictor
+
+DEFAULT_PROMPTS = [
+    "make him into an oil painting, exactly preserving his likeness and facial features",
+    "make it a watercolor",
+    "change the background to a beach at sunset",
+    "turn the photo into a pencil sketch",
+]
+
+
+@torch.inference_mode()
+def main(
+    image: str = "lady.png",
+    prompts: str | None = None,
+    aspect_ratios: str | tuple = "1:1,16:9,9:16,4:3,3:4",
+    validation_aspect_ratio: str = "3:2",
+    num_inference_steps: int = 28,
+    guidance: float = 2.5,
+    margin: float = 1.0,
+    seed: int = 42,
+    output: str = FP8_INPUT_SCALES_PATH,
+    top: int = 20,
+):
+    if prompts is None:
+        prompt_list = DEFAULT_PROMPTS
+    else:
+        with open(prompts) as f:
+            prompt_list = [line.strip() for line in f if line.strip()]
+    aspect_ratios = parse_list(aspect_ratios)
+
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    model = predictor.model
+    # run the transformer eagerly, calibration and the error hooks change module state every call
+    del model.step
+    model.set_concat_free(False)
+
+    def run(prompt: str, aspect_ratio: str, run_seed: int) -> tuple[torch.Tensor, float]:
+        width, height = ASPECT_RATIOS[aspect_ratio]
+        inp, _, _ = predictor.encoding_stage(
+            prompt=prompt, img_cond_path=image, seed=run_seed, target_width=width, target_height=height
+        )
+        timesteps = get_schedule(num_inference_steps, inp["img"].shape[1], shift=True)
+        torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        x = denoise(model, **inp, timesteps=timesteps, guidance=guidance, precompute_modulation=True)
+        torch.cuda.synchronize()
+        return x.float(), time.perf_counter() - t0
+
+    layers = f8_linears(model)
+    for layer in layers.values():
+        layer.clear_input_scale()
+
+    with InputScaleCalibration(model) as calibration:
+        for aspect_ratio in aspect_ratios:
+            for prompt in prompt_list:
+                run(prompt, aspect_ratio, seed)
+                calibration.next_trial()
+            print(f"Calibrated on {aspect_ratio}")
+    uncalibrated = calibration.freeze(margin)
+    calibrated = {name: layer for name, layer in calibration.layers.items() if name not in uncalibrated}
+    save_input_scales(
+        model,
+        output,
+        metadata={
+            "aspect_ratios": json.dumps(aspect_ratios),
+            "num_prompts": str(len(prompt_list)),
+            "num_inference_steps": str(num_inference_steps),
+            "margin": str(margin),
+        },
+    )
+    print(f"Saved static input scales of {len(calibrated)} layers to {output}")
+    if uncalibrated:
+        print(f"{len(uncalibrated)} layers saw no input during calibration and stay on dynamic scaling:")
+        for name in uncalibrated:
+            print(f"  {name}")
+
+    # per-layer error of the static scales on a validation run
+    errors = defaultdict(list)
+    clipped = defaultdict(int)
+
+    def compare(name: str):
+        def hook(layer, inputs, output):
+            x = inputs[0]
+            reference = layer.forward(x, static_input_scale=False)
+            error = torch.linalg.vector_norm(output.float() - reference.float()) / torch.linalg.vector_norm(
+                reference.float()
+            )
+            errors[name].append(error.item())
+            clipped[name] += int((x.abs().max() * layer.input_scale > layer.input_max_value).item())
+
+        return hook
+
+    validation_prompt = prompt_list[0]
+    handles = [layer.register_forward_hook(compare(name)) for name, layer in calibrated.items()]
+    try:
+        run(validation_prompt, validation_aspect_ratio, seed + 1)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    print(f"{'layer':<40}{'mean err':>10}{'max err':>10}{'clipped':>9}")
+    ranked = sorted(errors, key=lambda name: max(errors[name]), reverse=True)
+    for name in ranked[:top]:
+        calls = len(errors[name])
+        print(
+            f"{name:<40}{sum(errors[name]) / calls:>10.4f}{max(errors[name]):>10.4f}"
+            f"{clipped[name] / calls:>9.1%}"
+        )
+    all_errors = [error for name in errors for error in errors[name]]
+    print(f"All {len(errors)} layers: mean error {sum(all_errors) / len(all_errors):.4f}, max {max(all_errors):.4f}")
+
+    # end to end against dynamic scaling
+    static_latent, static_time = run(validation_prompt, validation_aspect_ratio, seed + 1)
+    for layer in layers.values():
+        layer.input_scale_initialized = False
+    dynamic_latent, dynamic_time = run(validation_prompt, validation_aspect_ratio, seed + 1)
+    for layer in calibrated.values():
+        layer.input_scale_initialized = True
+    latent_error = torch.linalg.vector_norm(static_latent - dynamic_latent) / torch.linalg.vector_norm(dynamic_latent)
+    print(
+        f"Denoising (eager): dynamic {dynamic_time:.2f}s, static {static_time:.2f}s, "
+        f"final latent relative error {latent_error.item():.4f}"
+    )
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Check `ContinuousBatchScheduler` against `denoise` on a tiny randomly initialised
+Flux model on the CPU.
+
+Requests of the same shape but with different step counts, guidance values,
+samplers and `compute_step_map`s are submitted at different times, so rows join
+and leave the in-flight batch mid-way. Every finished request has to match
+`denoise` run on it alone, up to the rounding of the batched float32 GEMMs. The
+script exits with an error if any request is off by more than the tolerance.
+
+    python check_continuous_batching.py
+"""
+
+import sys
+
+import torch
+from fire import Fire
+
+from benchmark_utils import TINY_SIZE, relative_error, tiny_kontext_inputs, tiny_model
+from flux.sampling import denoise, get_schedule
+from flux.scheduler import ContinuousBatchScheduler, DenoiseRequest
+
+# max abs error relative to the max abs value of the reference
+TOLERANCE = 1e-4
+
+
+@torch.inference_mode()
+def main(max_batch_size: int = 2, precompute_modulation: bool = True):
+    model = tiny_model()
+    seq_len = TINY_SIZE[0] * TINY_SIZE[1]
+    # (arrival step, num_steps, guidance, sampler, compute_step_map)
+    jobs = [
+        (0, 6, 2.5, "euler", None),
+        (0, 4, 4.0, "ab2", None),
+        (1, 8, 3.0, "euler", [True, True, False, True, False, False, True, True]),
+        (3, 5, 2.0, "dpmpp_2m", [True, True, False, True, True]),
+        (3, 6, 2.5, "ab3", [True, True, True, False, False, True]),
+    ]
+
+    scheduler = ContinuousBatchScheduler(
+        model, max_batch_size=max_batch_size, precompute_modulation=precompute_modulation
+    )
+    requests, results = {}, {}
+    step = 0
+    while len(results) < len(jobs):
+        for i, (arrival, num_steps, guidance, sampler, compute_step_map) in enumerate(jobs):
+            if arrival == step:
+                requests[i] = DenoiseRequest(
+                    **tiny_kontext_inputs(seed=i),
+                    timesteps=get_schedule(num_steps, seq_len, shift=True),
+                    guidance=guidance,
+                    compute_step_map=compute_step_map,
+                    n_derivatives=2,
+                    sampler=sampler,
+                    request_id=i,
+                )
+                scheduler.submit(requests[i])
+        results.update(scheduler.step())
+        step += 1
+
+    failed = False
+    for i, request in requests.items():
+        reference = denoise(
+            model,
+            **tiny_kontext_inputs(seed=i),
+            timesteps=request.timesteps,
+            guidance=request.guidance,
+            compute_step_map=request.compute_step_map,
+            n_derivatives=request.n_derivatives,
+            precompute_modulation=precompute_modulation,
+            sampler=request.sampler,
+        )
+        error = relative_error(results[i], reference)
+        ok = error <= TOLERANCE
+        failed |= not ok
+        print(
+            f"request {i} ({request.num_steps} steps, {request.sampler}): "
+            f"relative error {error:.2e} {'ok' if ok else 'FAILED'}"
+        )
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Convert `kontext-dev.sft` into a pre-quantized FP8 checkpoint.
+
+The F8Linear layers are quantized while the bf16 weights load, exactly as the
+predictor does it at startup, and saved as `float8_data` with their scales. If
+calibrated static input scales exist (see `calibrate_fp8.py`) they are stored
+in the checkpoint too. When the output file exists the predictor loads it
+instead of the bf16 weights, which reads half the bytes for the quantized
+layers and skips `quantize_weight`.
+
+    python convert_fp8_checkpoint.py
+    python convert_fp8_checkpoint.py --input_scales none
+"""
+
+import os
+import time
+
+import torch
+from fire import Fire
+from safetensors.torch import load_file as load_sft
+
+from flux.model import Flux
+from flux.modules.float8_linear import f8_linears, load_input_scales
+from flux.util import configs, save_fp8_checkpoint
+from predict import FP8_INPUT_SCALES_PATH, KONTEXT_FP8_WEIGHTS_PATH, KONTEXT_WEIGHTS_PATH
+
+
+def size_gb(path: str) -> float:
+    return os.path.getsize(path) / 1024**3
+
+
+@torch.inference_mode()
+def main(
+    weights: str = KONTEXT_WEIGHTS_PATH,
+    output: str = KONTEXT_FP8_WEIGHTS_PATH,
+    input_scales: str | None = FP8_INPUT_SCALES_PATH,
+    device: str = "cpu",
+):
+    with torch.device("meta"):
+        model = Flux(configs["flux-dev"].params).to(torch.bfloat16)
+
+    t0 = time.perf_counter()
+    sd = load_sft(weights, device=device)
+    missing, unexpected = model.load_state_dict(sd, strict=False, assign=True)
+    if missing:
+        print(f"Missing keys: {missing}")
+    if unexpected:
+        print(f"Unexpected keys: {unexpected}")
+    print(f"Loaded and quantized {weights} in {time.perf_counter() - t0:.2f}s")
+
+    if input_scales and input_scales != "none" and os.path.exists(input_scales):
+        loaded = load_input_scales(model, input_scales)
+        print(f"Added static input scales of {loaded} layers from {input_scales}")
+
+    layers = f8_linears(model)
+    not_quantized = [name for name, layer in layers.items() if not layer.weight_initialized]
+    if not_quantized:
+        raise RuntimeError(f"F8Linear layers were not quantized: {not_quantized}")
+
+    save_fp8_checkpoint(model, output)
+    print(f"Saved {len(layers)} quantized layers to {output}")
+    print(f"Size: {size_gb(weights):.2f} GB -> {size_gb(output):.2f} GB")
+
+    # round trip, the converted file has to load into a fresh model without re-quantizing
+    with torch.device("meta"):
+        check = Flux(configs["flux-dev"].params).to(torch.bfloat16)
+    t0 = time.perf_counter()
+    check.load_state_dict(load_sft(output, device=device), strict=True, assign=True)
+    print(f"Loaded {output} in {time.perf_counter() - t0:.2f}s")
+    for name, layer in f8_linears(check).items():
+        if not torch.equal(layer.float8_data.view(torch.uint8), layers[name].float8_data.view(torch.uint8)):
+            raise RuntimeError(f"{name} differs after loading the converted checkpoint")
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Evaluate the early-abort safety check against the check on the final image.
+
+Every example is denoised in full. At each candidate abort step the safety
+checker classifies the linear RGB preview of the predicted clean latent, and in
+the end it classifies the decoded image. Per abort step the script reports:
+
+- false negatives: images flagged in the end but not by the early check, these
+  still cost a full run before the final check rejects them
+- false positives: images the early check would have aborted although the final
+  image passes
+- steps saved: denoising steps skipped for correctly aborted images
+
+The examples are a JSON lines file of {"image": ..., "prompt": ...} records,
+and it should contain prompts that trip the checker for the rates to mean much.
+
+    python evaluate_early_safety_check.py --examples eval.jsonl --fractions 0.4,0.5,0.6
+"""
+
+import json
+import time
+
+import torch
+from fire import Fire
+
+from flux.sampling import denoise, get_schedule, unpack
+from predict import FluxDevKontextPredictor
+from safety_checker import EarlySafetyCheck
+
+
+@torch.inference_mode()
+def main(
+    examples: str,
+    fractions: str | tuple[float, ...] = "0.4,0.5,0.6",
+    num_inference_steps: int = 28,
+    guidance: float = 2.5,
+    seed: int = 42,
+):
+    # fire already parses "0.4,0.5,0.6" into a tuple
+    if isinstance(fractions, str):
+        fractions = fractions.split(",")
+    fractions = [float(f) for f in (fractions if isinstance(fractions, (list, tuple)) else [fractions])]
+    with open(examples) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    checker = predictor.safety_checker
+
+    # per fraction: (early flag, final flag) of every example
+    results = {fraction: [] for fraction in fractions}
+    check_times = []
+    for record in records:
+        inp, height, width = predictor.encoding_stage(prompt=record["prompt"], img_cond_path=record["image"], seed=seed)
+        checks = {
+            fraction: EarlySafetyCheck(checker, num_inference_steps, height, width, fraction=fraction)
+            for fraction in fractions
+        }
+        early_flags = {}
+
+        def record_previews(step: int, t: float, img: torch.Tensor, pred: torch.Tensor):
+            for fraction, check in checks.items():
+                if step == check.check_step:
+                    t0 = time.perf_counter()
+                    early_flags[fraction] = any(checker.check(check.preview(t, img, pred)))
+                    check_times.append(time.perf_counter() - t0)
+
+        timesteps = get_schedule(num_inference_steps, inp["img"].shape[1], shift=True)
+        x = denoise(predictor.model, **inp, timesteps=timesteps, guidance=guidance, step_callback=record_previews)
+        x = unpack(x.float(), height, width)
+        with torch.autocast(device_type=predictor.device.type, dtype=torch.bfloat16):
+            x = predictor.ae.decode(x)
+        final_flag = any(checker.check(x))
+
+        print(f"{record['image']} '{record['prompt']}': final {final_flag}, early {early_flags}")
+        for fraction in fractions:
+            results[fraction].append((early_flags[fraction], final_flag))
+
+    print(f"Early check takes {1000 * sum(check_times) / len(check_times):.1f}ms on average")
+    print(f"{'fraction':>8}{'step':>6}{'FN rate':>10}{'FP rate':>10}{'steps saved':>13}")
+    for fraction in fractions:
+        step = checks[fraction].check_step
+        pairs = results[fraction]
+        flagged = [early for early, final in pairs if final]
+        passed = [early for early, final in pairs if not final]
+        fn_rate = flagged.count(False) / len(flagged) if flagged else float("nan")
+        fp_rate = passed.count(True) / len(passed) if passed else float("nan")
+        print(
+            f"{fraction:>8.2f}{step + 1:>6}{fn_rate:>10.2%}{fp_rate:>10.2%}"
+            f"{flagged.count(True) * (num_inference_steps - step - 1):>13}"
+        )
+
+
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,183 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import torch
+from PIL import Image
+from torch import Tensor
+
+from .image_ingest import decode_image, to_model_input
+from .latent_cache import ConditioningLatentCache
+from .modules.autoencoder import AutoEncoder
+from .modules.conditioner import HFEmbedder
+from .position_cache import PositionCache
+from .prompt_cache import PromptEmbeddingCache
+from .sampling import encode_kontext_cond, finish_kontext, get_noise, kontext_cond_size, load_kontext_cond, prepare
+
+
+class EncodingStage:
+    """
+    Concurrent version of `prepare_kontext`.
+
+    Decoding and resizing the conditioning image, the VAE encoder, T5 and CLIP do not
+    depend on each other. Each one runs as a job in a thread pool. On the GPU every job
+    also gets its own CUDA stream, so the encoders can overlap on the device while the
+    image is decoded on the CPU. The result is the same `inp` dict as `prepare_kontext`,
+    apart from `img_cond_orig` which is not kept.
+
+    With `fast_ingest` the image goes through `flux.image_ingest`: JPEGs are decoded at a
+    reduced scale and only uint8 pixels are copied to the device, which does the resize
+    and normalization. Without it the image is resized with LANCZOS on the CPU, exactly
+    like `prepare_kontext`.
+
+    `timings` holds the wall time of every sub-stage of the last call and the total,
+    the critical path, in seconds. `txt_buckets` trims the text tokens to a length bucket,
+    see `flux.sampling.bucket_txt`.
+    """
+
+    def __init__(
+        self,
+        t5: HFEmbedder,
+        clip: HFEmbedder,
+        ae: AutoEncoder,
+        device: str | torch.device,
+        position_cache: PositionCache | None = None,
+        prompt_cache: PromptEmbeddingCache | None = None,
+        latent_cache: ConditioningLatentCache | None = None,
+        max_workers: int = 4,
+        fast_ingest: bool = True,
+        txt_buckets: tuple[int, ...] | None = None,
+    ):
+        self.t5 = t5
+        self.clip = clip
+        self.ae = ae
+        self.device = torch.device(device)
+        self.position_cache = position_cache
+        self.prompt_cache = prompt_cache
+        self.latent_cache = latent_cache
+        self.fast_ingest = fast_ingest
+        self.txt_buckets = txt_buckets
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="encoding")
+        self.streams = {}
+        if self.device.type == "cuda":
+            self.streams = {name: torch.cuda.Stream(self.device) for name in ("text", "t5", "clip", "vae_encode")}
+        self.timings: dict[str, float] = {}
+
+    def _run(self, name: str, fn, *args):
+        """Run `fn` on the stream of `name` and record how long it took to finish on the device."""
+        stream = self.streams.get(name)
+        t0 = time.perf_counter()
+        with torch.inference_mode(), torch.cuda.stream(stream) if stream is not None else nullcontext():
+            result = fn(*args)
+        if stream is not None:
+            stream.synchronize()
+            # the results are consumed on the main stream, keep the allocator from
+            # reusing their memory on this stream before the main stream is done
+            main_stream = torch.cuda.default_stream(self.device)
+            for tensor in result if isinstance(result, tuple) else (result,):
+                if tensor.is_cuda:
+                    tensor.record_stream(main_stream)
+        self.timings[name] = time.perf_counter() - t0
+        return result
+
+    def _encode_image(self, img_cond_path: str, width: int, height: int) -> tuple[Tensor, Tensor]:
+        cache_key = None
+        if self.latent_cache is not None:
+            t0 = time.perf_counter()
+            ingest = "fast" if self.fast_ingest else "lanczos"
+            cache_key = self.latent_cache.key(img_cond_path, height, width, ingest)
+            cached = self.latent_cache.get(cache_key)
+            self.timings["latent_cache"] = time.perf_counter() - t0
+            if cached is not None:
+                return cached
+
+        t0 = time.perf_counter()
+        if self.fast_ingest:
+            size = (8 * width, 8 * height)
+            pixels = decode_image(Image.open(img_cond_path), size, pin_memory=self.device.type == "cuda")
+        else:
+            img_cond = load_kontext_cond(Image.open(img_cond_path), width, height)
+        self.timings["decode"] = time.perf_counter() - t0
+
+        def encode() -> tuple[Tensor, Tensor]:
+            # the upload and device-side resize run on the encoder's stream as well
+            cond = to_model_input(pixels, size, self.device) if self.fast_ingest else img_cond
+            return encode_kontext_cond(self.ae, cond, self.device, self.position_cache)
+
+        img_cond, img_cond_ids = self._run("vae_encode", encode)
+        if self.latent_cache is not None:
+            self.latent_cache.put(cache_key, img_cond, img_cond_ids)
+        return img_cond, img_cond_ids
+
+    def __call__(
+        self,
+        prompt: str | list[str],
+        img_cond_path: str,
+        seed: int | list[int],
+        target_width: int | None = None,
+        target_height: int | None = None,
+        bs: int = 1,
+    ) -> tuple[dict[str, Tensor], int, int]:
+        """
+        `seed` can be a list with one seed per sample, then the text and image conditioning
+        are encoded once and broadcast over the batch.
+        """
+        start = time.perf_counter()
+        self.timings = {}
+        if bs == 1 and not isinstance(prompt, str):
+            bs = len(prompt)
+        seeds = seed if isinstance(seed, (list, tuple)) else None
+        if seeds is not None:
+            bs = len(seeds)
+        prompts = [prompt] if isinstance(prompt, str) else prompt
+
+        # only reads the header, the pixels are decoded in the image job
+        width, height = kontext_cond_size(Image.open(img_cond_path))
+        image_job = self.executor.submit(self._encode_image, img_cond_path, width, height)
+
+        if self.prompt_cache is not None:
+            # the cache runs T5 and CLIP together for prompts it hasn't seen
+            text_job = self.executor.submit(self._run, "text", self.prompt_cache, prompts)
+        else:
+            t5_job = self.executor.submit(self._run, "t5", self.t5, prompts)
+            clip_job = self.executor.submit(self._run, "clip", self.clip, prompts)
+
+        if target_width is None:
+            target_width = 8 * width
+        if target_height is None:
+            target_height = 8 * height
+        t0 = time.perf_counter()
+        num_samples = len(seeds) if seeds is not None else 1
+        img = get_noise(num_samples, target_height, target_width, device=self.device, dtype=torch.bfloat16, seed=seed)
+        self.timings["noise"] = time.perf_counter() - t0
+
+        if self.prompt_cache is not None:
+            embeddings = text_job.result()
+        else:
+            embeddings = (t5_job.result(), clip_job.result())
+        img_cond, img_cond_ids = image_job.result()
+
+        inp = prepare(
+            self.t5,
+            self.clip,
+            img,
+            prompt,
+            position_cache=self.position_cache,
+            embeddings=embeddings,
+            txt_buckets=self.txt_buckets,
+        )
+        inp = finish_kontext(
+            inp,
+            img_cond,
+            img_cond_ids,
+            (img.shape[2] // 2, img.shape[3] // 2),
+            (height // 2, width // 2),
+            bs,
+            self.device,
+            self.position_cache,
+        )
+        self.timings["total"] = time.perf_counter() - start
+        return inp, target_height, target_width
+
+    def format_timings(self) -> str:
+        return ", ".join(f"{name} {seconds * 1000:.1f}ms" for name, seconds in self.timings.items())
@@ -0,0 +1,56 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from einops import rearrange
+from PIL import Image
+from torch import Tensor
+
+
+def open_reduced(img: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """
+    Decode `img` at the smallest resolution that is still at least `size` (width, height).
+
+    JPEGs are decoded at a reduced scale through `draft`, which has to be called before
+    the pixels are loaded and skips most of the IDCT work for large photos. Other
+    formats are decoded in full and then shrunk by an integer factor with `reduce`,
+    a cheap box filter. Either way the final resize to `size` is left to the caller.
+    """
+    width, height = size
+    if img.format == "JPEG":
+        # a no-op once the image is loaded
+        img.draft("RGB", (width, height))
+    img = img.convert("RGB")
+
+    factor = min(img.width // width, img.height // height)
+    if factor > 1:
+        img = img.reduce(factor)
+    return img
+
+
+def decode_image(img: Image.Image, size: tuple[int, int], pin_memory: bool = False) -> Tensor:
+    """uint8 (height, width, 3) pixels of `img`, reduced towards `size` by `open_reduced`."""
+    pixels = torch.from_numpy(np.array(open_reduced(img, size)))
+    if pin_memory:
+        pixels = pixels.pin_memory()
+    return pixels
+
+
+def to_model_input(pixels: Tensor, size: tuple[int, int], device: str | torch.device) -> Tensor:
+    """
+    Move uint8 `pixels` to `device` and resize and normalize them there, into a
+    (1, 3, height, width) float tensor in [-1, 1] of `size` (width, height).
+    """
+    pixels = pixels.to(device, non_blocking=True)
+    pixels = rearrange(pixels, "h w c -> 1 c h w").float()
+
+    width, height = size
+    if pixels.shape[2:] != (height, width):
+        pixels = F.interpolate(pixels, size=(height, width), mode="bicubic", antialias=True)
+    # bicubic overshoots, PIL clips to the uint8 range at this point
+    return (pixels / 127.5 - 1.0).clamp(-1.0, 1.0)
+
+
+def load_image(img: Image.Image, size: tuple[int, int], device: str | torch.device) -> Tensor:
+    """`img` as a (1, 3, height, width) float tensor in [-1, 1] of `size` (width, height) on `device`."""
+    device = torch.device(device)
+    return to_model_input(decode_image(img, size, pin_memory=device.type == "cuda"), size, device)
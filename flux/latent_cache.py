@@ -0,0 +1,132 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch import Tensor
+
+# part of every key, bump it when the encoding of conditioning images changes so that
+# entries written to disk by an older version are not used anymore
+LATENT_CACHE_VERSION = 1
+# how the image was decoded and resized, "lanczos" on the CPU or "fast" through flux.image_ingest
+INGEST_MODES = ("lanczos", "fast")
+
+
+def content_hash(path: str | Path, chunk_size: int = 1 << 20) -> str:
+    """Hash of the bytes of an image file, computed without decoding it."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class LatentCacheStats:
+    hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.hits} hits ({self.disk_hits} from disk), {self.misses} misses, {self.evictions} evictions"
+
+
+class ConditioningLatentCache:
+    """
+    Content-addressed cache of encoded Kontext conditioning images.
+
+    An entry holds the packed bf16 `img_cond` tokens and their position ids for one
+    source image at one latent size, so a repeated edit of the same image skips
+    decoding, resizing and the VAE encoder. Keys combine the hash of the image file
+    bytes with the target latent size, the ingest mode, whose resizing gives slightly
+    different latents, and `LATENT_CACHE_VERSION`. The image only has to be read, not
+    decoded, to look it up.
+
+    Entries live on the device in an LRU that evicts once their total size exceeds
+    `max_bytes`. With `disk_dir` every new entry is also written there as a
+    safetensors file, entries that are not in memory are loaded from it.
+    """
+
+    def __init__(self, device: str | torch.device, max_bytes: int = 1 << 30, disk_dir: str | Path | None = None):
+        self.device = torch.device(device)
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self.stats = LatentCacheStats()
+        self.num_bytes = 0
+        self._entries: OrderedDict[str, tuple[Tensor, Tensor]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(img_cond_path: str | Path, height: int, width: int, ingest: str = "lanczos") -> str:
+        """Key for the image at `img_cond_path` encoded to a `height` x `width` latent through `ingest`."""
+        if ingest not in INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode {ingest}, choose one of {INGEST_MODES}")
+        return f"v{LATENT_CACHE_VERSION}_{content_hash(img_cond_path)}_{height}x{width}_{ingest}"
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.safetensors"
+
+    @staticmethod
+    def _entry_bytes(entry: tuple[Tensor, Tensor]) -> int:
+        return sum(t.numel() * t.element_size() for t in entry)
+
+    def _insert(self, key: str, entry: tuple[Tensor, Tensor]) -> None:
+        self._entries[key] = entry
+        self.num_bytes += self._entry_bytes(entry)
+        while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= self._entry_bytes(evicted)
+            self.stats.evictions += 1
+
+    def get(self, key: str) -> tuple[Tensor, Tensor] | None:
+        """`(img_cond, img_cond_ids)` on the cache device, or None on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats.hits += 1
+                return self._entries[key]
+
+            if self.disk_dir is not None and self._disk_path(key).exists():
+                with safe_open(self._disk_path(key), framework="pt", device="cpu") as f:
+                    entry = (
+                        f.get_tensor("img_cond").to(self.device),
+                        f.get_tensor("img_cond_ids").to(self.device),
+                    )
+                self._insert(key, entry)
+                self.stats.hits += 1
+                self.stats.disk_hits += 1
+                return entry
+
+            self.stats.misses += 1
+            return None
+
+    def put(self, key: str, img_cond: Tensor, img_cond_ids: Tensor) -> None:
+        entry = (img_cond.to(self.device), img_cond_ids.to(self.device))
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entry_bytes(self._entries.pop(key))
+            self._insert(key, entry)
+
+        if self.disk_dir is not None and not self._disk_path(key).exists():
+            path = self._disk_path(key)
+            # write under a temporary name so readers never see a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            save_file({"img_cond": entry[0].contiguous().cpu(), "img_cond_ids": entry[1].contiguous().cpu()}, tmp_path)
+            os.replace(tmp_path, path)
+
+    def clear(self, disk: bool = False) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+            if disk and self.disk_dir is not None:
+                for path in self.disk_dir.glob("*.safetensors"):
+                    path.unlink()
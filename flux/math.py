@@ -1,19 +1,168 @@
+import os
+from dataclasses import dataclass
+from typing import Callable
+
 import torch
 from einops import rearrange
 from torch import Tensor
 
 from torch.nn.attention import SDPBackend, sdpa_kernel
 
+try:
+    from flash_attn import flash_attn_func
+except ImportError:
+    flash_attn_func = None
+
+try:
+    from sageattention import sageattn
+except ImportError:
+    sageattn = None
+
+
+@dataclass
+class AttentionBackend:
+    """
+    An attention kernel. `fn(q, k, v, mask)` takes (B, H, L, D) tensors and an optional
+    boolean (B, 1, 1, L) key mask and returns (B, H, L, D). `devices` are the device
+    types it can run on; whether it supports a dtype or a mask on this particular
+    device is found out by the probe in `select_attention_backend`.
+    """
+
+    name: str
+    fn: Callable[[Tensor, Tensor, Tensor, Tensor | None], Tensor]
+    devices: tuple[str, ...] = ("cuda",)
+
+
+def _sdpa(*backends: SDPBackend) -> Callable[[Tensor, Tensor, Tensor, Tensor | None], Tensor]:
+    def fn(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None) -> Tensor:
+        with sdpa_kernel(backends=list(backends)):
+            return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+    return fn
+
+
+def _default_sdpa(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None) -> Tensor:
+    # whatever kernel PyTorch dispatches to, on CPU that is its flash attention kernel
+    return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+
+def chunked_attention(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None, chunk_size: int = 1024) -> Tensor:
+    """Exact attention over `chunk_size` queries at a time, the score matrix never exceeds chunk_size x L."""
+    out = torch.empty_like(q)
+    scale = q.shape[-1] ** -0.5
+    for start in range(0, q.shape[2], chunk_size):
+        scores = torch.matmul(q[:, :, start : start + chunk_size], k.transpose(-2, -1)).float() * scale
+        if mask is not None:
+            scores = scores.masked_fill(~mask, float("-inf"))
+        out[:, :, start : start + chunk_size] = torch.matmul(scores.softmax(dim=-1).to(v.dtype), v)
+    return out
+
+
+def _flash_attn(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None) -> Tensor:
+    if mask is not None:
+        raise ValueError("flash_attn doesn't take an attention mask")
+    # flash_attn wants (B, L, H, D)
+    x = flash_attn_func(q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2))
+    return x.transpose(1, 2)
+
+
+def _sage(q: Tensor, k: Tensor, v: Tensor, mask: Tensor | None) -> Tensor:
+    if mask is not None:
+        raise ValueError("SageAttention doesn't take an attention mask")
+    return sageattn(q, k, v, tensor_layout="HND", is_causal=False)
+
+
+ATTENTION_BACKENDS: dict[str, AttentionBackend] = {}
+# backend chosen per (device type, dtype, masked)
+_selected: dict[tuple[str, torch.dtype, bool], AttentionBackend] = {}
+
 
-def attention(q: Tensor, k: Tensor, v: Tensor, pe: Tensor) -> Tensor:
-    q, k = apply_rope(q, k, pe)
+def register_attention_backend(backend: AttentionBackend) -> None:
+    ATTENTION_BACKENDS[backend.name] = backend
+    _selected.clear()
+
+
+register_attention_backend(AttentionBackend("cudnn", _sdpa(SDPBackend.CUDNN_ATTENTION)))
+register_attention_backend(AttentionBackend("flash", _sdpa(SDPBackend.FLASH_ATTENTION)))
+register_attention_backend(AttentionBackend("efficient", _sdpa(SDPBackend.EFFICIENT_ATTENTION)))
+register_attention_backend(AttentionBackend("sdpa", _default_sdpa, devices=("cuda", "cpu")))
+register_attention_backend(AttentionBackend("chunked", chunked_attention, devices=("cuda", "cpu")))
+register_attention_backend(AttentionBackend("math", _sdpa(SDPBackend.MATH), devices=("cuda", "cpu")))
+if flash_attn_func is not None:
+    register_attention_backend(AttentionBackend("flash_attn", _flash_attn))
+if sageattn is not None:
+    register_attention_backend(AttentionBackend("sage", _sage))
+
+# the first backend in this order that passes the probe is used, cuDNN is the fastest
+# on Hopper. Masked attention (bucketed text) falls through to a kernel that takes masks
+DEFAULT_ATTENTION_BACKENDS = ("cudnn", "flash", "efficient", "sdpa", "chunked", "math")
+# comma separated backends to try before the defaults, e.g. "sage" or "flash_attn,efficient"
+attention_backends = [name for name in os.environ.get("FLUX_ATTENTION_BACKEND", "").split(",") if name]
+
+
+def set_attention_backends(names: str | list[str]) -> None:
+    """Try `names`, in order, before the default backends."""
+    global attention_backends
+    attention_backends = [names] if isinstance(names, str) else list(names)
+    _selected.clear()
+
+
+def probe_attention_backend(backend: AttentionBackend, device: torch.device, dtype: torch.dtype, masked: bool) -> bool:
+    """Whether `backend` runs and matches the math kernel on a small input."""
+    generator = torch.Generator(device="cpu").manual_seed(0)
+    q, k, v = (torch.randn(1, 2, 256, 128, generator=generator).to(device, dtype) for _ in range(3))
+    mask = None
+    if masked:
+        mask = torch.ones(1, 1, 1, 256, dtype=torch.bool, device=device)
+        mask[..., 200:] = False
+    try:
+        out = backend.fn(q, k, v, mask)
+        reference = _sdpa(SDPBackend.MATH)(q.float(), k.float(), v.float(), mask)
+        return out.shape == reference.shape and torch.allclose(out.float(), reference, atol=3e-2, rtol=3e-2)
+    except Exception as e:
+        print(f"Attention backend {backend.name} is not usable for {dtype} on {device.type}: {e}")
+        return False
+
+
+@torch.compiler.disable
+def select_attention_backend(device: torch.device, dtype: torch.dtype, masked: bool = False) -> AttentionBackend:
+    """
+    First backend, configured ones before the defaults, that is available on `device` and
+    passes the probe. The choice is remembered per device type, dtype and masking.
+    """
+    key = (device.type, dtype, masked)
+    if key not in _selected:
+        for name in dict.fromkeys([*attention_backends, *DEFAULT_ATTENTION_BACKENDS]):
+            backend = ATTENTION_BACKENDS.get(name)
+            if backend is None:
+                print(f"Unknown attention backend {name}, choose one of {list(ATTENTION_BACKENDS)}")
+                continue
+            if device.type in backend.devices and probe_attention_backend(backend, device, dtype, masked):
+                _selected[key] = backend
+                break
+        else:
+            raise RuntimeError(f"No attention backend works for {dtype} on {device.type}")
+    return _selected[key]
+
+
+def attention(q: Tensor, k: Tensor, v: Tensor, pe: "Tensor | RopeTable", mask: Tensor | None = None) -> Tensor:
+    """
+    `pe` is the output of `EmbedND` or a `RopeTable` of it. `mask` is a boolean
+    (B, 1, 1, L) key mask, keys where it is False are not attended to.
+    """
+    if isinstance(pe, RopeTable):
+        q, k = apply_rope_table(q, k, pe)
+    else:
+        q, k = apply_rope(q, k, pe)
 
     q = q.contiguous()
     k = k.contiguous()
     v = v.contiguous()
 
-    with sdpa_kernel(backends=[SDPBackend.CUDNN_ATTENTION]):
-        x = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+    backend = _selected.get((q.device.type, q.dtype, mask is not None))
+    if backend is None:
+        backend = select_attention_backend(q.device, q.dtype, mask is not None)
+    x = backend.fn(q, k, v, mask)
     x = rearrange(x, "B H L D -> B L (H D)")
 
     return x
@@ -35,3 +184,53 @@ def apply_rope(xq: Tensor, xk: Tensor, freqs_cis: Tensor) -> tuple[Tensor, Tenso
     xq_out = freqs_cis[..., 0] * xq_[..., 0] + freqs_cis[..., 1] * xq_[..., 1]
     xk_out = freqs_cis[..., 0] * xk_[..., 0] + freqs_cis[..., 1] * xk_[..., 1]
     return xq_out.reshape(*xq.shape).type_as(xq), xk_out.reshape(*xk.shape).type_as(xk)
+
+
+@dataclass
+class RopeTable:
+    """
+    The RoPE rotations of `EmbedND` as cos and sin tables of shape (1, 1, L, D / 2) in
+    the compute dtype, for `apply_rope_table`. The first `identity_prefix` positions,
+    e.g. the text tokens whose ids are all zero, have no rotation and are not part of
+    the tables.
+    """
+
+    cos: Tensor
+    sin: Tensor
+    identity_prefix: int = 0
+
+    @classmethod
+    def from_pe(cls, pe: Tensor, dtype: torch.dtype = torch.bfloat16, identity_prefix: int = 0) -> "RopeTable":
+        """Table of an `EmbedND` output `pe` that covers the positions after the identity prefix."""
+        # pe holds the rotation matrices [[cos, -sin], [sin, cos]]
+        return cls(
+            cos=pe[..., 0, 0].to(dtype).contiguous(),
+            sin=pe[..., 1, 0].to(dtype).contiguous(),
+            identity_prefix=identity_prefix,
+        )
+
+
+def _rotate(x: Tensor, cos: Tensor, sin: Tensor) -> Tensor:
+    # a single elementwise kernel under torch.compile: bf16 loads, float32 math, bf16 stores
+    x = x.unflatten(-1, (-1, 2))
+    x0, x1 = x[..., 0].float(), x[..., 1].float()
+    cos, sin = cos.float(), sin.float()
+    return torch.stack((x0 * cos - x1 * sin, x0 * sin + x1 * cos), dim=-1).flatten(-2)
+
+
+def apply_rope_table(xq: Tensor, xk: Tensor, table: RopeTable) -> tuple[Tensor, Tensor]:
+    """
+    `apply_rope` with a precomputed `RopeTable`. The outputs are contiguous, positions
+    in the identity prefix are copied through unrotated.
+    """
+    n = table.identity_prefix
+    out = []
+    for x in (xq, xk):
+        if n == 0:
+            out.append(_rotate(x, table.cos, table.sin).to(x.dtype))
+            continue
+        x_out = torch.empty(x.shape, dtype=x.dtype, device=x.device)
+        x_out[:, :, :n] = x[:, :, :n]
+        x_out[:, :, n:] = _rotate(x[:, :, n:], table.cos, table.sin)
+        out.append(x_out)
+    return out[0], out[1]
@@ -3,6 +3,7 @@ from dataclasses import dataclass
 import torch
 from torch import Tensor, nn
 
+from flux.math import RopeTable
 from flux.modules.layers import (
     DoubleStreamBlock,
     EmbedND,
@@ -12,6 +13,7 @@ from flux.modules.layers import (
     timestep_embedding,
 )
 from flux.modules.lora import LinearLora, replace_linear_with_lora
+from flux.taylor_seer_utils import BlockFeatureCache
 
 
 @dataclass
@@ -31,6 +33,87 @@ class FluxParams:
     guidance_embed: bool
 
 
+@dataclass
+class StaticContext:
+    """
+    Step-invariant inputs of `Flux.step`: the projected text tokens, the conditioning
+    vector without the timestep embedding, the RoPE table of the positions and, for
+    bucketed text, the (B, 1, 1, L) key mask of the joint sequence.
+    """
+
+    txt: Tensor
+    vec: Tensor
+    pe: RopeTable
+    attn_mask: Tensor | None = None
+
+    @classmethod
+    def cat(cls, contexts: list["StaticContext"]) -> "StaticContext":
+        """
+        Stack per-request contexts along the batch dimension. Their joint sequences must
+        have the same length, RoPE tables with different identity prefixes are brought to
+        the shortest one by adding the identity rotation rows.
+        """
+        pe = contexts[0].pe
+        if any(context.pe is not pe for context in contexts[1:]):
+            tables = [context.pe for context in contexts]
+            lengths = {table.identity_prefix + table.cos.shape[2] for table in tables}
+            if len(lengths) != 1:
+                raise ValueError(f"Can't batch contexts with joint sequence lengths {sorted(lengths)}")
+            prefix = min(table.identity_prefix for table in tables)
+            cos, sin = [], []
+            for table in tables:
+                extra = table.identity_prefix - prefix
+                if extra:
+                    shape = (*table.cos.shape[:2], extra, table.cos.shape[3])
+                    cos.append(torch.cat((table.cos.new_ones(shape), table.cos), dim=2))
+                    sin.append(torch.cat((table.sin.new_zeros(shape), table.sin), dim=2))
+                else:
+                    cos.append(table.cos)
+                    sin.append(table.sin)
+            pe = RopeTable(cos=torch.cat(cos), sin=torch.cat(sin), identity_prefix=prefix)
+        attn_mask = None
+        masks = [context.attn_mask for context in contexts if context.attn_mask is not None]
+        if masks:
+            # unmasked contexts attend to every token
+            unmasked = masks[0].new_ones((1, *masks[0].shape[1:]))
+            attn_mask = torch.cat(
+                [
+                    (unmasked if context.attn_mask is None else context.attn_mask).expand(context.txt.shape[0], -1, -1, -1)
+                    for context in contexts
+                ]
+            )
+        return cls(
+            txt=torch.cat([context.txt for context in contexts]),
+            vec=torch.cat([context.vec for context in contexts]),
+            pe=pe,
+            attn_mask=attn_mask,
+        )
+
+
+@dataclass
+class StepModulation:
+    """
+    Precomputed outputs of every modulation linear for one denoising step:
+    `(img_mod, txt_mod)` per double block, one per single block and the final layer.
+    """
+
+    double: list[tuple[Tensor, Tensor]]
+    single: list[Tensor]
+    final: Tensor
+
+    @classmethod
+    def cat(cls, mods: list["StepModulation"]) -> "StepModulation":
+        """Stack per-request modulations along the batch dimension."""
+        return cls(
+            double=[
+                (torch.cat([mod.double[i][0] for mod in mods]), torch.cat([mod.double[i][1] for mod in mods]))
+                for i in range(len(mods[0].double))
+            ],
+            single=[torch.cat([mod.single[i] for mod in mods]) for i in range(len(mods[0].single))],
+            final=torch.cat([mod.final for mod in mods]),
+        )
+
+
 class Flux(nn.Module):
     """
     Transformer model for flow matching on sequences.
@@ -81,43 +164,174 @@ class Flux(nn.Module):
 
         self.final_layer = LastLayer(self.hidden_size, 1, self.out_channels)
 
-    def forward(
+    def set_concat_free(self, enabled: bool = True) -> None:
+        """
+        Let the double blocks build the joint q, k and v in preallocated buffers and the
+        single blocks run `linear2` as two accumulating GEMMs, instead of concatenating
+        their inputs. See `benchmark_concat_free.py` for the numerical difference.
+        """
+        for block in [*self.double_blocks, *self.single_blocks]:
+            block.concat_free = enabled
+
+    def prepare_static(
         self,
-        img: Tensor,
         img_ids: Tensor,
         txt: Tensor,
         txt_ids: Tensor,
-        timesteps: Tensor,
         y: Tensor,
         guidance: Tensor | None = None,
-    ) -> Tensor:
-        if img.ndim != 3 or txt.ndim != 3:
-            raise ValueError("Input img and txt tensors must have 3 dimensions.")
+        pe: Tensor | RopeTable | None = None,
+        txt_mask: Tensor | None = None,
+    ) -> StaticContext:
+        """
+        Compute everything in the forward pass that does not depend on the timestep.
+        A precomputed `pe` for the `(txt_ids, img_ids)` positions skips the RoPE embedding,
+        a `RopeTable` of it also skips building the table.
+        `txt_mask` is True for the text tokens that are attended to, image tokens always are.
+        """
+        if txt.ndim != 3:
+            raise ValueError("Input txt tensor must have 3 dimensions.")
 
-        # running on sequences img
-        img = self.img_in(img)
-        vec = self.time_in(timestep_embedding(timesteps, 256))
+        vec = self.vector_in(y)
         if self.params.guidance_embed:
             if guidance is None:
                 raise ValueError("Didn't get guidance strength for guidance distilled model.")
             vec = vec + self.guidance_in(timestep_embedding(guidance, 256))
-        vec = vec + self.vector_in(y)
         txt = self.txt_in(txt)
 
-        ids = torch.cat((txt_ids, img_ids), dim=1)
-        pe = self.pe_embedder(ids)
+        if pe is None:
+            ids = torch.cat((txt_ids, img_ids), dim=1)
+            pe = self.pe_embedder(ids)
+        if not isinstance(pe, RopeTable):
+            # arbitrary txt_ids, so nothing is known to be an identity rotation
+            pe = RopeTable.from_pe(pe, dtype=txt.dtype)
+
+        attn_mask = None
+        if txt_mask is not None:
+            img_mask = txt_mask.new_ones((txt_mask.shape[0], img_ids.shape[1]))
+            attn_mask = torch.cat((txt_mask, img_mask), dim=1)[:, None, None, :]
+        return StaticContext(txt=txt, vec=vec, pe=pe, attn_mask=attn_mask)
+
+    def precompute_modulations(self, timesteps: Tensor, static: StaticContext) -> list[StepModulation]:
+        """
+        Run every modulation linear for all `timesteps` at once.
+
+        The modulation parameters only depend on the timestep and the static conditioning
+        vector, so instead of one small GEMV per layer and step this does one
+        `(steps * batch, hidden)` GEMM per layer and returns a `StepModulation` per timestep.
+        """
+        num_steps = timesteps.shape[0]
+        bs = static.vec.shape[0]
+        # step-major rows: all batch entries for timesteps[0], then timesteps[1], ...
+        vec = self.time_in(timestep_embedding(timesteps.repeat_interleave(bs), 256))
+        vec = vec + static.vec.repeat(num_steps, 1)
+        silu_vec = nn.functional.silu(vec)
+
+        double = [(block.img_mod.lin(silu_vec), block.txt_mod.lin(silu_vec)) for block in self.double_blocks]
+        single = [block.modulation.lin(silu_vec) for block in self.single_blocks]
+        final = self.final_layer.adaLN_modulation(vec)
+
+        mods = []
+        for i in range(num_steps):
+            rows = slice(i * bs, (i + 1) * bs)
+            mods.append(
+                StepModulation(
+                    double=[(img_mod[rows], txt_mod[rows]) for img_mod, txt_mod in double],
+                    single=[mod[rows] for mod in single],
+                    final=final[rows],
+                )
+            )
+        return mods
+
+    def step_signal(
+        self,
+        img: Tensor,
+        timesteps: Tensor,
+        static: StaticContext,
+        mod: StepModulation | None = None,
+    ) -> Tensor:
+        """
+        Cheap proxy for how much the output of `step` changes between steps: the
+        modulated input of the first double block, i.e. only the first few ops of `step`.
+        """
+        block = self.double_blocks[0]
+        if mod is None:
+            vec = self.time_in(timestep_embedding(timesteps, 256)) + static.vec
+            img_mod1, _ = block.img_mod(vec)
+        else:
+            img_mod1, _ = block.img_mod.split(mod.double[0][0])
+        img = block.img_norm1(self.img_in(img))
+        return (1 + img_mod1.scale) * img + img_mod1.shift
+
+    def step(
+        self,
+        img: Tensor,
+        timesteps: Tensor,
+        static: StaticContext,
+        mod: StepModulation | None = None,
+        feature_cache: BlockFeatureCache | None = None,
+    ) -> Tensor:
+        """
+        Run the time embedding and the transformer blocks for a single denoising step.
+        With a precomputed `mod` for this step, the time embedding and all modulation
+        linears are skipped. With a `feature_cache`, blocks record or forecast their
+        attention and MLP outputs.
+        """
+        if img.ndim != 3:
+            raise ValueError("Input img tensor must have 3 dimensions.")
 
-        for block in self.double_blocks:
-            img, txt = block(img=img, txt=txt, vec=vec, pe=pe)
+        # running on sequences img
+        img = self.img_in(img)
+        if mod is None:
+            vec = self.time_in(timestep_embedding(timesteps, 256)) + static.vec
+            double_mods = [None] * len(self.double_blocks)
+            single_mods = [None] * len(self.single_blocks)
+            final_mod = None
+        else:
+            vec = None
+            double_mods, single_mods, final_mod = mod.double, mod.single, mod.final
+        txt = static.txt
+        pe = static.pe
+        attn_mask = static.attn_mask
+
+        for i, (block, block_mod) in enumerate(zip(self.double_blocks, double_mods)):
+            img, txt = block(
+                img=img,
+                txt=txt,
+                vec=vec,
+                pe=pe,
+                mod=block_mod,
+                feature_cache=feature_cache,
+                block_index=i,
+                attn_mask=attn_mask,
+            )
 
         img = torch.cat((txt, img), 1)
-        for block in self.single_blocks:
-            img = block(img, vec=vec, pe=pe)
+        for i, (block, block_mod) in enumerate(zip(self.single_blocks, single_mods), start=len(self.double_blocks)):
+            img = block(
+                img, vec=vec, pe=pe, mod=block_mod, feature_cache=feature_cache, block_index=i, attn_mask=attn_mask
+            )
         img = img[:, txt.shape[1] :, ...]
 
-        img = self.final_layer(img, vec)  # (N, T, patch_size ** 2 * out_channels)
+        img = self.final_layer(img, vec, mod=final_mod)  # (N, T, patch_size ** 2 * out_channels)
         return img
 
+    def forward(
+        self,
+        img: Tensor,
+        img_ids: Tensor,
+        txt: Tensor,
+        txt_ids: Tensor,
+        timesteps: Tensor,
+        y: Tensor,
+        guidance: Tensor | None = None,
+    ) -> Tensor:
+        if img.ndim != 3 or txt.ndim != 3:
+            raise ValueError("Input img and txt tensors must have 3 dimensions.")
+
+        static = self.prepare_static(img_ids=img_ids, txt=txt, txt_ids=txt_ids, y=y, guidance=guidance)
+        return self.step(img=img, timesteps=timesteps, static=static)
+
 
 class FluxLoraWrapper(Flux):
     def __init__(
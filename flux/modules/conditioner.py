@@ -1,6 +1,14 @@
 from torch import Tensor, nn
 from transformers import CLIPTextModel, CLIPTokenizer, T5EncoderModel, T5Tokenizer
 
+# text lengths the T5 sequence can be trimmed to, see `flux.sampling.bucket_txt`
+T5_LENGTH_BUCKETS = (64, 128, 256, 512)
+
+
+def bucket_length(length: int, buckets: tuple[int, ...] = T5_LENGTH_BUCKETS) -> int:
+    """Smallest bucket that fits `length` tokens, the largest bucket if none does."""
+    return min((bucket for bucket in buckets if bucket >= length), default=max(buckets))
+
 
 class HFEmbedder(nn.Module):
     def __init__(self, version: str, max_length: int, is_clip: bool = False, **hf_kwargs):
@@ -18,6 +26,17 @@ class HFEmbedder(nn.Module):
 
         self.hf_module = self.hf_module.eval().requires_grad_(False)
 
+    def token_lengths(self, text: list[str]) -> list[int]:
+        """Number of tokens of every prompt, including the end of sequence token, without padding."""
+        batch_encoding = self.tokenizer(
+            text,
+            truncation=True,
+            max_length=self.max_length,
+            padding=False,
+            return_attention_mask=False,
+        )
+        return [len(input_ids) for input_ids in batch_encoding["input_ids"]]
+
     def forward(self, text: list[str]) -> Tensor:
         batch_encoding = self.tokenizer(
             text,
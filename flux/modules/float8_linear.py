@@ -6,6 +6,8 @@ import math
 from torch.compiler import is_compiling
 from torch import __version__
 from torch.version import cuda
+from safetensors import safe_open
+from safetensors.torch import save_file
 
 
 IS_TORCH_2_4 = __version__ < (2, 4, 9)
@@ -16,7 +18,7 @@ if LT_TORCH_2_4:
             "This version of PyTorch is not supported. Please upgrade to PyTorch 2.4 with CUDA 12.4 or later."
         )
 CUDA_VERSION = float(cuda) if cuda else 0
-if CUDA_VERSION < 12.4:
+if cuda and CUDA_VERSION < 12.4:
     raise RuntimeError(
         f"This version of PyTorch is not supported. Please upgrade to PyTorch 2.4 with CUDA 12.4 or later got torch version {__version__} and CUDA version {cuda}."
     )
@@ -72,6 +74,8 @@ class F8Linear(nn.Module):
             num_scale_trials, requires_grad=False, device=device, dtype=torch.float32
         )
         self.trial_index = 0
+        # record the input amax of every call into input_amax_trials, see InputScaleCalibration
+        self.calibrating = False
         self.register_buffer("scale", None)
         self.register_buffer(
             "input_scale",
@@ -96,33 +100,46 @@ class F8Linear(nn.Module):
         unexpected_keys,
         error_msgs,
     ):
-        sd = {k.replace(prefix, ""): v for k, v in state_dict.items()}
-        assert "weight" in sd, "Weight tensor not found in state dict"
-        if "weight" in sd:
-            if (
-                "float8_data" not in sd
-                or sd["float8_data"] is None
-                and sd["weight"].shape == (self.out_features, self.in_features)
-            ):
-                # Initialize as if it's an F8Linear that needs to be quantized
-                self._parameters["weight"] = nn.Parameter(
-                    sd["weight"], requires_grad=False
-                )
-                if "bias" in sd:
-                    self._parameters["bias"] = nn.Parameter(
-                        sd["bias"], requires_grad=False
-                    )
-                self.quantize_weight()
-
-            else:
+        sd = {k[len(prefix) :]: v for k, v in state_dict.items() if k.startswith(prefix)}
+        if sd.get("float8_data") is not None:
+            # pre-quantized checkpoint, see flux.util.save_fp8_checkpoint
+            for key in ("scale", "scale_reciprocal"):
+                if sd.get(key) is None:
+                    raise RuntimeError(f"Pre-quantized F8Linear state dict without {key}: {list(sd.keys())}")
+            if sd["float8_data"].shape != (self.out_features, self.in_features):
                 raise RuntimeError(
-                    f"Weight tensor not found or has incorrect shape in state dict: {sd.keys()}"
+                    f"float8_data has shape {tuple(sd['float8_data'].shape)}, "
+                    f"expected {(self.out_features, self.in_features)}"
+                )
+            # only the dtype of the weight is used, it sets the output dtype
+            weight_dtype = sd["weight"].dtype if "weight" in sd else self.weight.dtype
+            self._parameters["weight"] = nn.Parameter(
+                torch.zeros(1, dtype=weight_dtype, device=sd["float8_data"].device), requires_grad=False
+            )
+            if "bias" in sd:
+                self._parameters["bias"] = nn.Parameter(sd["bias"], requires_grad=False)
+            self.float8_data = sd["float8_data"].to(self.float8_dtype)
+            self.scale = sd["scale"].float()
+            self.scale_reciprocal = sd["scale_reciprocal"].float()
+            self.weight_initialized = True
+        elif "weight" in sd and sd["weight"].shape == (self.out_features, self.in_features):
+            # Initialize as if it's an F8Linear that needs to be quantized
+            self._parameters["weight"] = nn.Parameter(
+                sd["weight"], requires_grad=False
+            )
+            if "bias" in sd:
+                self._parameters["bias"] = nn.Parameter(
+                    sd["bias"], requires_grad=False
                 )
+            self.quantize_weight()
         else:
             raise RuntimeError(
-                "Weight tensor not found or has incorrect shape in state dict"
+                f"Weight tensor not found or has incorrect shape in state dict: {list(sd.keys())}"
             )
 
+        if sd.get("input_scale") is not None:
+            self.set_input_scale(sd["input_scale"])
+
     def quantize_weight(self):
         if self.weight_initialized:
             return
@@ -156,9 +173,43 @@ class F8Linear(nn.Module):
         )
         return x_fp8, scale
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def set_input_scale(self, scale: torch.Tensor):
+        """Use a fixed input scale instead of computing one from every input."""
+        self.input_scale = scale.float().reshape(()).to(self.weight.device)
+        self.input_scale_reciprocal = self.input_scale.reciprocal()
+        self.input_scale_initialized = True
+
+    def clear_input_scale(self):
+        """Back to dynamic input scales."""
+        self.input_scale = None
+        self.input_scale_reciprocal = None
+        self.input_scale_initialized = False
+
+    def observe_input(self, x: torch.Tensor):
+        amax = torch.max(torch.abs(x)).float()
+        self.input_amax_trials[self.trial_index] = torch.maximum(self.input_amax_trials[self.trial_index], amax)
+
+    def quantize_input(self, x: torch.Tensor, static_input_scale: bool | None = None):
+        """
+        FP8 input and the reciprocal of its scale. With a static input scale, the default
+        once one is set and not calibrating, this skips the amax reduction.
+        """
+        if self.calibrating:
+            self.observe_input(x)
+        if static_input_scale is None:
+            static_input_scale = self.input_scale_initialized and not self.calibrating
+        if static_input_scale:
+            x = self.to_fp8_saturated(x, self.input_scale, self.input_max_value).to(self.input_float8_dtype)
+            return x, self.input_scale_reciprocal
         x, x_scale = self.dynamic_quantize_input(x)
-        x_scale_reciprocal = x_scale.reciprocal()
+        return x, x_scale.reciprocal()
+
+    def forward(self, x: torch.Tensor, static_input_scale: bool | None = None) -> torch.Tensor:
+        if not self.weight_initialized:
+            # freshly constructed (e.g. a small test model), nothing has been quantized yet
+            return nn.functional.linear(x, self.weight, self.bias)
+
+        x, x_scale_reciprocal = self.quantize_input(x, static_input_scale)
 
         prev_dims = x.shape[:-1]
         x = x.view(-1, self.in_features)
@@ -174,4 +225,110 @@ class F8Linear(nn.Module):
         )
 
         out = out.view(*prev_dims, self.out_features)
-        return out
\ No newline at end of file
+        return out
+
+    def forward_split(self, xs: list[torch.Tensor]) -> torch.Tensor:
+        """
+        `forward(torch.cat(xs, dim=-1))` without the concatenation: one scaled GEMM per
+        input over the matching columns of the weight, summed into the first output.
+        Every input gets its own dynamic scale, or they share the static input scale.
+        """
+        if not self.weight_initialized:
+            return self.forward(torch.cat(xs, dim=-1))
+
+        out = None
+        start = 0
+        prev_dims = xs[0].shape[:-1]
+        for x in xs:
+            width = x.shape[-1]
+            x, x_scale_reciprocal = self.quantize_input(x)
+            part = torch._scaled_mm(
+                x.reshape(-1, width),
+                # a column-major view with the full row stride, no copy
+                self.float8_data[:, start : start + width].T,
+                scale_a=x_scale_reciprocal,
+                scale_b=self.scale_reciprocal,
+                bias=self.bias if out is None else None,
+                out_dtype=self.weight.dtype,
+                use_fast_accum=True,
+            )
+            out = part if out is None else out.add_(part)
+            start += width
+        return out.view(*prev_dims, self.out_features)
+
+
+def f8_linears(model: nn.Module) -> dict[str, F8Linear]:
+    return {name: module for name, module in model.named_modules() if isinstance(module, F8Linear)}
+
+
+class InputScaleCalibration:
+    """
+    Records the input amax of every quantized F8Linear in `model` while active. Call
+    `next_trial` between calibration runs, e.g. per resolution; each trial keeps its own
+    amax in `input_amax_trials`, after `num_scale_trials` they wrap around and merge by
+    max. `freeze` sets every layer's static input scale from the largest amax seen,
+    times `margin`. Layers that saw no input keep dynamic scaling.
+
+        with InputScaleCalibration(model) as calibration:
+            for run in runs:
+                run()
+                calibration.next_trial()
+        calibration.freeze()
+    """
+
+    def __init__(self, model: nn.Module):
+        self.layers = {name: layer for name, layer in f8_linears(model).items() if layer.weight_initialized}
+
+    def __enter__(self) -> "InputScaleCalibration":
+        for layer in self.layers.values():
+            layer.input_amax_trials = torch.zeros_like(layer.input_amax_trials, device=layer.weight.device)
+            layer.trial_index = 0
+            layer.calibrating = True
+        return self
+
+    def __exit__(self, *exc):
+        for layer in self.layers.values():
+            layer.calibrating = False
+
+    def next_trial(self):
+        for layer in self.layers.values():
+            layer.trial_index = (layer.trial_index + 1) % layer.num_scale_trials
+
+    def freeze(self, margin: float = 1.0) -> list[str]:
+        """Set the static input scales, returns the names of the layers left on dynamic scaling."""
+        uncalibrated = []
+        for name, layer in self.layers.items():
+            amax = layer.input_amax_trials.max()
+            if amax.item() == 0:
+                # never called, or only on zeros: amax_to_scale(0) is the largest scale and
+                # every real input would saturate
+                uncalibrated.append(name)
+                continue
+            layer.set_input_scale(layer.amax_to_scale(amax * margin, layer.input_max_value))
+        if uncalibrated:
+            logger.warning(
+                f"No input recorded for {len(uncalibrated)} layers, they keep dynamic scaling: {uncalibrated}"
+            )
+        return uncalibrated
+
+
+def save_input_scales(model: nn.Module, path: str, metadata: dict[str, str] | None = None):
+    """Write the static input scales of `model` to a safetensors file."""
+    scales = {
+        f"{name}.input_scale": layer.input_scale.reshape(1).cpu()
+        for name, layer in f8_linears(model).items()
+        if layer.input_scale_initialized
+    }
+    save_file(scales, path, metadata=metadata)
+
+
+def load_input_scales(model: nn.Module, path: str) -> int:
+    """Set the static input scales saved by `save_input_scales`, returns how many layers got one."""
+    loaded = 0
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = set(f.keys())
+        for name, layer in f8_linears(model).items():
+            if f"{name}.input_scale" in keys:
+                layer.set_input_scale(f.get_tensor(f"{name}.input_scale"))
+                loaded += 1
+    return loaded
@@ -6,6 +6,7 @@ from einops import rearrange
 from torch import Tensor, nn
 
 from flux.math import attention, rope
+from flux.taylor_seer_utils import BlockFeatureCache
 
 from .float8_linear import F8Linear
 
@@ -66,11 +67,11 @@ class RMSNorm(torch.nn.Module):
         super().__init__()
         self.scale = nn.Parameter(torch.ones(dim))
 
-    def forward(self, x: Tensor):
+    def forward(self, x: Tensor, out: Tensor | None = None):
         x_dtype = x.dtype
         x = x.float()
         rrms = torch.rsqrt(torch.mean(x**2, dim=-1, keepdim=True) + 1e-6)
-        return (x * rrms).to(dtype=x_dtype) * self.scale
+        return torch.mul((x * rrms).to(dtype=x_dtype), self.scale, out=out)
 
 
 class QKNorm(torch.nn.Module):
@@ -85,6 +86,27 @@ class QKNorm(torch.nn.Module):
         return q.to(v), k.to(v)
 
 
+def split_linear(layer: nn.Module, xs: list[Tensor]) -> Tensor:
+    """
+    `layer(torch.cat(xs, dim=-1))` as one GEMM per input over the matching columns of the
+    weight, accumulated into the output, so the concatenated input is never materialized.
+    """
+    if isinstance(layer, F8Linear):
+        return layer.forward_split(xs)
+    # torchao swaps the weight of quantized linears for a tensor subclass
+    if type(layer) is not nn.Linear or type(layer.weight) is not nn.Parameter:
+        return layer(torch.cat(xs, dim=-1))
+
+    weights = layer.weight.split([x.shape[-1] for x in xs], dim=1)
+    out = nn.functional.linear(xs[0], weights[0], layer.bias)
+    prev_dims = out.shape[:-1]
+    out = out.view(-1, layer.out_features)
+    for x, weight in zip(xs[1:], weights[1:]):
+        # the GEMM adds to out in place (beta = 1)
+        out.addmm_(x.reshape(-1, x.shape[-1]), weight.t())
+    return out.view(*prev_dims, layer.out_features)
+
+
 class SelfAttention(nn.Module):
     def __init__(self, dim: int, num_heads: int = 8, qkv_bias: bool = False):
         super().__init__()
@@ -119,7 +141,11 @@ class Modulation(nn.Module):
         self.lin = nn.Linear(dim, self.multiplier * dim, bias=True)
 
     def forward(self, vec: Tensor) -> tuple[ModulationOut, ModulationOut | None]:
-        out = self.lin(nn.functional.silu(vec))[:, None, :].chunk(self.multiplier, dim=-1)
+        return self.split(self.lin(nn.functional.silu(vec)))
+
+    def split(self, mod: Tensor) -> tuple[ModulationOut, ModulationOut | None]:
+        """Split a (precomputed) output of `lin` into shift, scale and gate."""
+        out = mod[:, None, :].chunk(self.multiplier, dim=-1)
 
         return (
             ModulationOut(*out[:3]),
@@ -155,40 +181,99 @@ class DoubleStreamBlock(nn.Module):
             nn.GELU(approximate="tanh"),
             nn.Linear(mlp_hidden_dim, hidden_size, bias=True),
         )
-
-    def forward(self, img: Tensor, txt: Tensor, vec: Tensor, pe: Tensor) -> tuple[Tensor, Tensor]:
-        img_mod1, img_mod2 = self.img_mod(vec)
-        txt_mod1, txt_mod2 = self.txt_mod(vec)
+        # write q, k and v of txt and img straight into joint buffers instead of concatenating them
+        self.concat_free = False
+
+    def joint_qkv(self, txt_qkv: Tensor, img_qkv: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        q, k and v of the joint `(txt, img)` sequence. The QK norms write their outputs
+        into slices of one preallocated buffer and v is copied in, nothing is concatenated.
+        """
+        bs, txt_len, _ = txt_qkv.shape
+        seq_len = txt_len + img_qkv.shape[1]
+        head_dim = self.hidden_size // self.num_heads
+        q, k, v = torch.empty(
+            (3, bs, self.num_heads, seq_len, head_dim), dtype=img_qkv.dtype, device=img_qkv.device
+        )
+        for qkv, attn, rows in (
+            (txt_qkv, self.txt_attn, slice(0, txt_len)),
+            (img_qkv, self.img_attn, slice(txt_len, seq_len)),
+        ):
+            part_q, part_k, part_v = rearrange(qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
+            attn.norm.query_norm(part_q, out=q[:, :, rows])
+            attn.norm.key_norm(part_k, out=k[:, :, rows])
+            v[:, :, rows] = part_v
+        return q, k, v
+
+    def forward(
+        self,
+        img: Tensor,
+        txt: Tensor,
+        vec: Tensor | None,
+        pe: Tensor,
+        mod: tuple[Tensor, Tensor] | None = None,
+        feature_cache: BlockFeatureCache | None = None,
+        block_index: int = 0,
+        attn_mask: Tensor | None = None,
+    ) -> tuple[Tensor, Tensor]:
+        if mod is None:
+            img_mod1, img_mod2 = self.img_mod(vec)
+            txt_mod1, txt_mod2 = self.txt_mod(vec)
+        else:
+            img_mod1, img_mod2 = self.img_mod.split(mod[0])
+            txt_mod1, txt_mod2 = self.txt_mod.split(mod[1])
+
+        if feature_cache is not None and not feature_cache.computes(block_index):
+            img = img + img_mod1.gate * feature_cache.forecast((block_index, "img_attn"))
+            img = img + img_mod2.gate * feature_cache.forecast((block_index, "img_mlp"))
+            txt = txt + txt_mod1.gate * feature_cache.forecast((block_index, "txt_attn"))
+            txt = txt + txt_mod2.gate * feature_cache.forecast((block_index, "txt_mlp"))
+            return img, txt
 
         # prepare image for attention
         img_modulated = self.img_norm1(img)
         img_modulated = (1 + img_mod1.scale) * img_modulated + img_mod1.shift
         img_qkv = self.img_attn.qkv(img_modulated)
-        img_q, img_k, img_v = rearrange(img_qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
-        img_q, img_k = self.img_attn.norm(img_q, img_k, img_v)
 
         # prepare txt for attention
         txt_modulated = self.txt_norm1(txt)
         txt_modulated = (1 + txt_mod1.scale) * txt_modulated + txt_mod1.shift
         txt_qkv = self.txt_attn.qkv(txt_modulated)
-        txt_q, txt_k, txt_v = rearrange(txt_qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
-        txt_q, txt_k = self.txt_attn.norm(txt_q, txt_k, txt_v)
+
+        if self.concat_free:
+            q, k, v = self.joint_qkv(txt_qkv, img_qkv)
+        else:
+            img_q, img_k, img_v = rearrange(img_qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
+            img_q, img_k = self.img_attn.norm(img_q, img_k, img_v)
+            txt_q, txt_k, txt_v = rearrange(txt_qkv, "B L (K H D) -> K B H L D", K=3, H=self.num_heads)
+            txt_q, txt_k = self.txt_attn.norm(txt_q, txt_k, txt_v)
+
+            q = torch.cat((txt_q, img_q), dim=2)
+            k = torch.cat((txt_k, img_k), dim=2)
+            v = torch.cat((txt_v, img_v), dim=2)
 
         # run actual attention
-        q = torch.cat((txt_q, img_q), dim=2)
-        k = torch.cat((txt_k, img_k), dim=2)
-        v = torch.cat((txt_v, img_v), dim=2)
 
-        attn = attention(q, k, v, pe=pe)
+        attn = attention(q, k, v, pe=pe, mask=attn_mask)
         txt_attn, img_attn = attn[:, : txt.shape[1]], attn[:, txt.shape[1] :]
 
         # calculate the img blocks
-        img = img + img_mod1.gate * self.img_attn.proj(img_attn)
-        img = img + img_mod2.gate * self.img_mlp((1 + img_mod2.scale) * self.img_norm2(img) + img_mod2.shift)
+        img_attn = self.img_attn.proj(img_attn)
+        img = img + img_mod1.gate * img_attn
+        img_mlp = self.img_mlp((1 + img_mod2.scale) * self.img_norm2(img) + img_mod2.shift)
+        img = img + img_mod2.gate * img_mlp
 
         # calculate the txt blocks
-        txt = txt + txt_mod1.gate * self.txt_attn.proj(txt_attn)
-        txt = txt + txt_mod2.gate * self.txt_mlp((1 + txt_mod2.scale) * self.txt_norm2(txt) + txt_mod2.shift)
+        txt_attn = self.txt_attn.proj(txt_attn)
+        txt = txt + txt_mod1.gate * txt_attn
+        txt_mlp = self.txt_mlp((1 + txt_mod2.scale) * self.txt_norm2(txt) + txt_mod2.shift)
+        txt = txt + txt_mod2.gate * txt_mlp
+
+        if feature_cache is not None:
+            feature_cache.record((block_index, "img_attn"), img_attn)
+            feature_cache.record((block_index, "img_mlp"), img_mlp)
+            feature_cache.record((block_index, "txt_attn"), txt_attn)
+            feature_cache.record((block_index, "txt_mlp"), txt_mlp)
         return img, txt
 
 
@@ -224,9 +309,23 @@ class SingleStreamBlock(nn.Module):
 
         self.mlp_act = nn.GELU(approximate="tanh")
         self.modulation = Modulation(hidden_size, double=False)
+        # run linear2 as two accumulating GEMMs instead of on the concatenated input
+        self.concat_free = False
+
+    def forward(
+        self,
+        x: Tensor,
+        vec: Tensor | None,
+        pe: Tensor,
+        mod: Tensor | None = None,
+        feature_cache: BlockFeatureCache | None = None,
+        block_index: int = 0,
+        attn_mask: Tensor | None = None,
+    ) -> Tensor:
+        mod, _ = self.modulation(vec) if mod is None else self.modulation.split(mod)
+        if feature_cache is not None and not feature_cache.computes(block_index):
+            return x + mod.gate * feature_cache.forecast((block_index, "out"))
 
-    def forward(self, x: Tensor, vec: Tensor, pe: Tensor) -> Tensor:
-        mod, _ = self.modulation(vec)
         x_mod = (1 + mod.scale) * self.pre_norm(x) + mod.shift
         qkv, mlp = torch.split(self.linear1(x_mod), [3 * self.hidden_size, self.mlp_hidden_dim], dim=-1)
 
@@ -234,9 +333,14 @@ class SingleStreamBlock(nn.Module):
         q, k = self.norm(q, k, v)
 
         # compute attention
-        attn = attention(q, k, v, pe=pe)
+        attn = attention(q, k, v, pe=pe, mask=attn_mask)
         # compute activation in mlp stream, cat again and run second linear layer
-        output = self.linear2(torch.cat((attn, self.mlp_act(mlp)), 2))
+        if self.concat_free:
+            output = split_linear(self.linear2, [attn, self.mlp_act(mlp)])
+        else:
+            output = self.linear2(torch.cat((attn, self.mlp_act(mlp)), 2))
+        if feature_cache is not None:
+            feature_cache.record((block_index, "out"), output)
         return x + mod.gate * output
 
 
@@ -247,8 +351,10 @@ class LastLayer(nn.Module):
         self.linear = nn.Linear(hidden_size, patch_size * patch_size * out_channels, bias=True)
         self.adaLN_modulation = nn.Sequential(nn.SiLU(), nn.Linear(hidden_size, 2 * hidden_size, bias=True))
 
-    def forward(self, x: Tensor, vec: Tensor) -> Tensor:
-        shift, scale = self.adaLN_modulation(vec).chunk(2, dim=1)
+    def forward(self, x: Tensor, vec: Tensor | None, mod: Tensor | None = None) -> Tensor:
+        if mod is None:
+            mod = self.adaLN_modulation(vec)
+        shift, scale = mod.chunk(2, dim=1)
         x = (1 + scale[:, None, :]) * self.norm_final(x) + shift[:, None, :]
         x = self.linear(x)
         return x
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+import torch
+from einops import rearrange
+from torch import Tensor
+
+from .math import RopeTable
+from .modules.layers import EmbedND
+
+
+def get_img_ids(height: int, width: int, index: int = 0, device: torch.device | None = None) -> Tensor:
+    """
+    Position ids for a `height` x `width` grid of packed latent tokens, with a batch
+    dimension of 1 that broadcasts over the batch. `index` fills the first axis,
+    Kontext uses 1 to mark the conditioning image tokens.
+    """
+    img_ids = torch.zeros(height, width, 3, device=device)
+    img_ids[..., 0] = index
+    img_ids[..., 1] = img_ids[..., 1] + torch.arange(height, device=device)[:, None]
+    img_ids[..., 2] = img_ids[..., 2] + torch.arange(width, device=device)[None, :]
+    return rearrange(img_ids, "h w c -> 1 (h w) c")
+
+
+def get_txt_ids(length: int, device: torch.device | None = None) -> Tensor:
+    return torch.zeros(1, length, 3, device=device)
+
+
+class PositionCache:
+    """
+    Device-resident cache of position ids and RoPE embeddings keyed by token grid size.
+
+    RoPE is applied per token, so the embedding of the joint `(txt, img, img_cond)`
+    sequence is the concatenation of the embeddings of its parts. `warmup` builds the
+    parts, and the `RopeTable` of the joint sequence used by the model, for a fixed set
+    of resolutions once; they are never evicted. Anything else, including other
+    assembled joint embeddings, lives in an LRU of `max_entries` items.
+    All tensors have a batch dimension of 1 and broadcast over the batch.
+    """
+
+    def __init__(self, pe_embedder: EmbedND, device: str | torch.device, max_entries: int = 32):
+        self.pe_embedder = pe_embedder
+        self.device = torch.device(device)
+        self.max_entries = max_entries
+        self._resident: dict[tuple, Tensor] = {}
+        self._lru: OrderedDict[tuple, Tensor] = OrderedDict()
+
+    def _get(self, key: tuple, build: Callable[[], Tensor], resident: bool = False) -> Tensor:
+        if key in self._resident:
+            return self._resident[key]
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            value = self._lru[key]
+            if resident:
+                self._resident[key] = self._lru.pop(key)
+            return value
+
+        value = build()
+        if resident:
+            self._resident[key] = value
+        else:
+            self._lru[key] = value
+            if len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+        return value
+
+    def img_ids(self, height: int, width: int, index: int = 0, resident: bool = False) -> Tensor:
+        """Ids for a `height` x `width` grid of packed latent tokens."""
+        return self._get(
+            ("img_ids", height, width, index),
+            lambda: get_img_ids(height, width, index=index, device=self.device),
+            resident,
+        )
+
+    def txt_ids(self, length: int, resident: bool = False) -> Tensor:
+        return self._get(("txt_ids", length), lambda: get_txt_ids(length, device=self.device), resident)
+
+    @torch.inference_mode()
+    def _embed(self, ids: Tensor) -> Tensor:
+        return self.pe_embedder(ids)
+
+    def _img_pe(self, height: int, width: int, index: int, resident: bool = False) -> Tensor:
+        return self._get(
+            ("img_pe", height, width, index),
+            lambda: self._embed(self.img_ids(height, width, index, resident)),
+            resident,
+        )
+
+    def _txt_pe(self, length: int, resident: bool = False) -> Tensor:
+        return self._get(("txt_pe", length), lambda: self._embed(self.txt_ids(length, resident)), resident)
+
+    def pe(
+        self,
+        txt_len: int,
+        img_size: tuple[int, int],
+        cond_size: tuple[int, int] | None = None,
+        resident: bool = False,
+    ) -> Tensor:
+        """
+        Positional embedding for `txt_len` text tokens, followed by an `img_size` grid
+        of image tokens and optionally a `cond_size` grid of Kontext conditioning tokens.
+        Sizes are `(height, width)` in packed latent tokens.
+        """
+
+        def build() -> Tensor:
+            parts = [self._txt_pe(txt_len, resident), self._img_pe(*img_size, index=0, resident=resident)]
+            if cond_size is not None:
+                parts.append(self._img_pe(*cond_size, index=1, resident=resident))
+            return torch.cat(parts, dim=2)
+
+        return self._get(("pe", txt_len, tuple(img_size), cond_size and tuple(cond_size)), build, resident)
+
+    def rope_table(
+        self,
+        txt_len: int,
+        img_size: tuple[int, int],
+        cond_size: tuple[int, int] | None = None,
+        dtype: torch.dtype = torch.bfloat16,
+        resident: bool = False,
+    ) -> RopeTable:
+        """
+        `pe` as a `RopeTable` in `dtype`. Text ids are all zero, so the text tokens are
+        the identity prefix and only the image tokens are in the table.
+        """
+
+        def build() -> RopeTable:
+            parts = [self._img_pe(*img_size, index=0, resident=resident)]
+            if cond_size is not None:
+                parts.append(self._img_pe(*cond_size, index=1, resident=resident))
+            return RopeTable.from_pe(torch.cat(parts, dim=2), dtype, identity_prefix=txt_len)
+
+        key = ("rope_table", txt_len, tuple(img_size), cond_size and tuple(cond_size), dtype)
+        return self._get(key, build, resident)
+
+    def warmup(self, resolutions: Iterable[tuple[int, int]], txt_len: int) -> None:
+        """
+        Populate the resident tier for `(width, height)` pixel resolutions, for use both
+        as the generated image and as the Kontext conditioning image.
+        """
+        self._txt_pe(txt_len, resident=True)
+        for width, height in resolutions:
+            size = (height // 16, width // 16)
+            self._img_pe(*size, index=0, resident=True)
+            self._img_pe(*size, index=1, resident=True)
+            # the default `match_input_image` case, generated and conditioning image share a size
+            self.rope_table(txt_len, size, size, resident=True)
@@ -0,0 +1,138 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator
+
+import torch
+from einops import rearrange
+from PIL import Image
+from torch import Tensor
+
+# least squares fit of the 16 Flux latent channels to RGB, as used by ComfyUI for previews
+LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+
+def predicted_x0(img: Tensor, pred: Tensor, t: float) -> Tensor:
+    """Clean latent the velocity `pred` points to, the flow runs from x0 at t=0 to noise at t=1."""
+    return img - t * pred
+
+
+def latent_to_rgb(x: Tensor, height: int, width: int) -> Tensor:
+    """
+    Cheap preview of the packed latent `x` for a `height` x `width` pixel image, a
+    linear projection of every latent pixel to RGB instead of running the decoder.
+    The result is (batch, 3, height / 8, width / 8) in [-1, 1].
+    """
+    x = rearrange(
+        x,
+        "b (h w) (c ph pw) -> b (h ph) (w pw) c",
+        h=(height + 15) // 16,
+        w=(width + 15) // 16,
+        ph=2,
+        pw=2,
+    )
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=x.device, dtype=x.dtype)
+    bias = torch.tensor(LATENT_RGB_BIAS, device=x.device, dtype=x.dtype)
+    rgb = x @ factors + bias
+    return rearrange(rgb, "b h w c -> b c h w").clamp(-1, 1)
+
+
+class DenoiseCancelled(Exception):
+    """Raised from a `denoise` step callback once the preview consumer went away."""
+
+
+class PreviewStreamer:
+    """
+    `denoise` step callback that produces a low resolution preview every `every` steps.
+
+    On the denoising thread the callback only enqueues the `latent_to_rgb` projection
+    of the predicted clean latent and a non-blocking copy to pinned host memory. A
+    worker thread waits for the copy and builds the PIL images. Previews are dropped,
+    never queued up, while the previous one is still in flight or when the time the
+    callback took on the denoising thread so far exceeds `time_budget` times the
+    elapsed time.
+
+    `stream(job)` yields `(step, preview, images)` as previews become ready until the
+    future `job` running the denoise is done. `preview` is the `latent_to_rgb` output
+    on the device, e.g. for a safety check, `images` are its PIL versions. After `cancel` the next step raises
+    `DenoiseCancelled`, so the denoise stops and frees the device. The worker thread is shut
+    down once `stream` returns or by `close`, which must only be called once the denoise is
+    done so that no step submits to it afterwards. A streamer serves one request.
+    """
+
+    def __init__(self, height: int, width: int, every: int, time_budget: float = 0.05):
+        self.height = height
+        self.width = width
+        self.every = every
+        self.time_budget = time_budget
+        self.previews = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+        self.cancelled = threading.Event()
+        self.overhead = 0.0
+        self.skipped = 0
+        self._pending: Future | None = None
+        self._start = time.perf_counter()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    def __call__(self, step: int, t: float, img: Tensor, pred: Tensor) -> None:
+        if self.cancelled.is_set():
+            raise DenoiseCancelled(f"Cancelled at step {step}")
+        if (step + 1) % self.every != 0:
+            return
+
+        t0 = time.perf_counter()
+        if (self._pending is not None and not self._pending.done()) or self.overhead > self.time_budget * (
+            t0 - self._start
+        ):
+            self.skipped += 1
+            return
+
+        preview = latent_to_rgb(predicted_x0(img, pred, t).float(), self.height, self.width)
+        rgb = ((preview + 1) * 127.5).to(torch.uint8).permute(0, 2, 3, 1).contiguous()
+        host = torch.empty(rgb.shape, dtype=torch.uint8, pin_memory=rgb.is_cuda)
+        host.copy_(rgb, non_blocking=rgb.is_cuda)
+        event = None
+        if rgb.is_cuda:
+            event = torch.cuda.Event()
+            event.record()
+        self._pending = self.executor.submit(self._finish, step, preview, host, event)
+        self.overhead += time.perf_counter() - t0
+
+    def _finish(self, step: int, preview: Tensor, host: Tensor, event: torch.cuda.Event | None) -> None:
+        if event is not None:
+            event.synchronize()
+        self.previews.put((step, preview, [Image.fromarray(image.numpy()) for image in host]))
+
+    def stream(self, job: Future) -> Iterator[tuple[int, Tensor, list[Image.Image]]]:
+        while True:
+            try:
+                yield self.previews.get(timeout=0.05)
+            except queue.Empty:
+                # previews can still be in flight when the denoise finishes
+                if job.done() and (self._pending is None or self._pending.done()) and self.previews.empty():
+                    self.close()
+                    return
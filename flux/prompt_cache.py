@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+from torch import Tensor
+
+from .modules.conditioner import HFEmbedder
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Prompts that only differ in surrounding or repeated whitespace tokenize the same."""
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def tokenizer_version(embedder: HFEmbedder) -> str:
+    """Identifies the tokenizer and encoder an embedding was computed with."""
+    tokenizer = embedder.tokenizer
+    return f"{type(tokenizer).__name__}:{tokenizer.name_or_path}:{len(tokenizer)}:{embedder.max_length}"
+
+
+@dataclass
+class PromptCacheStats:
+    hot_hits: int = 0
+    warm_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.hot_hits + self.warm_hits + self.disk_hits
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.hits} hits ({self.hot_hits} hot, {self.warm_hits} warm, {self.disk_hits} disk), "
+            f"{self.misses} misses, hit rate {self.hit_rate:.1%}"
+        )
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of the T5 `txt` and CLIP `vec` embeddings of a prompt.
+
+    Entries are keyed by the normalized prompt together with the tokenizer version
+    and max length of both embedders. There are three tiers:
+
+    - hot: the `hot_entries` most recently used embeddings, on the embedders' device
+    - warm: entries evicted from the hot tier, in pinned host memory so they move
+      back to the device with an asynchronous copy
+    - disk: an optional directory of safetensors files that are memory-mapped on
+      load and survive restarts. Every newly encoded prompt is written to it
+
+    Calling the cache with a batch of prompts looks up every prompt and encodes the
+    misses together, in one T5 and one CLIP pass.
+    """
+
+    def __init__(
+        self,
+        t5: HFEmbedder,
+        clip: HFEmbedder,
+        hot_entries: int = 32,
+        warm_entries: int = 256,
+        disk_dir: str | Path | None = None,
+    ):
+        self.t5 = t5
+        self.clip = clip
+        self.hot_entries = hot_entries
+        self.warm_entries = warm_entries
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self.version = f"t5={tokenizer_version(t5)};clip={tokenizer_version(clip)}"
+        self.stats = PromptCacheStats()
+        self._hot: OrderedDict[str, tuple[Tensor, Tensor]] = OrderedDict()
+        self._warm: OrderedDict[str, tuple[Tensor, Tensor]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def device(self) -> torch.device:
+        return self.t5.hf_module.device
+
+    def key(self, prompt: str) -> str:
+        payload = json.dumps([normalize_prompt(prompt), self.version])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / f"{key}.safetensors"
+
+    def _to_host(self, tensor: Tensor) -> Tensor:
+        host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=torch.cuda.is_available())
+        return host.copy_(tensor)
+
+    def _insert_hot(self, key: str, entry: tuple[Tensor, Tensor]) -> None:
+        self._hot[key] = entry
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_entries:
+            evicted_key, (txt, vec) = self._hot.popitem(last=False)
+            # demote to the warm tier
+            self._warm[evicted_key] = (self._to_host(txt), self._to_host(vec))
+            while len(self._warm) > self.warm_entries:
+                self._warm.popitem(last=False)
+
+    def _lookup(self, key: str) -> tuple[Tensor, Tensor] | None:
+        if key in self._hot:
+            self._hot.move_to_end(key)
+            self.stats.hot_hits += 1
+            return self._hot[key]
+
+        if key in self._warm:
+            txt, vec = self._warm.pop(key)
+            entry = (txt.to(self.device, non_blocking=True), vec.to(self.device, non_blocking=True))
+            self._insert_hot(key, entry)
+            self.stats.warm_hits += 1
+            return entry
+
+        if self.disk_dir is not None and self._disk_path(key).exists():
+            with safe_open(self._disk_path(key), framework="pt", device="cpu") as f:
+                entry = (f.get_tensor("txt").to(self.device), f.get_tensor("vec").to(self.device))
+            self._insert_hot(key, entry)
+            self.stats.disk_hits += 1
+            return entry
+
+        return None
+
+    def _store(self, key: str, prompt: str, txt: Tensor, vec: Tensor) -> None:
+        self._insert_hot(key, (txt, vec))
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            # write under a temporary name so readers never see a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            save_file(
+                {"txt": txt.contiguous().cpu(), "vec": vec.contiguous().cpu()},
+                tmp_path,
+                metadata={"prompt": normalize_prompt(prompt), "version": self.version},
+            )
+            os.replace(tmp_path, path)
+
+    @torch.inference_mode()
+    def __call__(self, prompts: list[str]) -> tuple[Tensor, Tensor]:
+        """
+        Embeddings for a batch of prompts, `txt` of shape (len(prompts), max_length, dim)
+        and `vec` of shape (len(prompts), dim), on the embedders' device. The tensors
+        may be owned by the cache and must not be modified in place.
+        """
+        keys = [self.key(prompt) for prompt in prompts]
+        entries: dict[str, tuple[Tensor, Tensor]] = {}
+        with self._lock:
+            for key in keys:
+                if key not in entries:
+                    entry = self._lookup(key)
+                    if entry is not None:
+                        entries[key] = entry
+
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in entries and key not in missing:
+                missing[key] = normalize_prompt(prompt)
+        if missing:
+            txt = self.t5(list(missing.values()))
+            vec = self.clip(list(missing.values()))
+            with self._lock:
+                for i, (key, prompt) in enumerate(missing.items()):
+                    entry = (txt[i : i + 1], vec[i : i + 1])
+                    if len(missing) > 1:
+                        # don't keep the whole batch alive through views
+                        entry = (entry[0].clone(), entry[1].clone())
+                    entries[key] = entry
+                    self._store(key, prompt, *entries[key])
+                    self.stats.misses += 1
+
+        if len(keys) == 1:
+            return entries[keys[0]]
+        txt = torch.cat([entries[key][0] for key in keys])
+        vec = torch.cat([entries[key][1] for key in keys])
+        return txt, vec
+
+    def clear(self, disk: bool = False) -> None:
+        with self._lock:
+            self._hot.clear()
+            self._warm.clear()
+            if disk and self.disk_dir is not None:
+                for path in self.disk_dir.glob("*.safetensors"):
+                    path.unlink()
@@ -0,0 +1,240 @@
+import json
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+import torch
+from torch import Tensor, nn
+
+from .modules.float8_linear import F8Linear
+
+try:
+    from torchao.quantization import quantize_
+
+    try:
+        from torchao.quantization import Int4WeightOnlyConfig, Int8WeightOnlyConfig
+    except ImportError:
+        # torchao < 0.9 only has the function style configs
+        from torchao.quantization import int4_weight_only as Int4WeightOnlyConfig
+        from torchao.quantization import int8_weight_only as Int8WeightOnlyConfig
+except ImportError:
+    quantize_ = None
+
+QUANTIZATION_METHODS = ("bf16", "fp8", "int8", "int4")
+# bytes per weight, for the memory estimate of a policy
+BYTES_PER_WEIGHT = {"bf16": 2.0, "fp8": 1.0, "int8": 1.0, "int4": 0.5}
+INT4_GROUP_SIZE = 128
+
+
+@dataclass
+class QuantizationPolicy:
+    """
+    Quantization method of every linear in the transformer. `layers` maps fnmatch patterns of
+    module names, e.g. "double_blocks.*.img_mlp.*", to one of `QUANTIZATION_METHODS`. The
+    first matching pattern wins, layers no pattern matches get `default`. "fp8" runs the
+    layer as an F8Linear, "int8" and "int4" are torchao weight-only quantization.
+    """
+
+    layers: dict[str, str] = field(default_factory=dict)
+    default: str = "bf16"
+    name: str = "custom"
+
+    def __post_init__(self):
+        for pattern, method in [*self.layers.items(), ("default", self.default)]:
+            if method not in QUANTIZATION_METHODS:
+                raise ValueError(
+                    f"Unknown quantization method {method} for {pattern}, choose one of {QUANTIZATION_METHODS}"
+                )
+
+    def method(self, name: str) -> str:
+        for pattern, method in self.layers.items():
+            if fnmatchcase(name, pattern):
+                return method
+        return self.default
+
+    def resolve(self, model: nn.Module) -> dict[str, str]:
+        """Method per linear of `model`, bf16 for layers whose shape the method can't handle."""
+        return {
+            name: method if supports(layer, method := self.method(name)) else "bf16"
+            for name, layer in quantizable_linears(model).items()
+        }
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "default": self.default, "layers": self.layers}
+
+
+# the layout of the released checkpoint, only the single block linears in FP8
+DEFAULT_POLICY = QuantizationPolicy(
+    layers={"single_blocks.*.linear1": "fp8", "single_blocks.*.linear2": "fp8"}, name="default"
+)
+BF16_POLICY = QuantizationPolicy(name="bf16")
+POLICIES = {policy.name: policy for policy in (DEFAULT_POLICY, BF16_POLICY)}
+
+
+def load_policy(path: str | Path) -> QuantizationPolicy:
+    """Read a policy from JSON, or YAML for .yaml/.yml files, or return a built-in one by name."""
+    if str(path) in POLICIES:
+        return POLICIES[str(path)]
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix in (".yaml", ".yml"):
+            import yaml
+
+            raw = yaml.safe_load(f)
+        else:
+            raw = json.load(f)
+    return QuantizationPolicy(
+        layers=dict(raw.get("layers", {})), default=raw.get("default", "bf16"), name=raw.get("name", path.stem)
+    )
+
+
+def save_policy(policy: QuantizationPolicy, path: str | Path) -> None:
+    with open(path, "w") as f:
+        json.dump(policy.to_dict(), f, indent=2)
+        f.write("\n")
+
+
+def quantizable_linears(model: nn.Module) -> dict[str, nn.Module]:
+    """Every nn.Linear and F8Linear of `model` by name, including ones torchao quantized."""
+    return {name: module for name, module in model.named_modules() if isinstance(module, (nn.Linear, F8Linear))}
+
+
+def supports(layer: nn.Module, method: str) -> bool:
+    if method == "fp8":
+        # torch._scaled_mm needs both dimensions divisible by 16
+        return layer.in_features % 16 == 0 and layer.out_features % 16 == 0
+    if method == "int4":
+        # whole groups along the input, which also satisfies the tinygemm kernel's tiling
+        return layer.in_features % INT4_GROUP_SIZE == 0 and layer.out_features % 8 == 0
+    return True
+
+
+def _set_module(model: nn.Module, name: str, module: nn.Module) -> None:
+    parent, _, child = name.rpartition(".")
+    setattr(model.get_submodule(parent) if parent else model, child, module)
+
+
+def _torchao_config(method: str):
+    if quantize_ is None:
+        raise RuntimeError(f"{method} quantization needs torchao")
+    if method == "int4":
+        return Int4WeightOnlyConfig(group_size=INT4_GROUP_SIZE)
+    return Int8WeightOnlyConfig()
+
+
+def prepare_quantization(model: nn.Module, policy: QuantizationPolicy) -> dict[str, str]:
+    """
+    Swap the linears of a `model` on the meta device, before its bf16 weights are loaded:
+    "fp8" layers become F8Linear, which quantizes while loading, every other layer an
+    nn.Linear. Returns the method per layer, `finish_quantization` applies int8 and int4
+    once the weights are on the target device.
+    """
+    methods = policy.resolve(model)
+    for name, layer in quantizable_linears(model).items():
+        if methods[name] != policy.method(name):
+            print(f"{name} ({layer.in_features} -> {layer.out_features}) can't be {policy.method(name)}, keeping bf16")
+        shape = (layer.in_features, layer.out_features, layer.bias is not None)
+        if methods[name] == "fp8" and not isinstance(layer, F8Linear):
+            _set_module(model, name, F8Linear(*shape, device="meta", dtype=torch.bfloat16))
+        elif methods[name] != "fp8" and isinstance(layer, F8Linear):
+            _set_module(model, name, nn.Linear(*shape, device="meta", dtype=torch.bfloat16))
+    return methods
+
+
+def finish_quantization(model: nn.Module, policy: QuantizationPolicy) -> dict[str, str]:
+    """torchao weight-only quantization of the int8 and int4 layers, on the device they run on."""
+    methods = policy.resolve(model)
+    for method in ("int8", "int4"):
+        names = {name for name, layer_method in methods.items() if layer_method == method}
+        if names:
+            quantize_(model, _torchao_config(method), filter_fn=lambda module, fqn, names=names: fqn in names)
+    return methods
+
+
+def quantize_linear(layer: nn.Linear, method: str) -> nn.Module:
+    """A quantized copy of the bf16 `layer`, sharing nothing that quantization changes."""
+    bias = layer.bias.detach() if layer.bias is not None else None
+    if method == "fp8":
+        quantized = F8Linear(
+            layer.in_features,
+            layer.out_features,
+            device=layer.weight.device,
+            float_weight=layer.weight.detach(),
+            float_bias=bias,
+        )
+        quantized.quantize_weight()
+        return quantized
+    quantized = nn.Linear(layer.in_features, layer.out_features, bias is not None, device="meta")
+    quantized.weight = nn.Parameter(layer.weight.detach(), requires_grad=False)
+    if bias is not None:
+        quantized.bias = nn.Parameter(bias, requires_grad=False)
+    if method != "bf16":
+        quantize_(quantized, _torchao_config(method))
+    return quantized
+
+
+def estimate_weight_bytes(model: nn.Module, methods: dict[str, str]) -> int:
+    """Bytes of the linear weights of `model` under `methods`, scales and biases left out."""
+    layers = quantizable_linears(model)
+    return int(
+        sum(layers[name].in_features * layers[name].out_features * BYTES_PER_WEIGHT[m] for name, m in methods.items())
+    )
+
+
+class SensitivityScan:
+    """
+    Measures how much quantizing each bf16 nn.Linear of `model` changes its output while
+    active. Every call of a layer also runs a quantized copy per method on the same input
+    and records the relative L2 error. `policy` then picks per layer the first method of
+    `preference` whose largest error stays within `max_error`.
+
+        with SensitivityScan(model) as scan:
+            denoise(model, ...)
+        policy = scan.policy(max_error=0.02)
+    """
+
+    def __init__(self, model: nn.Module, methods: tuple[str, ...] = ("fp8", "int8", "int4")):
+        self.layers = {name: layer for name, layer in quantizable_linears(model).items() if type(layer) is nn.Linear}
+        self.methods = methods
+        self.errors: dict[str, dict[str, list[float]]] = {name: {m: [] for m in methods} for name in self.layers}
+        self.handles = []
+
+    def _hook(self, name: str):
+        def hook(layer: nn.Linear, inputs: tuple[Tensor, ...], output: Tensor):
+            reference = output.float()
+            norm = torch.linalg.vector_norm(reference).clamp(min=1e-12)
+            for method in self.methods:
+                if not supports(layer, method):
+                    continue
+                quantized = quantize_linear(layer, method)
+                error = torch.linalg.vector_norm(quantized(inputs[0]).float() - reference) / norm
+                self.errors[name][method].append(error.item())
+                del quantized
+
+        return hook
+
+    def __enter__(self) -> "SensitivityScan":
+        self.handles = [layer.register_forward_hook(self._hook(name)) for name, layer in self.layers.items()]
+        return self
+
+    def __exit__(self, *exc):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def max_errors(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {method: max(errors) for method, errors in methods.items() if errors}
+            for name, methods in self.errors.items()
+        }
+
+    def policy(
+        self, max_error: float, preference: tuple[str, ...] = ("int4", "fp8", "int8"), name: str = "scanned"
+    ) -> QuantizationPolicy:
+        layers = {}
+        for layer_name, errors in self.max_errors().items():
+            for method in preference:
+                if errors.get(method, float("inf")) <= max_error:
+                    layers[layer_name] = method
+                    break
+        return QuantizationPolicy(layers=layers, default="bf16", name=name)
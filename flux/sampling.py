@@ -1,4 +1,5 @@
 import math
+from functools import partial
 from typing import Callable
 
 import numpy as np
@@ -9,10 +10,15 @@ from torch import Tensor
 
 from .model import Flux
 from .modules.autoencoder import AutoEncoder
-from .modules.conditioner import HFEmbedder
+from .modules.conditioner import HFEmbedder, bucket_length
+from .latent_cache import ConditioningLatentCache
+from .math import RopeTable
 from .modules.image_embedders import DepthImageEncoder, ReduxImageEncoder
+from .position_cache import PositionCache, get_img_ids, get_txt_ids
+from .prompt_cache import PromptEmbeddingCache
+from .step_policy import AdaptiveStepPolicy
 from .util import PREFERED_KONTEXT_RESOLUTIONS
-from .taylor_seer_utils import approximate_derivative, approximate_value
+from .taylor_seer_utils import BlockFeatureCache, TaylorSeerState
 
 
 def get_noise(
@@ -21,8 +27,12 @@ def get_noise(
     width: int,
     device: torch.device,
     dtype: torch.dtype,
-    seed: int,
+    seed: int | list[int],
 ):
+    if isinstance(seed, (list, tuple)):
+        # one seed per sample, each sample is the noise a single sample run with that seed gets
+        assert num_samples == len(seed), "get_noise needs one seed per sample"
+        return torch.cat([get_noise(1, height, width, device, dtype, s) for s in seed])
     return torch.randn(
         num_samples,
         16,
@@ -34,7 +44,39 @@ def get_noise(
     ).to(device)
 
 
-def prepare(t5: HFEmbedder, clip: HFEmbedder, img: Tensor, prompt: str | list[str]) -> dict[str, Tensor]:
+def bucket_txt(
+    t5: HFEmbedder, prompts: list[str], txt: Tensor, buckets: tuple[int, ...]
+) -> tuple[Tensor, Tensor | None]:
+    """
+    Trim the T5 embeddings `txt`, padded to `t5.max_length`, to the smallest of `buckets`
+    that fits the longest prompt. The padding left within the bucket is masked: the mask
+    is (len(prompts), bucket) and True for real tokens, or None if there is no padding left.
+    """
+    lengths = t5.token_lengths(prompts)
+    length = min(bucket_length(max(lengths), buckets), txt.shape[1])
+    txt = txt[:, :length]
+    if min(lengths) >= length:
+        return txt, None
+    txt_mask = torch.arange(length)[None, :] < torch.tensor(lengths)[:, None]
+    return txt, txt_mask.to(txt.device)
+
+
+def prepare(
+    t5: HFEmbedder,
+    clip: HFEmbedder,
+    img: Tensor,
+    prompt: str | list[str],
+    position_cache: PositionCache | None = None,
+    prompt_cache: PromptEmbeddingCache | None = None,
+    embeddings: tuple[Tensor, Tensor] | None = None,
+    txt_buckets: tuple[int, ...] | None = None,
+) -> dict[str, Tensor]:
+    """
+    Pack the noise `img` and encode `prompt`. `embeddings` are `(txt, vec)` that were
+    already encoded for `prompt`, the text encoders are skipped when they are given.
+    With `txt_buckets` the text tokens are trimmed to a length bucket and the result
+    holds a `txt_mask` for the padding that is left, see `bucket_txt`.
+    """
     bs, c, h, w = img.shape
     if bs == 1 and not isinstance(prompt, str):
         bs = len(prompt)
@@ -43,29 +85,46 @@ def prepare(t5: HFEmbedder, clip: HFEmbedder, img: Tensor, prompt: str | list[st
     if img.shape[0] == 1 and bs > 1:
         img = repeat(img, "1 ... -> bs ...", bs=bs)
 
-    img_ids = torch.zeros(h // 2, w // 2, 3)
-    img_ids[..., 1] = img_ids[..., 1] + torch.arange(h // 2)[:, None]
-    img_ids[..., 2] = img_ids[..., 2] + torch.arange(w // 2)[None, :]
-    img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
+    # position ids are shared by every sample, they keep a batch dim of 1 and broadcast
+    if position_cache is not None:
+        img_ids = position_cache.img_ids(h // 2, w // 2)
+    else:
+        img_ids = get_img_ids(h // 2, w // 2)
 
     if isinstance(prompt, str):
         prompt = [prompt]
-    txt = t5(prompt)
+    if embeddings is not None:
+        txt, vec = embeddings
+    elif prompt_cache is not None:
+        txt, vec = prompt_cache(prompt)
+    else:
+        txt = t5(prompt)
+        vec = clip(prompt)
+    txt_mask = None
+    if txt_buckets is not None:
+        txt, txt_mask = bucket_txt(t5, prompt, txt, txt_buckets)
     if txt.shape[0] == 1 and bs > 1:
         txt = repeat(txt, "1 ... -> bs ...", bs=bs)
-    txt_ids = torch.zeros(bs, txt.shape[1], 3)
+    if txt_mask is not None and txt_mask.shape[0] == 1 and bs > 1:
+        txt_mask = repeat(txt_mask, "1 ... -> bs ...", bs=bs)
+    if position_cache is not None:
+        txt_ids = position_cache.txt_ids(txt.shape[1])
+    else:
+        txt_ids = get_txt_ids(txt.shape[1])
 
-    vec = clip(prompt)
     if vec.shape[0] == 1 and bs > 1:
         vec = repeat(vec, "1 ... -> bs ...", bs=bs)
 
-    return {
+    return_dict = {
         "img": img,
         "img_ids": img_ids.to(img.device),
         "txt": txt.to(img.device),
         "txt_ids": txt_ids.to(img.device),
         "vec": vec.to(img.device),
     }
+    if txt_buckets is not None:
+        return_dict["txt_mask"] = txt_mask if txt_mask is None else txt_mask.to(img.device)
+    return return_dict
 
 
 def prepare_control(
@@ -182,10 +241,7 @@ def prepare_redux(
     if img.shape[0] == 1 and bs > 1:
         img = repeat(img, "1 ... -> bs ...", bs=bs)
 
-    img_ids = torch.zeros(h // 2, w // 2, 3)
-    img_ids[..., 1] = img_ids[..., 1] + torch.arange(h // 2)[:, None]
-    img_ids[..., 2] = img_ids[..., 2] + torch.arange(w // 2)[None, :]
-    img_ids = repeat(img_ids, "h w c -> b (h w) c", b=bs)
+    img_ids = get_img_ids(h // 2, w // 2)
 
     if isinstance(prompt, str):
         prompt = [prompt]
@@ -193,7 +249,7 @@ def prepare_redux(
     txt = torch.cat((txt, img_cond.to(txt)), dim=-2)
     if txt.shape[0] == 1 and bs > 1:
         txt = repeat(txt, "1 ... -> bs ...", bs=bs)
-    txt_ids = torch.zeros(bs, txt.shape[1], 3)
+    txt_ids = get_txt_ids(txt.shape[1])
 
     vec = clip(prompt)
     if vec.shape[0] == 1 and bs > 1:
@@ -208,6 +264,73 @@ def prepare_redux(
     }
 
 
+def kontext_cond_size(img_cond: Image.Image) -> tuple[int, int]:
+    """
+    Latent `(width, height)` the conditioning image is encoded at. Only needs the
+    image header, the pixels are not decoded.
+    """
+    width, height = img_cond.size
+    aspect_ratio = width / height
+    # Kontext is trained on specific resolutions, using one of them is recommended
+    _, width, height = min((abs(aspect_ratio - w / h), w, h) for w, h in PREFERED_KONTEXT_RESOLUTIONS)
+    return 2 * int(width / 16), 2 * int(height / 16)
+
+
+def load_kontext_cond(img_cond: Image.Image, width: int, height: int) -> Tensor:
+    """Decode and resize the conditioning image to a `width` x `height` latent, in [-1, 1]."""
+    img_cond = img_cond.convert("RGB")
+    img_cond = img_cond.resize((8 * width, 8 * height), Image.Resampling.LANCZOS)
+    img_cond = np.array(img_cond)
+    img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
+    return rearrange(img_cond, "h w c -> 1 c h w")
+
+
+def encode_kontext_cond(
+    ae: AutoEncoder,
+    img_cond: Tensor,
+    device: torch.device,
+    position_cache: PositionCache | None = None,
+) -> tuple[Tensor, Tensor]:
+    """Packed bf16 conditioning tokens of a `load_kontext_cond` image and their ids."""
+    _, _, height, width = img_cond.shape
+    with torch.no_grad():
+        img_cond = ae.encode(img_cond.to(device))
+
+    img_cond = img_cond.to(torch.bfloat16)
+    img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
+
+    # image ids are the same as base image with the first dimension set to 1
+    # instead of 0
+    if position_cache is not None:
+        img_cond_ids = position_cache.img_ids(height // 16, width // 16, index=1)
+    else:
+        img_cond_ids = get_img_ids(height // 16, width // 16, index=1)
+    return img_cond, img_cond_ids
+
+
+def finish_kontext(
+    return_dict: dict[str, Tensor],
+    img_cond: Tensor,
+    img_cond_ids: Tensor,
+    img_size: tuple[int, int],
+    cond_size: tuple[int, int],
+    bs: int,
+    device: torch.device,
+    position_cache: PositionCache | None = None,
+) -> dict[str, Tensor]:
+    """
+    Add the conditioning tokens to the output of `prepare`. `img_size` and `cond_size`
+    are the `(height, width)` of the generated and conditioning image in packed tokens.
+    """
+    if img_cond.shape[0] == 1 and bs > 1:
+        img_cond = repeat(img_cond, "1 ... -> bs ...", bs=bs)
+    return_dict["img_cond_seq"] = img_cond
+    return_dict["img_cond_seq_ids"] = img_cond_ids.to(device)
+    if position_cache is not None:
+        return_dict["pe"] = position_cache.rope_table(return_dict["txt"].shape[1], img_size, cond_size)
+    return return_dict
+
+
 def prepare_kontext(
     t5: HFEmbedder,
     clip: HFEmbedder,
@@ -219,40 +342,40 @@ def prepare_kontext(
     target_width: int | None = None,
     target_height: int | None = None,
     bs: int = 1,
+    position_cache: PositionCache | None = None,
+    prompt_cache: PromptEmbeddingCache | None = None,
+    latent_cache: ConditioningLatentCache | None = None,
+    keep_orig: bool = True,
+    txt_buckets: tuple[int, ...] | None = None,
 ) -> tuple[dict[str, Tensor], int, int]:
+    """
+    Inputs for Kontext sampling. With `keep_orig` the result also holds the resized
+    conditioning image before encoding as `img_cond_orig`, unless it came from the
+    latent cache.
+    """
     # load and encode the conditioning image
     if bs == 1 and not isinstance(prompt, str):
         bs = len(prompt)
 
-    img_cond = Image.open(img_cond_path).convert("RGB")
-    width, height = img_cond.size
-    aspect_ratio = width / height
-    # Kontext is trained on specific resolutions, using one of them is recommended
-    _, width, height = min((abs(aspect_ratio - w / h), w, h) for w, h in PREFERED_KONTEXT_RESOLUTIONS)
-    width = 2 * int(width / 16)
-    height = 2 * int(height / 16)
-
-    img_cond = img_cond.resize((8 * width, 8 * height), Image.Resampling.LANCZOS)
-    img_cond = np.array(img_cond)
-    img_cond = torch.from_numpy(img_cond).float() / 127.5 - 1.0
-    img_cond = rearrange(img_cond, "h w c -> 1 c h w")
-    img_cond_orig = img_cond.clone()
-
-    with torch.no_grad():
-        img_cond = ae.encode(img_cond.to(device))
+    # only reads the header, the pixels are decoded on first use
+    img_cond = Image.open(img_cond_path)
+    width, height = kontext_cond_size(img_cond)
 
-    img_cond = img_cond.to(torch.bfloat16)
-    img_cond = rearrange(img_cond, "b c (h ph) (w pw) -> b (h w) (c ph pw)", ph=2, pw=2)
-    if img_cond.shape[0] == 1 and bs > 1:
-        img_cond = repeat(img_cond, "1 ... -> bs ...", bs=bs)
+    cached = None
+    if latent_cache is not None:
+        cache_key = latent_cache.key(img_cond_path, height, width, "lanczos")
+        cached = latent_cache.get(cache_key)
 
-    # image ids are the same as base image with the first dimension set to 1
-    # instead of 0
-    img_cond_ids = torch.zeros(height // 2, width // 2, 3)
-    img_cond_ids[..., 0] = 1
-    img_cond_ids[..., 1] = img_cond_ids[..., 1] + torch.arange(height // 2)[:, None]
-    img_cond_ids[..., 2] = img_cond_ids[..., 2] + torch.arange(width // 2)[None, :]
-    img_cond_ids = repeat(img_cond_ids, "h w c -> b (h w) c", b=bs)
+    if cached is not None:
+        # a repeated source image, the pixels are never decoded so there is no img_cond_orig
+        img_cond, img_cond_ids = cached
+        img_cond_orig = None
+    else:
+        img_cond = load_kontext_cond(img_cond, width, height)
+        img_cond_orig = img_cond.clone() if keep_orig else None
+        img_cond, img_cond_ids = encode_kontext_cond(ae, img_cond, device, position_cache)
+        if latent_cache is not None:
+            latent_cache.put(cache_key, img_cond, img_cond_ids)
 
     if target_width is None:
         target_width = 8 * width
@@ -268,10 +391,21 @@ def prepare_kontext(
         seed=seed,
     )
 
-    return_dict = prepare(t5, clip, img, prompt)
-    return_dict["img_cond_seq"] = img_cond
-    return_dict["img_cond_seq_ids"] = img_cond_ids.to(device)
-    return_dict["img_cond_orig"] = img_cond_orig
+    return_dict = prepare(
+        t5, clip, img, prompt, position_cache=position_cache, prompt_cache=prompt_cache, txt_buckets=txt_buckets
+    )
+    return_dict = finish_kontext(
+        return_dict,
+        img_cond,
+        img_cond_ids,
+        (img.shape[2] // 2, img.shape[3] // 2),
+        (height // 2, width // 2),
+        bs,
+        device,
+        position_cache,
+    )
+    if img_cond_orig is not None:
+        return_dict["img_cond_orig"] = img_cond_orig
     return return_dict, target_height, target_width
 
 
@@ -306,6 +440,145 @@ def get_schedule(
     return timesteps.tolist()
 
 
+class Sampler:
+    """
+    Turns the velocity predicted at `t_curr` into the latent at `t_prev`.
+
+    Samplers may keep state across the steps of one trajectory, `denoise` calls
+    `reset` before the first step.
+    """
+
+    def reset(self) -> None:
+        pass
+
+    def step(self, img: Tensor, pred: Tensor, t_curr: float, t_prev: float) -> Tensor:
+        raise NotImplementedError
+
+
+class EulerSampler(Sampler):
+    def step(self, img: Tensor, pred: Tensor, t_curr: float, t_prev: float) -> Tensor:
+        return img + (t_prev - t_curr) * pred
+
+
+def _lagrange_integrals(nodes: list[float], a: float, b: float) -> list[float]:
+    """Integrals over [a, b] of the Lagrange basis polynomials through `nodes`."""
+    weights = []
+    for j, t_j in enumerate(nodes):
+        # polynomial coefficients in ascending powers of t
+        coeffs = [1.0]
+        denom = 1.0
+        for m, t_m in enumerate(nodes):
+            if m == j:
+                continue
+            shifted = [0.0] * (len(coeffs) + 1)
+            for k, c in enumerate(coeffs):
+                shifted[k + 1] += c
+                shifted[k] -= t_m * c
+            coeffs = shifted
+            denom *= t_j - t_m
+        integral = sum(c * (b ** (k + 1) - a ** (k + 1)) / (k + 1) for k, c in enumerate(coeffs))
+        weights.append(integral / denom)
+    return weights
+
+
+class AdamsBashforthSampler(Sampler):
+    """
+    Variable step size Adams-Bashforth on the velocity field. Integrates the polynomial
+    through the last `order` velocity predictions, so it costs no extra model
+    evaluations. The first steps fall back to lower orders until enough history exists.
+    """
+
+    def __init__(self, order: int = 2):
+        self.order = order
+        self.reset()
+
+    def reset(self) -> None:
+        self.history: list[tuple[float, Tensor]] = []
+
+    def step(self, img: Tensor, pred: Tensor, t_curr: float, t_prev: float) -> Tensor:
+        # skipped steps forecast into TaylorSeerState's reused buffers, keep a copy
+        self.history = (self.history + [(t_curr, pred.clone())])[-self.order :]
+        weights = _lagrange_integrals([t for t, _ in self.history], t_curr, t_prev)
+        for weight, (_, velocity) in zip(weights, self.history):
+            img = img + weight * velocity
+        return img
+
+
+class DPMSolverPP2MSampler(Sampler):
+    """
+    DPM-Solver++(2M) for rectified flow, where x_t = (1 - t) * x0 + t * noise and the
+    data prediction is x0 = x_t - t * v. The first and the last step are first order.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.prev: tuple[float, Tensor] | None = None
+
+    @staticmethod
+    def _lambda(t: float) -> float:
+        return math.log((1 - t) / t)
+
+    def step(self, img: Tensor, pred: Tensor, t_curr: float, t_prev: float) -> Tensor:
+        x0 = img - t_curr * pred
+        denoised = x0
+        if self.prev is not None and 0 < t_prev and self.prev[0] < 1:
+            t_last, x0_last = self.prev
+            h = self._lambda(t_prev) - self._lambda(t_curr)
+            h_last = self._lambda(t_curr) - self._lambda(t_last)
+            r = h_last / h
+            denoised = (1 + 1 / (2 * r)) * x0 - (1 / (2 * r)) * x0_last
+        self.prev = (t_curr, x0)
+
+        # sigma = t and alpha = 1 - t, alpha_next * (1 - exp(-h)) written without logs
+        # so the t = 1 and t = 0 ends stay finite
+        sigma_ratio = t_prev / t_curr
+        return sigma_ratio * img + ((1 - t_prev) - (1 - t_curr) * sigma_ratio) * denoised
+
+
+SAMPLERS: dict[str, Callable[[], Sampler]] = {
+    "euler": EulerSampler,
+    "ab2": partial(AdamsBashforthSampler, order=2),
+    "ab3": partial(AdamsBashforthSampler, order=3),
+    "dpmpp_2m": DPMSolverPP2MSampler,
+}
+
+
+def get_sampler(sampler: str | Sampler) -> Sampler:
+    if isinstance(sampler, Sampler):
+        return sampler
+    if sampler not in SAMPLERS:
+        raise ValueError(f"Unknown sampler {sampler}, choose one of {list(SAMPLERS)}")
+    return SAMPLERS[sampler]()
+
+
+def prepare_img_input(
+    img: Tensor,
+    img_cond: Tensor | None = None,
+    img_cond_seq: Tensor | None = None,
+) -> Tensor:
+    img_input = img
+    if img_cond is not None:
+        img_input = torch.cat((img, img_cond), dim=-1)
+    if img_cond_seq is not None:
+        img_input = torch.cat((img_input, img_cond_seq), dim=1)
+    return img_input
+
+
+def prepare_img_input_ids(
+    img_ids: Tensor,
+    img_cond_seq: Tensor | None = None,
+    img_cond_seq_ids: Tensor | None = None,
+) -> Tensor:
+    if img_cond_seq is None:
+        return img_ids
+    assert (
+        img_cond_seq_ids is not None
+    ), "You need to provide either both or neither of the sequence conditioning"
+    return torch.cat((img_ids, img_cond_seq_ids), dim=1)
+
+
 def denoise(
     model: Flux,
     # model input
@@ -316,7 +589,8 @@ def denoise(
     vec: Tensor,
     # sampling parameters
     timesteps: list[float],
-    guidance: float = 4.0,
+    # one value for the whole batch or one per sample
+    guidance: float | list[float] = 4.0,
     # extra img tokens (channel-wise)
     img_cond: Tensor | None = None,
     # extra img tokens (sequence-wise)
@@ -324,6 +598,20 @@ def denoise(
     img_cond_seq_ids: Tensor | None = None,
     compute_step_map: list[bool] | None = None,
     n_derivatives: int = 1,
+    # precomputed positional embedding or its RopeTable, e.g. from a PositionCache
+    pe: Tensor | RopeTable | None = None,
+    # compute the modulation vectors of all steps in one batched GEMM per layer
+    precompute_modulation: bool = False,
+    # decide online which steps to compute, replaces compute_step_map
+    step_policy: AdaptiveStepPolicy | None = None,
+    # forecast block features instead of the whole model output on approximated steps
+    feature_cache: BlockFeatureCache | None = None,
+    # how velocity predictions are integrated, a name from SAMPLERS or a Sampler instance
+    sampler: str | Sampler = "euler",
+    # called as step_callback(step, t_curr, img, pred) before every update, raise to stop early
+    step_callback: Callable[[int, float, Tensor, Tensor], None] | None = None,
+    # True for real text tokens, the padding within a T5 length bucket is not attended to
+    txt_mask: Tensor | None = None,
 ):
 
     # this is ignored for schnell
@@ -334,52 +622,84 @@ def denoise(
         assert len(compute_step_map) == num_steps, "compute_step_map must be the same length as timesteps"
     
 
-    order = n_derivatives + 1
-    taylor_seer_state = {
-        "dY_prev": [None] * order,
-        "dY_current": [None] * order,
-        "last_non_approximated_step": 0,
-        "current_step": 0,
-    }
+    taylor_seer_state = TaylorSeerState(n_derivatives)
+    sampler = get_sampler(sampler)
+    sampler.reset()
 
-    guidance_vec = torch.full((img.shape[0],), guidance, device=img.device, dtype=img.dtype)
+    if isinstance(guidance, (list, tuple)):
+        assert len(guidance) == img.shape[0], "guidance needs one value per sample"
+        guidance_vec = torch.tensor(guidance, device=img.device, dtype=img.dtype)
+    else:
+        guidance_vec = torch.full((img.shape[0],), guidance, device=img.device, dtype=img.dtype)
+    img_input_ids = prepare_img_input_ids(img_ids, img_cond_seq, img_cond_seq_ids)
+    # text projection, conditioning vector and positional embedding are the same for every step,
+    # TensorRT engines only expose the fused forward
+    static = None
+    if isinstance(model, Flux):
+        static = model.prepare_static(
+            img_ids=img_input_ids, txt=txt, txt_ids=txt_ids, y=vec, guidance=guidance_vec, pe=pe, txt_mask=txt_mask
+        )
+    elif txt_mask is not None:
+        raise ValueError("Masked text tokens need a Flux model, TensorRT engines are not supported.")
+
+    if step_policy is not None:
+        if static is None:
+            raise ValueError("Adaptive step skipping needs a Flux model, TensorRT engines are not supported.")
+        step_policy.reset(num_steps)
+    if feature_cache is not None and static is None:
+        raise ValueError("Block level TaylorSeer needs a Flux model, TensorRT engines are not supported.")
+
+    step_mods = {}
+    if precompute_modulation and static is not None:
+        # only the fully computed steps need modulation vectors, unknown upfront with a step policy
+        # and forecast blocks still apply the gates of every step
+        every_step = step_policy is not None or feature_cache is not None
+        compute_steps = [step for step, compute in enumerate(compute_step_map) if compute or every_step]
+        t_compute = torch.tensor([timesteps[step] for step in compute_steps], dtype=img.dtype, device=img.device)
+        step_mods = dict(zip(compute_steps, model.precompute_modulations(t_compute, static)))
     for current_step, (t_curr, t_prev) in enumerate(zip(timesteps[:-1], timesteps[1:])):
         
         t_vec = torch.full((img.shape[0],), t_curr, dtype=img.dtype, device=img.device)
-        img_input = img
-        img_input_ids = img_ids
-        if img_cond is not None:
-            img_input = torch.cat((img, img_cond), dim=-1)
-        if img_cond_seq is not None:
-            assert (
-                img_cond_seq_ids is not None
-            ), "You need to provide either both or neither of the sequence conditioning"
-            img_input = torch.cat((img_input, img_cond_seq), dim=1)
-            img_input_ids = torch.cat((img_input_ids, img_cond_seq_ids), dim=1)
+        img_input = prepare_img_input(img, img_cond, img_cond_seq)
         
-        if compute_step_map[current_step]:
-            pred = model(
-                img=img_input,
-                img_ids=img_input_ids,
-                txt=txt,
-                txt_ids=txt_ids,
-                y=vec,
-                timesteps=t_vec,
-                guidance=guidance_vec,
-            )
+        if step_policy is not None:
+            signal = model.step_signal(img_input, t_vec, static, mod=step_mods.get(current_step))
+            compute = step_policy.should_compute(current_step, signal)
+        else:
+            compute = compute_step_map[current_step]
 
-            taylor_seer_state['dY_prev'] = taylor_seer_state['dY_current']
-            taylor_seer_state['dY_current'] = approximate_derivative(pred, taylor_seer_state['dY_prev'], current_step, taylor_seer_state['last_non_approximated_step'])
-            taylor_seer_state['last_non_approximated_step'] = current_step
+        if feature_cache is not None:
+            feature_cache.begin_step(current_step, full=compute)
+            pred = model.step(
+                img=img_input, timesteps=t_vec, static=static, mod=step_mods.get(current_step), feature_cache=feature_cache
+            )
+            feature_cache.end_step()
+        elif compute:
+            if static is not None:
+                pred = model.step(img=img_input, timesteps=t_vec, static=static, mod=step_mods.get(current_step))
+            else:
+                pred = model(
+                    img=img_input,
+                    img_ids=img_input_ids,
+                    txt=txt,
+                    txt_ids=txt_ids,
+                    y=vec,
+                    timesteps=t_vec,
+                    guidance=guidance_vec,
+                )
+
+            taylor_seer_state.update(pred, current_step)
         else:
-            finite_difference_window = current_step - taylor_seer_state['last_non_approximated_step']
-            pred = approximate_value(taylor_seer_state['dY_current'], finite_difference_window)
+            pred = taylor_seer_state.forecast(current_step)
 
         
         if img_input_ids is not None:
             pred = pred[:, : img.shape[1]]
 
-        img = img + (t_prev - t_curr) * pred
+        if step_callback is not None:
+            step_callback(current_step, t_curr, img, pred)
+
+        img = sampler.step(img, pred, t_curr, t_prev)
 
     return img
 
@@ -0,0 +1,225 @@
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+
+import torch
+from torch import Tensor
+
+from .math import RopeTable
+from .model import Flux, StaticContext, StepModulation
+from .sampling import Sampler, get_sampler, prepare_img_input, prepare_img_input_ids
+from .taylor_seer_utils import TaylorSeerState
+
+
+@dataclass
+class DenoiseRequest:
+    """
+    A single denoising job. Tensors carry a batch dimension of 1, i.e. they are the
+    output of `prepare`/`prepare_kontext` with `bs=1`.
+    """
+
+    img: Tensor
+    img_ids: Tensor
+    txt: Tensor
+    txt_ids: Tensor
+    vec: Tensor
+    timesteps: list[float]
+    guidance: float = 4.0
+    img_cond: Tensor | None = None
+    img_cond_seq: Tensor | None = None
+    img_cond_seq_ids: Tensor | None = None
+    compute_step_map: list[bool] | None = None
+    n_derivatives: int = 1
+    pe: Tensor | RopeTable | None = None
+    txt_mask: Tensor | None = None
+    sampler: str | Sampler = "euler"
+    request_id: object = None
+
+    @property
+    def num_steps(self) -> int:
+        return len(self.timesteps) - 1
+
+
+@dataclass
+class _Row:
+    request: DenoiseRequest
+    img: Tensor
+    static: StaticContext
+    compute_step_map: list[bool]
+    taylor_seer_state: TaylorSeerState
+    sampler: Sampler
+    mods: dict[int, StepModulation] = field(default_factory=dict, repr=False)
+    step: int = 0
+    pred: Tensor | None = field(default=None, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.step >= self.request.num_steps
+
+
+def batch_key(request: DenoiseRequest) -> tuple:
+    """Requests can only share a forward pass if all their sequence shapes match."""
+    img_seq_len = request.img.shape[1]
+    if request.img_cond_seq is not None:
+        img_seq_len += request.img_cond_seq.shape[1]
+    channels = request.img.shape[2]
+    if request.img_cond is not None:
+        channels += request.img_cond.shape[2]
+    return (
+        img_seq_len,
+        channels,
+        tuple(request.txt.shape[1:]),
+        tuple(request.vec.shape[1:]),
+        request.img.dtype,
+        request.img.device,
+    )
+
+
+class ContinuousBatchScheduler:
+    """
+    Step-level continuous batching on top of `Flux.step`.
+
+    Requests are admitted into the in-flight batch at step boundaries and retired as
+    soon as their last step is done, so a long request does not hold back short ones
+    and new requests do not wait for the whole batch to drain. Every row carries its
+    own timestep, guidance value, `compute_step_map` position and TaylorSeer state;
+    only rows that need a full model evaluation on the current step are sent through
+    the transformer, the rest are extrapolated.
+
+    With `precompute_modulation`, the modulation vectors of a request's whole
+    schedule are computed at admission, see `Flux.precompute_modulations`.
+    """
+
+    def __init__(self, model: Flux, max_batch_size: int = 4, precompute_modulation: bool = False):
+        if max_batch_size < 1:
+            raise ValueError(f"max_batch_size must be at least 1, got {max_batch_size}")
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.precompute_modulation = precompute_modulation
+        self.pending: deque[DenoiseRequest] = deque()
+        self.active: list[_Row] = []
+        self._ids = itertools.count()
+
+    @property
+    def idle(self) -> bool:
+        return not self.pending and not self.active
+
+    def submit(self, request: DenoiseRequest) -> object:
+        if request.img.shape[0] != 1:
+            raise ValueError(f"Requests must have a batch size of 1, got {request.img.shape[0]}")
+        if request.compute_step_map is not None:
+            assert (
+                len(request.compute_step_map) == request.num_steps
+            ), "compute_step_map must be the same length as timesteps"
+        if request.request_id is None:
+            request.request_id = next(self._ids)
+        self.pending.append(request)
+        return request.request_id
+
+    def _admit(self) -> None:
+        if len(self.active) >= self.max_batch_size or not self.pending:
+            return
+
+        key = batch_key(self.active[0].request) if self.active else None
+        waiting = deque()
+        while self.pending:
+            request = self.pending.popleft()
+            if key is None:
+                key = batch_key(request)
+            if len(self.active) >= self.max_batch_size or batch_key(request) != key:
+                # keep arrival order for requests that can't join this batch yet
+                waiting.append(request)
+                continue
+
+            img_input_ids = prepare_img_input_ids(request.img_ids, request.img_cond_seq, request.img_cond_seq_ids)
+            guidance_vec = torch.full((1,), request.guidance, dtype=request.img.dtype, device=request.img.device)
+            static = self.model.prepare_static(
+                img_ids=img_input_ids,
+                txt=request.txt,
+                txt_ids=request.txt_ids,
+                y=request.vec,
+                guidance=guidance_vec,
+                pe=request.pe,
+                txt_mask=request.txt_mask,
+            )
+            sampler = get_sampler(request.sampler)
+            sampler.reset()
+            compute_step_map = request.compute_step_map or [True] * request.num_steps
+            mods = {}
+            if self.precompute_modulation:
+                compute_steps = [step for step, compute in enumerate(compute_step_map) if compute]
+                t_compute = torch.tensor(
+                    [request.timesteps[step] for step in compute_steps],
+                    dtype=request.img.dtype,
+                    device=request.img.device,
+                )
+                mods = dict(zip(compute_steps, self.model.precompute_modulations(t_compute, static)))
+            self.active.append(
+                _Row(
+                    request=request,
+                    img=request.img,
+                    static=static,
+                    compute_step_map=compute_step_map,
+                    taylor_seer_state=TaylorSeerState(request.n_derivatives),
+                    sampler=sampler,
+                    mods=mods,
+                )
+            )
+        self.pending = waiting
+
+    def _forward(self, rows: list[_Row]) -> Tensor:
+        img_input = torch.cat(
+            [prepare_img_input(row.img, row.request.img_cond, row.request.img_cond_seq) for row in rows]
+        )
+        t_vec = torch.tensor(
+            [row.request.timesteps[row.step] for row in rows], dtype=img_input.dtype, device=img_input.device
+        )
+        mod = None
+        if self.precompute_modulation:
+            mod = StepModulation.cat([row.mods.pop(row.step) for row in rows])
+        return self.model.step(
+            img=img_input,
+            timesteps=t_vec,
+            static=StaticContext.cat([row.static for row in rows]),
+            mod=mod,
+        )
+
+    def step(self) -> list[tuple[object, Tensor]]:
+        """
+        Admit what fits, advance every in-flight row by one denoising step and
+        return `(request_id, img)` for the rows that finished on this step.
+        """
+        self._admit()
+        if not self.active:
+            return []
+
+        compute_rows = [row for row in self.active if row.compute_step_map[row.step]]
+        if compute_rows:
+            preds = self._forward(compute_rows)
+            for row, pred in zip(compute_rows, preds.split(1)):
+                row.taylor_seer_state.update(pred, row.step)
+                row.pred = pred
+
+        for row in self.active:
+            if row.compute_step_map[row.step]:
+                pred = row.pred
+            else:
+                pred = row.taylor_seer_state.forecast(row.step)
+            row.pred = None
+
+            pred = pred[:, : row.img.shape[1]]
+            t_curr = row.request.timesteps[row.step]
+            t_prev = row.request.timesteps[row.step + 1]
+            row.img = row.sampler.step(row.img, pred, t_curr, t_prev)
+            row.step += 1
+
+        finished = [(row.request.request_id, row.img) for row in self.active if row.finished]
+        self.active = [row for row in self.active if not row.finished]
+        return finished
+
+    def run(self) -> dict[object, Tensor]:
+        """Step until every submitted request has finished."""
+        results = {}
+        while not self.idle:
+            results.update(self.step())
+        return results
@@ -0,0 +1,107 @@
+import json
+import math
+from pathlib import Path
+
+from .sampling import get_lin_function, get_schedule
+
+SCHEDULES_PATH = Path(__file__).parent / "schedules.json"
+
+# names that are computed rather than looked up in the registry
+DEFAULT_SCHEDULE = "default"
+
+
+def shift_timestep(t: float, image_seq_len: int) -> float:
+    """The resolution dependent shift of `get_schedule` for a single timestep."""
+    if t in (0.0, 1.0):
+        return t
+    mu = get_lin_function()(image_seq_len)
+    return math.exp(mu) / (math.exp(mu) + (1 / t - 1))
+
+
+def unshift_timestep(t: float, image_seq_len: int) -> float:
+    """Inverse of `shift_timestep`."""
+    if t in (0.0, 1.0):
+        return t
+    mu = get_lin_function()(image_seq_len)
+    return t / (t + math.exp(mu) * (1 - t))
+
+
+def load_schedules(path: str | Path = SCHEDULES_PATH) -> dict[str, dict[int, list[float]]]:
+    """
+    Read the registry, `{name: {num_steps: timesteps}}` with `num_steps + 1` timesteps each.
+    Timesteps are stored before the resolution shift, `get_named_schedule` shifts them for
+    the sequence length of the request like `get_schedule` does with its linear schedule.
+    """
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        raw = json.load(f)
+    return {name: {int(steps): timesteps for steps, timesteps in tables.items()} for name, tables in raw.items()}
+
+
+def validate_schedule(timesteps: list[float], num_steps: int) -> None:
+    if len(timesteps) != num_steps + 1:
+        raise ValueError(f"Expected {num_steps + 1} timesteps, got {len(timesteps)}")
+    if timesteps[0] != 1.0 or timesteps[-1] != 0.0:
+        raise ValueError(f"Schedules must run from 1.0 to 0.0, got {timesteps[0]} to {timesteps[-1]}")
+    if any(t_next >= t for t, t_next in zip(timesteps[:-1], timesteps[1:])):
+        raise ValueError("Timesteps must be strictly decreasing")
+
+
+def save_schedule(
+    name: str, timesteps: list[float], image_seq_len: int, path: str | Path = SCHEDULES_PATH
+) -> None:
+    """
+    Add or replace the `name` table for `len(timesteps) - 1` steps. `timesteps` are the
+    shifted ones used at `image_seq_len`, they are stored unshifted so that other
+    resolutions get their own shift.
+    """
+    if name == DEFAULT_SCHEDULE:
+        raise ValueError(f"'{DEFAULT_SCHEDULE}' is computed by get_schedule and can't be overwritten")
+    num_steps = len(timesteps) - 1
+    validate_schedule(timesteps, num_steps)
+
+    schedules = load_schedules(path)
+    schedules.setdefault(name, {})[num_steps] = [unshift_timestep(float(t), image_seq_len) for t in timesteps]
+    serialized = {
+        name: {str(steps): tables[steps] for steps in sorted(tables)} for name, tables in sorted(schedules.items())
+    }
+    with open(path, "w") as f:
+        json.dump(serialized, f, indent=2)
+        f.write("\n")
+
+
+def available_schedules(path: str | Path = SCHEDULES_PATH) -> dict[str, list[int]]:
+    """Step counts that have a stored table, per schedule name."""
+    return {name: sorted(tables) for name, tables in load_schedules(path).items()}
+
+
+def schedule_names(path: str | Path = SCHEDULES_PATH) -> list[str]:
+    """The default schedule and every stored schedule that has at least one table."""
+    return [DEFAULT_SCHEDULE] + [name for name, steps in available_schedules(path).items() if steps]
+
+
+def get_named_schedule(
+    name: str,
+    num_steps: int,
+    image_seq_len: int,
+    path: str | Path = SCHEDULES_PATH,
+) -> list[float]:
+    """
+    Timesteps of the `name` schedule for `num_steps` steps, shifted for `image_seq_len`.
+    Step counts without a stored table fall back to the shifted `get_schedule` default.
+    """
+    if name == DEFAULT_SCHEDULE:
+        return get_schedule(num_steps, image_seq_len, shift=True)
+
+    schedules = load_schedules(path)
+    if name not in schedules:
+        raise ValueError(f"Unknown schedule {name}, choose one of {[DEFAULT_SCHEDULE] + list(schedules)}")
+    if num_steps not in schedules[name]:
+        print(f"Schedule {name} has no table for {num_steps} steps, using the default schedule")
+        return get_schedule(num_steps, image_seq_len, shift=True)
+
+    timesteps = schedules[name][num_steps]
+    validate_schedule(timesteps, num_steps)
+    return [shift_timestep(t, image_seq_len) for t in timesteps]
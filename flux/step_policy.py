@@ -0,0 +1,61 @@
+from torch import Tensor
+
+
+class AdaptiveStepPolicy:
+    """
+    Online replacement for a fixed `compute_step_map`.
+
+    Before every step `denoise` hands over a cheap signal, the modulated input of the
+    first block (`Flux.step_signal`). The policy accumulates its relative L1 change
+    from step to step and only asks for a full model evaluation once the accumulated
+    change exceeds `threshold`; until then the TaylorSeer extrapolation is used. Edits
+    that barely move the latent skip many steps, hard ones skip few.
+
+    Args:
+        threshold: accumulated relative change that triggers a full evaluation,
+            higher values skip more steps
+        warmup_steps: number of leading steps that are always computed, TaylorSeer
+            needs a few real outputs to estimate derivatives
+        cooldown_steps: number of trailing steps that are always computed
+        max_skipped: maximum number of consecutive approximated steps
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.15,
+        warmup_steps: int = 3,
+        cooldown_steps: int = 2,
+        max_skipped: int = 3,
+    ):
+        self.threshold = threshold
+        self.warmup_steps = warmup_steps
+        self.cooldown_steps = cooldown_steps
+        self.max_skipped = max_skipped
+        self.reset(0)
+
+    def reset(self, num_steps: int) -> None:
+        self.num_steps = num_steps
+        self.computed_steps: list[int] = []
+        self.accumulated_change = 0.0
+        self.skipped = 0
+        self.prev_signal: Tensor | None = None
+
+    def should_compute(self, current_step: int, signal: Tensor) -> bool:
+        if self.prev_signal is not None:
+            change = (signal - self.prev_signal).abs().mean() / self.prev_signal.abs().mean().clamp(min=1e-6)
+            self.accumulated_change += change.item()
+        self.prev_signal = signal
+
+        compute = (
+            current_step < self.warmup_steps
+            or current_step >= self.num_steps - self.cooldown_steps
+            or self.skipped >= self.max_skipped
+            or self.accumulated_change >= self.threshold
+        )
+        if compute:
+            self.computed_steps.append(current_step)
+            self.accumulated_change = 0.0
+            self.skipped = 0
+        else:
+            self.skipped += 1
+        return compute
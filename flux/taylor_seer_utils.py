@@ -1,4 +1,6 @@
 import math
+
+import torch
         
 def approximate_derivative(Y, dY_prev, current_step, last_non_approximated_step):
     """
@@ -44,4 +46,158 @@ def approximate_value(dY_current, elapsed_steps):
     return output
 
 
+class TaylorSeerState:
+    """
+    Taylor expansion of a single feature, i.e. the in-place equivalent of
+    approximate_derivative and approximate_value
+
+    The derivative estimates live in `n_derivatives + 1` buffers that are allocated
+    once, on the first update, and then overwritten in place. Updates compute the
+    finite differences level by level through one scratch buffer, and forecasts
+    evaluate the Taylor polynomial in Horner form with one fused multiply-add per
+    order into a preallocated output buffer.
+
+    Args:
+        n_derivatives: number of derivatives to track, the order of the Taylor expansion
+    """
+
+    def __init__(self, n_derivatives: int = 1):
+        self.order = n_derivatives + 1
+        self.buffers = []
+        self.num_valid = 0
+        self.last_non_approximated_step = 0
+        self._scratch = None
+        self._out = None
+
+    def update(self, Y, current_step):
+        """
+        Record a fully computed value and refresh the derivative estimates
+
+        Args:
+            Y: current value of the feature, i.e. Y=f(X) where f could be a transformer or linear layer
+            current_step: index of the denoising step that produced Y
+        """
+        if not self.buffers:
+            self.buffers = [torch.empty_like(Y) for _ in range(self.order)]
+            self._scratch = torch.empty_like(Y)
+            self._out = torch.empty_like(Y)
+
+        if self.num_valid == 0 or current_step <= 1 or self.order == 1:
+            self.buffers[0].copy_(Y)
+            self.num_valid = 1
+        else:
+            finite_difference_window = current_step - self.last_non_approximated_step
+            # equation (7) from the paper, the first difference goes into the scratch buffer
+            scratch = torch.sub(Y, self.buffers[0], out=self._scratch)
+            scratch.div_(finite_difference_window)
+            self.buffers[0].copy_(Y)
+            num_valid = 1
+            for i in range(1, self.order):
+                if i >= self.num_valid or i == self.order - 1:
+                    # no previous estimate to difference against, or the highest order we track
+                    self.buffers[i], scratch = scratch, self.buffers[i]
+                    num_valid = i + 1
+                    break
+                # overwrite the previous estimate with the next order difference, then swap
+                # so buffers[i] holds the new estimate and scratch the next order
+                self.buffers[i].sub_(scratch).div_(-finite_difference_window)
+                self.buffers[i], scratch = scratch, self.buffers[i]
+            self._scratch = scratch
+            self.num_valid = num_valid
+
+        self.last_non_approximated_step = current_step
+
+    def forecast(self, current_step):
+        """
+        Extrapolate the value at current_step. The result is a buffer that is reused by
+        the next call, consume it before forecasting again.
+
+        Args:
+            current_step: index of the denoising step to approximate
+        """
+        if self.num_valid == 0:
+            raise RuntimeError("TaylorSeerState needs at least one update before it can forecast")
+        if self.num_valid == 1:
+            return self.buffers[0]
+
+        elapsed_steps = current_step - self.last_non_approximated_step
+        # d0 + w * (d1 + w / 2 * (d2 + w / 3 * (...)))
+        out = self._out.copy_(self.buffers[self.num_valid - 1])
+        for i in range(self.num_valid - 2, -1, -1):
+            torch.add(self.buffers[i], out, alpha=elapsed_steps / (i + 1), out=out)
+        return out
+
+
+class BlockFeatureCache:
+    """
+    TaylorSeer at the level of individual transformer blocks
+
+    On fully computed steps every block records its attention and MLP outputs. On
+    approximated steps the first `first_blocks` and last `last_blocks` blocks still run,
+    all others forecast their outputs from the Taylor expansion of the recorded features
+    and only apply the (cheap) modulation gates of the current step.
+
+    `begin_step` and `end_step` run outside the compiled `Flux.step`: the first decides
+    which blocks run and forecasts the features of the others, the second folds the
+    features recorded on a full step into their expansions. Inside the step the blocks
+    only read `computed` and `forecasts` and add to `recorded`, so the compiled graph is
+    not split per block, with one variant for full and one for approximated steps.
+
+    Memory: every forecast feature keeps `n_derivatives + 3` tensors of its size, the
+    derivative estimates, a scratch and a forecast buffer. For a 1024x1024 Kontext
+    request with 512 text tokens the features of all blocks are about 4 GB in bf16,
+    so 16 GB on top of the model with `n_derivatives=1` and 24 GB with 3. The features
+    recorded on a full step add one more set until `end_step`.
+
+    Args:
+        num_blocks: total number of double and single stream blocks
+        n_derivatives: order of the Taylor expansion
+        first_blocks: number of leading blocks that always run
+        last_blocks: number of trailing blocks that always run
+    """
+
+    def __init__(self, num_blocks: int, n_derivatives: int = 1, first_blocks: int = 1, last_blocks: int = 1):
+        self.num_blocks = num_blocks
+        self.n_derivatives = n_derivatives
+        self.first_blocks = first_blocks
+        self.last_blocks = last_blocks
+        self.states = {}
+        self.current_step = 0
+        self.full = True
+        self.computed = (True,) * num_blocks
+        self.forecasts = {}
+        self.recorded = {}
+
+    def always_computes(self, block_index):
+        return block_index < self.first_blocks or block_index >= self.num_blocks - self.last_blocks
+
+    def begin_step(self, current_step, full):
+        self.current_step = current_step
+        self.full = full
+        self.computed = tuple(full or self.always_computes(i) for i in range(self.num_blocks))
+        self.forecasts = {}
+        if not full:
+            # each state forecasts into its own buffer, all of them stay valid for this step
+            self.forecasts = {
+                key: state.forecast(current_step) for key, state in self.states.items() if not self.computed[key[0]]
+            }
+        self.recorded = {}
+
+    def end_step(self):
+        for key, Y in self.recorded.items():
+            if key not in self.states:
+                self.states[key] = TaylorSeerState(self.n_derivatives)
+            self.states[key].update(Y, self.current_step)
+        self.recorded = {}
+        self.forecasts = {}
+
+    def computes(self, block_index):
+        return self.computed[block_index]
+
+    def record(self, key, Y):
+        # blocks that always run are never forecast, their features are not needed
+        if self.full and not self.always_computes(key[0]):
+            self.recorded[key] = Y
 
+    def forecast(self, key):
+        return self.forecasts[key]
@@ -11,6 +11,7 @@ from huggingface_hub import hf_hub_download, login
 # from imwatermark import WatermarkEncoder
 from PIL import ExifTags, Image
 from safetensors.torch import load_file as load_sft
+from safetensors.torch import save_file
 
 from flux.model import Flux, FluxLoraWrapper, FluxParams
 from flux.modules.autoencoder import AutoEncoder, AutoEncoderParams
@@ -670,6 +671,16 @@ def load_flow_model(name: str, device: str | torch.device = "cuda", verbose: boo
     return model
 
 
+def save_fp8_checkpoint(model: Flux, path: str | Path) -> None:
+    """
+    Save `model` with its F8Linear layers as they are after quantization: `float8_data`,
+    `scale`, `scale_reciprocal` and calibrated `input_scale`s instead of bf16 weights.
+    Loading the file into a fresh model with `load_state_dict` skips `quantize_weight`.
+    """
+    sd = {key: tensor.contiguous() for key, tensor in model.state_dict().items()}
+    save_file(sd, str(path), metadata={"format": "flux-fp8"})
+
+
 def load_t5(device: str | torch.device = "cuda", max_length: int = 512, t5_path: str = "./models/t5") -> HFEmbedder:
     # max length 64, 128, 256 and 512 should work (if your sequence is short enough)
     return HFEmbedder(t5_path, max_length=max_length, torch_dtype=torch.bfloat16).to(device)
@@ -0,0 +1,161 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pybase64
+import torch
+from PIL import Image
+from torch import Tensor
+
+try:
+    if os.name == "nt":
+        raise ImportError
+    from cog import Path  # type: ignore
+except Exception:  # pragma: no cover - fallback for non-cog environments
+    from pathlib import Path
+
+OUTPUT_MODES = ["file", "bytes", "data_url"]
+MIME_TYPES = {"webp": "image/webp", "jpg": "image/jpeg", "png": "image/png"}
+
+
+class OutputPipeline:
+    """
+    Turns decoder outputs into encoded images.
+
+    The conversion to uint8 runs on the device. Each image is copied asynchronously
+    into a pinned staging buffer that is reused across calls, and its encode job on
+    the thread pool waits for that copy only. The first image is encoding while the
+    others are still copying. Outputs are either written to a file with a unique name
+    in the directory of the current request, or returned in memory as the encoded bytes
+    or a base64 data URL. `begin_request` starts a new directory under `output_dir`,
+    the system temp dir by default, and removes the previous one, so a long-running
+    worker keeps the files of one request only.
+    """
+
+    def __init__(self, max_workers: int = 4, output_dir: str | None = None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="output")
+        self.output_dir = output_dir
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        self.request_dir: str | None = None
+        self._staging: list[Tensor] = []
+        self._lock = threading.Lock()
+
+    def begin_request(self) -> None:
+        """
+        New directory for the files of the next request. Cog runs one prediction at a
+        time and has uploaded the files of the previous one by now, its directory is removed.
+        """
+        previous, self.request_dir = self.request_dir, tempfile.mkdtemp(prefix="outputs-", dir=self.output_dir)
+        if previous is not None:
+            shutil.rmtree(previous, ignore_errors=True)
+
+    def _check_mode(self, output_mode: str) -> None:
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode {output_mode}, choose one of {OUTPUT_MODES}")
+        # files written without begin_request still go into a directory that the next request removes
+        if output_mode == "file" and self.request_dir is None:
+            self.begin_request()
+
+    def _acquire(self, numel: int) -> tuple[Tensor, Tensor]:
+        """A staging buffer of at least `numel` bytes and a view of its first `numel`."""
+        with self._lock:
+            for i, buffer in enumerate(self._staging):
+                if buffer.numel() >= numel:
+                    buffer = self._staging.pop(i)
+                    return buffer, buffer[:numel]
+        buffer = torch.empty(numel, dtype=torch.uint8, pin_memory=torch.cuda.is_available())
+        return buffer, buffer
+
+    def _release(self, buffer: Tensor) -> None:
+        with self._lock:
+            self._staging.append(buffer)
+
+    @staticmethod
+    def _encode(image: Image.Image, output_format: str, output_quality: int) -> bytes:
+        f = io.BytesIO()
+        if output_format == "png":
+            image.save(f, format="PNG")
+        elif output_format == "webp":
+            image.save(f, format="WEBP", quality=output_quality, optimize=True)
+        else:  # jpg
+            image.save(f, format="JPEG", quality=output_quality, optimize=True)
+        return f.getvalue()
+
+    def _output(self, image: Image.Image, output_format: str, output_quality: int, output_mode: str):
+        data = self._encode(image, output_format, output_quality)
+        if output_mode == "bytes":
+            return data
+        if output_mode == "data_url":
+            return f"data:{MIME_TYPES[output_format]};base64,{pybase64.b64encode(data).decode()}"
+
+        fd, output_path = tempfile.mkstemp(prefix="output-", suffix=f".{output_format}", dir=self.request_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return Path(output_path)
+
+    def _output_staged(
+        self,
+        host: Tensor,
+        copied: torch.cuda.Event | None,
+        output_format: str,
+        output_quality: int,
+        output_mode: str,
+    ):
+        if copied is not None:
+            copied.synchronize()
+        # fromarray copies the RGB data, the staging buffer can be reused afterwards
+        return self._output(Image.fromarray(host.numpy()), output_format, output_quality, output_mode)
+
+    def encode_decoded(
+        self,
+        x: Tensor,
+        output_format: str,
+        output_quality: int,
+        output_mode: str = "file",
+    ) -> list[Path | bytes | str]:
+        """
+        Encode a (batch, 3, height, width) decoder output in [-1, 1] like `encode`, through
+        the staging buffer. Each image's encode job starts as soon as its own copy is done.
+        """
+        self._check_mode(output_mode)
+        x = ((x.clamp(-1, 1) + 1) * 127.5).to(torch.uint8)
+        x = x.permute(0, 2, 3, 1).contiguous()
+
+        buffer, view = self._acquire(x.numel())
+        host = view.view(x.shape)
+        futures = []
+        try:
+            for image, staged in zip(x, host):
+                staged.copy_(image, non_blocking=x.is_cuda)
+                copied = None
+                if x.is_cuda:
+                    copied = torch.cuda.Event()
+                    copied.record()
+                futures.append(
+                    self.executor.submit(
+                        self._output_staged, staged, copied, output_format, output_quality, output_mode
+                    )
+                )
+            return [future.result() for future in futures]
+        finally:
+            wait(futures)
+            self._release(buffer)
+
+    def encode(
+        self,
+        images: list[Image.Image],
+        output_format: str,
+        output_quality: int,
+        output_mode: str = "file",
+    ) -> list[Path | bytes | str]:
+        """Encode `images` concurrently, see `OUTPUT_MODES` for what is returned per image."""
+        self._check_mode(output_mode)
+        futures = [
+            self.executor.submit(self._output, image, output_format, output_quality, output_mode)
+            for image in images
+        ]
+        return [future.result() for future in futures]
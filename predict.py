@@ -2,6 +2,8 @@ import os
 import time
 import torch
 import gc
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Iterator
 from PIL import Image
 from cog import BasePredictor, Input
 
@@ -12,24 +14,38 @@ try:
 except Exception:  # pragma: no cover - fallback for non-cog environments
     from pathlib import Path
 
-from flux.sampling import denoise, get_schedule, prepare_kontext, unpack
+from flux.encoding import EncodingStage
+from flux.sampling import SAMPLERS, denoise, unpack
+from flux.schedules import DEFAULT_SCHEDULE, get_named_schedule
 from flux.util import (
     configs,
     load_clip,
     load_t5
 )
 from flux.model import Flux
+from flux.preview import PreviewStreamer
 from flux.modules.autoencoder import AutoEncoder
+from flux.modules.float8_linear import load_input_scales
+from flux.quantization import QuantizationPolicy, finish_quantization, load_policy, prepare_quantization
 from safetensors.torch import load_file as load_sft
-from safety_checker import SafetyChecker
+from output_pipeline import OUTPUT_MODES, OutputPipeline
+from safety_checker import EarlySafetyCheck, SafetyChecker
 from util import print_timing, generate_compute_step_map
 from weights import download_weights
 
-from flux.util import ASPECT_RATIOS
+from flux.util import ASPECT_RATIOS, PREFERED_KONTEXT_RESOLUTIONS
+from flux.latent_cache import ConditioningLatentCache
+from flux.math import select_attention_backend
+from flux.position_cache import PositionCache
+from flux.prompt_cache import PromptEmbeddingCache
+from flux.step_policy import AdaptiveStepPolicy
+from flux.taylor_seer_utils import BlockFeatureCache
 
 # Kontext model configuration
 KONTEXT_WEIGHTS_URL = "https://weights.replicate.delivery/default/black-forest-labs/kontext/release-candidate/kontext-dev.sft"
 KONTEXT_WEIGHTS_PATH = "./models/kontext/kontext-dev.sft"
+# pre-quantized version written by convert_fp8_checkpoint.py, loaded instead when it exists
+KONTEXT_FP8_WEIGHTS_PATH = "./models/kontext/kontext-dev-fp8.safetensors"
 AE_WEIGHTS_URL = "https://weights.replicate.delivery/default/black-forest-labs/FLUX.1-dev/safetensors/ae.safetensors"
 AE_WEIGHTS_PATH = "./models/flux-dev/ae.safetensors"
 T5_WEIGHTS_URL = "https://weights.replicate.delivery/default/official-models/flux/t5/t5-v1_1-xxl.tar"
@@ -38,6 +54,25 @@ CLIP_URL = "https://weights.replicate.delivery/default/official-models/flux/clip
 CLIP_PATH = "./models/clip"
 
 TORCH_COMPILE_CACHE = "./torch-compile-cache-flux-dev-kontext.bin"
+# set to a directory to keep prompt embeddings across restarts
+PROMPT_CACHE_DIR = os.environ.get("PROMPT_CACHE_DIR")
+# same for the encoded conditioning images
+LATENT_CACHE_DIR = os.environ.get("LATENT_CACHE_DIR")
+# fraction of the denoising time preview generation may add to the critical path
+PREVIEW_TIME_BUDGET = float(os.environ.get("PREVIEW_TIME_BUDGET", "0.05"))
+# allowed guidance scales, for the guidance input and every per_output_guidance value
+GUIDANCE_RANGE = (0.0, 10.0)
+# comma separated T5 lengths, e.g. "64,128,256,512", to trim the padded text tokens to.
+# Off by default, masking the padding changes the outputs slightly, see evaluate_txt_buckets.py
+T5_LENGTH_BUCKETS = os.environ.get("T5_LENGTH_BUCKETS", "")
+# "1" builds the joint attention inputs without concatenation, see benchmark_concat_free.py
+CONCAT_FREE_BLOCKS = os.environ.get("CONCAT_FREE_BLOCKS", "0") == "1"
+# static FP8 input scales written by calibrate_fp8.py, used if the file exists. Set it to an
+# empty string to compute the scales from every input again
+FP8_INPUT_SCALES_PATH = os.environ.get("FP8_INPUT_SCALES_PATH", "./models/kontext/kontext-dev.input_scales.safetensors")
+# JSON or YAML quantization method per linear, or "bf16", see scan_quantization.py. Unset keeps the
+# checkpoint's layout. A policy is applied to the bf16 weights, the pre-quantized checkpoint is not used
+QUANTIZATION_POLICY = os.environ.get("QUANTIZATION_POLICY", "")
 
 class FluxDevKontextPredictor(BasePredictor):
     """
@@ -65,7 +100,13 @@ class FluxDevKontextPredictor(BasePredictor):
         print(f"Loaded clip in {time.time() - st} seconds")
 
         st = time.time()
-        self.model = load_kontext_model(device=cpu).to(self.device)
+        policy = load_policy(QUANTIZATION_POLICY) if QUANTIZATION_POLICY else None
+        self.model = load_kontext_model(device=cpu, policy=policy).to(self.device)
+        if policy is not None:
+            methods = finish_quantization(self.model, policy)
+            counts = {method: list(methods.values()).count(method) for method in sorted(set(methods.values()))}
+            print(f"Quantization policy {policy.name}: {counts}")
+        self.model.set_concat_free(CONCAT_FREE_BLOCKS)
         gc.collect()
         print(f"Loaded kontext model in {time.time() - st} seconds")
 
@@ -75,13 +116,45 @@ class FluxDevKontextPredictor(BasePredictor):
         print(f"Loaded ae in {time.time() - st} seconds")
 
         st = time.time()
-        self.model = torch.compile(self.model, dynamic=True)
+        self.position_cache = PositionCache(self.model.pe_embedder, self.device)
+        resolutions = set(PREFERED_KONTEXT_RESOLUTIONS)
+        resolutions.update(size for size in ASPECT_RATIOS.values() if size != (None, None))
+        self.position_cache.warmup(sorted(resolutions), txt_len=self.t5.max_length)
+        print(f"Cached positional embeddings in {time.time() - st} seconds")
+
+        # probe the attention kernels before torch.compile traces them
+        attention = select_attention_backend(self.device, torch.bfloat16).name
+        if T5_LENGTH_BUCKETS:
+            attention += f", {select_attention_backend(self.device, torch.bfloat16, masked=True).name} with masks"
+        print(f"Attention backend: {attention}")
+
+        self.prompt_cache = PromptEmbeddingCache(self.t5, self.clip, disk_dir=PROMPT_CACHE_DIR)
+        self.latent_cache = ConditioningLatentCache(self.device, disk_dir=LATENT_CACHE_DIR)
+        self.encoding_stage = EncodingStage(
+            self.t5,
+            self.clip,
+            self.ae,
+            self.device,
+            position_cache=self.position_cache,
+            prompt_cache=self.prompt_cache,
+            latent_cache=self.latent_cache,
+            txt_buckets=tuple(int(length) for length in T5_LENGTH_BUCKETS.split(",")) if T5_LENGTH_BUCKETS else None,
+        )
+
+        st = time.time()
+        # denoise calls prepare_static once per request and step once per denoising step,
+        # only the per-step path needs to be compiled
+        self.model.step = torch.compile(self.model.step, dynamic=True)
 
-        # Initialize safety checker
-        self.safety_checker = SafetyChecker()
+        self.output_pipeline = OutputPipeline()
+        # denoises while predict streams previews
+        self.denoise_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="denoise")
+
+        # Initialize safety checker, its models load on the first checked image
+        self.safety_checker = SafetyChecker(self.device)
         print("Compiling model with torch.compile...")
         start_time = time.time()
-        self.predict(
+        for _ in self.predict(
             prompt="Make the hair blue",
             input_image=Path("lady.png"),
             aspect_ratio="1:1",
@@ -92,7 +165,17 @@ class FluxDevKontextPredictor(BasePredictor):
             output_quality=100,
             disable_safety_checker=True,
             go_fast=True,
-        )
+            acceleration_level="default",
+            adaptive_threshold=0.15,
+            taylor_seer_scope="model",
+            taylor_seer_order=1,
+            sampler="euler",
+            early_safety_check=False,
+            num_outputs=1,
+            per_output_guidance="",
+            preview_every=0,
+        ):
+            pass
         print(f"Compiled in {time.time() - start_time} seconds")
         print("FluxDevKontextPredictor setup complete")
 
@@ -119,7 +202,7 @@ class FluxDevKontextPredictor(BasePredictor):
             description="Number of inference steps", default=28, ge=4, le=50
         ),
         guidance: float = Input(
-            description="Guidance scale for generation", default=2.5, ge=0.0, le=10.0
+            description="Guidance scale for generation", default=2.5, ge=GUIDANCE_RANGE[0], le=GUIDANCE_RANGE[1]
         ),
         seed: int = Input(
             description="Random seed for reproducible generation. Leave blank for random.",
@@ -143,91 +226,254 @@ class FluxDevKontextPredictor(BasePredictor):
             description="Make the model go fast, output quality may be slightly degraded for more difficult prompts",
             default=True,
         ),
-    ) -> Path:
+        acceleration_level: str = Input(
+            description="Step skipping strategy. 'default' follows go_fast, 'adaptive' decides per step whether the full model is needed based on how much the input changed, the other levels use a fixed pattern",
+            choices=["default", "none", "go fast", "go really fast", "adaptive"],
+            default="default",
+        ),
+        adaptive_threshold: float = Input(
+            description="Only used with acceleration_level 'adaptive'. Higher values skip more steps",
+            default=0.15,
+            ge=0.0,
+            le=1.0,
+        ),
+        taylor_seer_scope: str = Input(
+            description="What skipped steps approximate. 'model' extrapolates the whole model output, 'block' extrapolates the attention and MLP outputs of the inner transformer blocks while the first and last block still run. 'block' keeps 16-24 GB of features per image and only works with num_outputs 1",
+            choices=["model", "block"],
+            default="model",
+        ),
+        taylor_seer_order: int = Input(
+            description="Order of the Taylor expansion used on skipped steps", default=1, ge=1, le=3
+        ),
+        sampler: str = Input(
+            description="ODE solver used to integrate the velocity predictions. 'ab2', 'ab3' and 'dpmpp_2m' are higher order multistep solvers that reuse previous predictions and keep more quality at low step counts",
+            choices=list(SAMPLERS.keys()),
+            default="euler",
+        ),
+        early_safety_check: bool = Input(
+            description="Also run the safety checker on a cheap preview halfway through denoising and stop early if it is flagged. Ignored when the safety checker is disabled",
+            default=False,
+        ),
+        num_outputs: int = Input(
+            description="Number of images to generate. They share the encoded prompt and input image and are denoised as one batch, output i uses seed + i",
+            default=1,
+            ge=1,
+            le=4,
+        ),
+        per_output_guidance: str = Input(
+            description="Optional comma separated guidance scale for every output, e.g. '2.0,2.5,3.0,3.5', each from 0 to 10. Overrides guidance",
+            default="",
+        ),
+        preview_every: int = Input(
+            description="Stream a low resolution preview every this many steps before the final image, 0 disables previews. Previews are a cheap approximation, not decoded images",
+            default=0,
+            ge=0,
+            le=50,
+        ),
+    ) -> Iterator[Path]:
+        """
+        Generate an image based on the text prompt and conditioning image using FLUX.1 Kontext.
+        Yields the previews, if any, and then the final images.
         """
-        Generate an image based on the text prompt and conditioning image using FLUX.1 Kontext
+        # the cog output schema only has files, in-process callers can get bytes or data URLs
+        # from generate_outputs. The schedule registry ships without tuned tables, so predict
+        # has no schedule input yet and uses the default schedule
+        yield from self.generate_outputs(
+            "file",
+            prompt=prompt,
+            input_image=input_image,
+            aspect_ratio=aspect_ratio,
+            num_inference_steps=num_inference_steps,
+            guidance=guidance,
+            seed=seed,
+            output_format=output_format,
+            output_quality=output_quality,
+            disable_safety_checker=disable_safety_checker,
+            go_fast=go_fast,
+            acceleration_level=acceleration_level,
+            adaptive_threshold=adaptive_threshold,
+            taylor_seer_scope=taylor_seer_scope,
+            taylor_seer_order=taylor_seer_order,
+            sampler=sampler,
+            schedule=DEFAULT_SCHEDULE,
+            early_safety_check=early_safety_check,
+            num_outputs=num_outputs,
+            per_output_guidance=per_output_guidance,
+            preview_every=preview_every,
+        )
+
+    def generate_outputs(
+        self,
+        output_mode: str,
+        prompt: str,
+        input_image: Path,
+        aspect_ratio: str,
+        num_inference_steps: int,
+        guidance: float,
+        seed: int | None,
+        output_format: str,
+        output_quality: int,
+        disable_safety_checker: bool,
+        go_fast: bool,
+        acceleration_level: str,
+        adaptive_threshold: float,
+        taylor_seer_scope: str,
+        taylor_seer_order: int,
+        sampler: str,
+        schedule: str,
+        early_safety_check: bool,
+        num_outputs: int,
+        per_output_guidance: str,
+        preview_every: int,
+    ) -> Iterator[Path | bytes | str]:
         """
-        with torch.inference_mode(), print_timing("generate image"):
+        `predict` with the outputs returned as `output_mode`, see `OUTPUT_MODES`: files, the
+        encoded bytes or base64 data URLs. Every input has to be passed, `schedule` is a name
+        of `flux.schedules.schedule_names`.
+        """
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode {output_mode}, choose one of {OUTPUT_MODES}")
+        if output_mode == "file":
+            # removes the files of the previous request, cog has uploaded them
+            self.output_pipeline.begin_request()
+        # inference mode only around the work between yields, it must not stay on in the
+        # caller's thread while the generator is suspended
+        with print_timing("generate image"):
             seed = prepare_seed(seed)
+            seeds = [seed + i for i in range(num_outputs)]
+
+            if taylor_seer_scope == "block" and num_outputs > 1:
+                # the block features grow with the batch, 4 outputs would need 64-96 GB on top of the model
+                raise ValueError(
+                    f"taylor_seer_scope 'block' only supports num_outputs 1, got {num_outputs}. "
+                    "Use taylor_seer_scope 'model' to generate several outputs"
+                )
+
+            if per_output_guidance:
+                guidance = parse_per_output_guidance(per_output_guidance, num_outputs)
 
             if aspect_ratio == "match_input_image":
                 target_width, target_height = None, None
             else:
                 target_width, target_height = ASPECT_RATIOS[aspect_ratio]
 
-            # Prepare input for kontext sampling
-            inp, final_height, final_width = prepare_kontext(
-                t5=self.t5,
-                clip=self.clip,
-                prompt=prompt,
-                ae=self.ae,
-                img_cond_path=str(input_image),
-                target_width=target_width,
-                target_height=target_height,
-                bs=1,
-                seed=seed,
-                device=self.device,
-            )
-            
-            if go_fast:
-                compute_step_map = generate_compute_step_map("go really fast", num_inference_steps)
+            # Prepare input for kontext sampling, the text and image encoders run concurrently
+            with torch.inference_mode():
+                inp, final_height, final_width = self.encoding_stage(
+                    prompt=prompt,
+                    img_cond_path=str(input_image),
+                    target_width=target_width,
+                    target_height=target_height,
+                    seed=seeds if num_outputs > 1 else seed,
+                )
+            print(f"Encoding: {self.encoding_stage.format_timings()}")
+            print(f"Prompt cache: {self.prompt_cache.stats}")
+            print(f"Conditioning latent cache: {self.latent_cache.stats}")
+
+            if acceleration_level == "default":
+                acceleration_level = "go really fast" if go_fast else "none"
+
+            step_policy = None
+            if acceleration_level == "adaptive":
+                step_policy = AdaptiveStepPolicy(threshold=adaptive_threshold)
+                compute_step_map = None
             else:
-                compute_step_map = generate_compute_step_map("none", num_inference_steps)
+                compute_step_map = generate_compute_step_map(acceleration_level, num_inference_steps)
+
+            feature_cache = None
+            if taylor_seer_scope == "block":
+                feature_cache = BlockFeatureCache(
+                    num_blocks=len(self.model.double_blocks) + len(self.model.single_blocks),
+                    n_derivatives=taylor_seer_order,
+                )
 
             # Remove the original conditioning image from memory to save space
             inp.pop("img_cond_orig", None)
 
-            # Get sampling schedule
-            timesteps = get_schedule(
-                num_inference_steps,
-                inp["img"].shape[1],
-                shift=True,  # flux-dev uses shift=True
-            )
-
-            # Generate image
-            x = denoise(self.model, **inp, timesteps=timesteps, guidance=guidance, compute_step_map=compute_step_map)
-
-            # Decode latents to pixel space
-            x = unpack(x.float(), final_height, final_width)
-            with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
-                x = self.ae.decode(x)
-
-            # Convert to image
-            x = x.clamp(-1, 1)
-            x = (x + 1) / 2
-            x = (x.permute(0, 2, 3, 1) * 255).to(torch.uint8).cpu().numpy()
-            image = Image.fromarray(x[0])
-
-            # Apply safety checking
-            if not disable_safety_checker:
-                images = self.safety_checker.filter_images([image])
-                if not images:
-                    raise Exception(
-                        "Generated image contained NSFW content. Try running it again with a different prompt."
-                    )
-                image = images[0]
-
-            # Save image
-            output_path = f"output.{output_format}"
-            if output_format == "png":
-                image.save(output_path)
-            elif output_format == "webp":
-                image.save(
-                    output_path, format="WEBP", quality=output_quality, optimize=True
+            callbacks = []
+            if early_safety_check and not disable_safety_checker:
+                callbacks.append(
+                    EarlySafetyCheck(self.safety_checker, num_inference_steps, final_height, final_width)
                 )
-            else:  # jpg
-                image.save(
-                    output_path, format="JPEG", quality=output_quality, optimize=True
+            streamer = None
+            if preview_every > 0:
+                streamer = PreviewStreamer(final_height, final_width, preview_every, PREVIEW_TIME_BUDGET)
+                callbacks.append(streamer)
+
+            def step_callback(*args):
+                for callback in callbacks:
+                    callback(*args)
+
+            # Get sampling schedule, the default one uses shift=True like flux-dev
+            timesteps = get_named_schedule(schedule, num_inference_steps, inp["img"].shape[1])
+
+            @torch.inference_mode()
+            def generate():
+                # Generate image
+                x = denoise(
+                    self.model,
+                    **inp,
+                    timesteps=timesteps,
+                    guidance=guidance,
+                    compute_step_map=compute_step_map,
+                    n_derivatives=taylor_seer_order,
+                    precompute_modulation=True,
+                    step_policy=step_policy,
+                    feature_cache=feature_cache,
+                    sampler=sampler,
+                    step_callback=step_callback if callbacks else None,
                 )
+                if step_policy is not None:
+                    print(
+                        f"Computed {len(step_policy.computed_steps)} of {num_inference_steps} steps: "
+                        f"{step_policy.computed_steps}"
+                    )
+
+                # Decode latents to pixel space
+                x = unpack(x.float(), final_height, final_width)
+                with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16):
+                    return self.ae.decode(x)
 
-            # Return the output path
-            return Path(output_path)
+            if streamer is None:
+                x = generate()
+            else:
+                # denoise on a worker thread and stream the previews from this one
+                job = self.denoise_executor.submit(generate)
+                try:
+                    show_previews = True
+                    for _, preview, images in streamer.stream(job):
+                        # previews are not covered by the final check, stop showing them once one is flagged
+                        if show_previews and not disable_safety_checker:
+                            with torch.inference_mode():
+                                show_previews = not any(self.safety_checker.check(preview))
+                        if show_previews:
+                            yield self.output_pipeline.encode(images[:1], output_format, output_quality, output_mode)[0]
+                finally:
+                    # the client went away or the denoise failed, stop it before returning. The
+                    # preview worker is only shut down once no step can submit to it anymore
+                    streamer.cancel()
+                    wait([job])
+                    streamer.close()
+                print(f"Skipped {streamer.skipped} previews to stay within the time budget")
+                x = job.result()
+
+            with torch.inference_mode():
+                # Apply safety checking on the decoder output, before it leaves the GPU
+                if not disable_safety_checker:
+                    x = x[self.safety_checker.filter(x)]
+
+                # Copy to the host through a pinned staging buffer and encode on the output thread pool,
+                # files go into the directory of this request
+                outputs = self.output_pipeline.encode_decoded(x, output_format, output_quality, output_mode)
+            yield from outputs
 
 
 def download_model_weights():
     """Download all required model weights if they don't exist"""
     # Download kontext weights
-    if not os.path.exists(KONTEXT_WEIGHTS_PATH):
+    if os.path.exists(KONTEXT_FP8_WEIGHTS_PATH) and not QUANTIZATION_POLICY:
+        print("Pre-quantized kontext weights exist")
+    elif not os.path.exists(KONTEXT_WEIGHTS_PATH):
         print("Kontext weights not found, downloading...")
         download_weights(KONTEXT_WEIGHTS_URL, Path(KONTEXT_WEIGHTS_PATH))
         print("Kontext weights downloaded successfully")
@@ -257,18 +503,27 @@ def download_model_weights():
         print("CLIP weights already exist")
 
 
-def load_kontext_model(device: str | torch.device = "cuda"):
-    """Load the kontext model with complete transformer weights"""
+def load_kontext_model(device: str | torch.device = "cuda", policy: QuantizationPolicy | None = None):
+    """
+    Load the kontext model with complete transformer weights. With a `policy` its linears are
+    swapped before loading, call `finish_quantization` once the model is on its device.
+    """
     # Use flux-dev config as base for kontext model
     config = configs["flux-dev"]
 
     print("Loading kontext model...")
     with torch.device("meta"):
         model = Flux(config.params).to(torch.bfloat16)
-
-    # Load kontext weights (complete transformer)
-    print(f"Loading kontext weights from {KONTEXT_WEIGHTS_PATH}")
-    sd = load_sft(KONTEXT_WEIGHTS_PATH, device=str(device))
+    if policy is not None:
+        prepare_quantization(model, policy)
+
+    # Load kontext weights (complete transformer), the FP8 layers of a pre-quantized
+    # checkpoint load as they are instead of being quantized here
+    weights_path = KONTEXT_WEIGHTS_PATH
+    if policy is None and os.path.exists(KONTEXT_FP8_WEIGHTS_PATH):
+        weights_path = KONTEXT_FP8_WEIGHTS_PATH
+    print(f"Loading kontext weights from {weights_path}")
+    sd = load_sft(weights_path, device=str(device))
     missing, unexpected = model.load_state_dict(sd, strict=False, assign=True)
 
     if missing:
@@ -276,6 +531,10 @@ def load_kontext_model(device: str | torch.device = "cuda"):
     if unexpected:
         print(f"Unexpected keys: {unexpected}")
 
+    if FP8_INPUT_SCALES_PATH and os.path.exists(FP8_INPUT_SCALES_PATH):
+        loaded = load_input_scales(model, FP8_INPUT_SCALES_PATH)
+        print(f"Loaded static FP8 input scales of {loaded} layers from {FP8_INPUT_SCALES_PATH}")
+
     return model
 
 
@@ -299,6 +558,26 @@ def load_ae_local(device: str | torch.device = "cuda"):
     return ae
 
 
+def parse_per_output_guidance(per_output_guidance: str, num_outputs: int) -> list[float]:
+    """One guidance scale per output from a comma separated list, in the range of the guidance input."""
+    guidance = []
+    for value in per_output_guidance.split(","):
+        value = value.strip()
+        try:
+            scale = float(value)
+        except ValueError:
+            scale = None
+        if scale is None or not GUIDANCE_RANGE[0] <= scale <= GUIDANCE_RANGE[1]:
+            raise ValueError(
+                f"Invalid per_output_guidance value '{value}', every value must be a number from "
+                f"{GUIDANCE_RANGE[0]} to {GUIDANCE_RANGE[1]}"
+            )
+        guidance.append(scale)
+    if len(guidance) != num_outputs:
+        raise ValueError(f"per_output_guidance has {len(guidance)} values but num_outputs is {num_outputs}")
+    return guidance
+
+
 def prepare_seed(seed: int) -> int:
     if not seed:
         seed = int.from_bytes(os.urandom(2), "big")
@@ -1,5 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from PIL import Image
 import torch
+import torch.nn.functional as F
 import numpy as np
 from diffusers.pipelines.stable_diffusion.safety_checker import (
     StableDiffusionSafetyChecker,
@@ -18,6 +21,7 @@ try:
 except Exception:  # pragma: no cover - fallback for non-cog environments
     from pathlib import Path
 
+from flux.preview import latent_to_rgb, predicted_x0
 from weights import download_weights
 from util import print_timing
 
@@ -34,73 +38,182 @@ FALCON_MODEL_URL = (
 )
 
 
-class SafetyChecker:
-    def __init__(self):
-        with print_timing("Loading SDXL safety checker"):
-            if not SAFETY_CACHE.exists():
-                download_weights(SAFETY_URL, SAFETY_CACHE)
-            self.sdxl_safety_checker = StableDiffusionSafetyChecker.from_pretrained(
-                SAFETY_CACHE, torch_dtype=torch.float16
-            ).to("cuda")  # type: ignore
-            self.feature_extractor = CLIPImageProcessor.from_pretrained(
-                FEATURE_EXTRACTOR
-            )
+def resize_shortest_edge(x: torch.Tensor, size: int) -> torch.Tensor:
+    height, width = x.shape[2:]
+    scale = size / min(height, width)
+    new_size = (max(size, round(height * scale)), max(size, round(width * scale)))
+    return F.interpolate(x, size=new_size, mode="bicubic", antialias=True)
 
-        with print_timing("Loading Falcon safety checker"):
-            if not FALCON_MODEL_CACHE.exists():
-                download_weights(FALCON_MODEL_URL, FALCON_MODEL_CACHE)
-            self.falcon_model = AutoModelForImageClassification.from_pretrained(
-                FALCON_MODEL_NAME,
-                cache_dir=FALCON_MODEL_CACHE,
-            )
-            self.falcon_processor = ViTImageProcessor.from_pretrained(FALCON_MODEL_NAME)
 
-    def filter_images(self, images: list[Image.Image]) -> list[Image.Image]:
-        has_nsfw_content = [False] * len(images)
+def center_crop(x: torch.Tensor, height: int, width: int) -> torch.Tensor:
+    top = (x.shape[2] - height) // 2
+    left = (x.shape[3] - width) // 2
+    return x[:, :, top : top + height, left : left + width]
 
-        has_nsfw_content = self.run_sdxl_safety_checker(images)
 
-        filtered = []
-        for i, (img, is_nsfw) in enumerate(zip(images, has_nsfw_content)):
+class SafetyChecker:
+    """
+    SDXL safety checker with a Falcon ViT second opinion, an image is only filtered
+    when both consider it NSFW.
+
+    Both checkers take the decoder output directly, a (batch, 3, height, width)
+    tensor in [-1, 1], and do their preprocessing on its device. They run
+    concurrently on separate CUDA streams, each in one batched pass over all
+    images. The weights are downloaded up front but only loaded on first use, so
+    requests with `disable_safety_checker` never pay for them.
+    """
+
+    def __init__(self, device: str | torch.device = "cuda"):
+        self.device = torch.device(device)
+        if not SAFETY_CACHE.exists():
+            download_weights(SAFETY_URL, SAFETY_CACHE)
+        if not FALCON_MODEL_CACHE.exists():
+            download_weights(FALCON_MODEL_URL, FALCON_MODEL_CACHE)
+
+        self.sdxl_safety_checker = None
+        self.falcon_model = None
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="safety")
+        self.streams = {}
+        if self.device.type == "cuda":
+            self.streams = {"sdxl": torch.cuda.Stream(self.device), "falcon": torch.cuda.Stream(self.device)}
+
+    def load(self):
+        """Load both checkers, called on first use."""
+        if self.sdxl_safety_checker is None:
+            with print_timing("Loading SDXL safety checker"):
+                self.sdxl_safety_checker = StableDiffusionSafetyChecker.from_pretrained(
+                    SAFETY_CACHE, torch_dtype=torch.float16
+                ).to(self.device)  # type: ignore
+                self.feature_extractor = CLIPImageProcessor.from_pretrained(
+                    FEATURE_EXTRACTOR
+                )
+
+        if self.falcon_model is None:
+            with print_timing("Loading Falcon safety checker"):
+                self.falcon_model = AutoModelForImageClassification.from_pretrained(
+                    FALCON_MODEL_NAME,
+                    cache_dir=FALCON_MODEL_CACHE,
+                ).to(self.device).eval()
+                self.falcon_processor = ViTImageProcessor.from_pretrained(FALCON_MODEL_NAME)
+                self.falcon_normal_label = self.falcon_model.config.label2id["normal"]
+
+    def _normalize(self, x: torch.Tensor, processor) -> torch.Tensor:
+        mean = torch.tensor(processor.image_mean, device=x.device).view(1, -1, 1, 1)
+        std = torch.tensor(processor.image_std, device=x.device).view(1, -1, 1, 1)
+        return (x - mean) / std
+
+    def run_sdxl_safety_checker(self, x: torch.Tensor) -> torch.Tensor:
+        """NSFW flags of the SDXL checker, `x` is in [0, 1]."""
+        crop = self.feature_extractor.crop_size
+        clip_input = resize_shortest_edge(x, self.feature_extractor.size["shortest_edge"])
+        clip_input = center_crop(clip_input, crop["height"], crop["width"])
+        clip_input = self._normalize(clip_input, self.feature_extractor)
+        # forward_onnx is the batched, tensor-only variant of forward. It blacks out
+        # flagged entries of `images` in place, hand it a placeholder
+        placeholder = torch.zeros(x.shape[0], 1, device=x.device)
+        _, has_nsfw_concepts = self.sdxl_safety_checker.forward_onnx(
+            clip_input=clip_input.to(torch.float16), images=placeholder
+        )
+        return has_nsfw_concepts
+
+    def run_falcon_safety_checker(self, x: torch.Tensor) -> torch.Tensor:
+        """Whether Falcon considers each image normal, `x` is in [0, 1]."""
+        size = self.falcon_processor.size
+        inputs = F.interpolate(x, size=(size["height"], size["width"]), mode="bilinear", antialias=True)
+        inputs = self._normalize(inputs, self.falcon_processor)
+        logits = self.falcon_model(pixel_values=inputs.to(self.falcon_model.dtype)).logits
+        return logits.argmax(-1) == self.falcon_normal_label
+
+    def _run(self, name: str, fn, x: torch.Tensor) -> torch.Tensor:
+        stream = self.streams.get(name)
+        with torch.inference_mode():
+            if stream is None:
+                return fn(x).cpu()
+            # x is produced on the default stream
+            stream.wait_stream(torch.cuda.default_stream(self.device))
+            with torch.cuda.stream(stream):
+                return fn(x).cpu()
+
+    def check(self, x: torch.Tensor) -> list[bool]:
+        """Whether each image of the decoder output `x` is NSFW."""
+        self.load()
+        x = ((x.clamp(-1, 1) + 1) / 2).float()
+        sdxl = self.executor.submit(self._run, "sdxl", self.run_sdxl_safety_checker, x)
+        falcon = self.executor.submit(self._run, "falcon", self.run_falcon_safety_checker, x)
+
+        has_nsfw_content = sdxl.result().tolist()
+        try:
+            falcon_is_safe = falcon.result().tolist()
+        except Exception as e:
+            print(f"Error running safety checker: {e}")
+            falcon_is_safe = [False] * len(has_nsfw_content)
+        return [is_nsfw and not is_safe for is_nsfw, is_safe in zip(has_nsfw_content, falcon_is_safe)]
+
+    def filter(self, x: torch.Tensor) -> list[int]:
+        """Indices of the safe images in the decoder output `x`."""
+        safe = []
+        for i, is_nsfw in enumerate(self.check(x)):
             if is_nsfw:
-                try:
-                    falcon_is_safe = self.run_falcon_safety_checker(img)
-                except Exception as e:
-                    print(f"Error running safety checker: {e}")
-                    falcon_is_safe = False
-                if not falcon_is_safe:
-                    print(f"NSFW content detected in image {i}")
-                    continue
-
-            filtered.append(img)
-
-        if not filtered:
+                print(f"NSFW content detected in image {i}")
+            else:
+                safe.append(i)
+
+        if not safe:
             raise Exception(
                 "All generated images contained NSFW content. Try running it again with a different prompt."
             )
 
-        print(f"Total safe images: {len(filtered)} out of {len(images)}")
-
-        return filtered
+        print(f"Total safe images: {len(safe)} out of {len(x)}")
+        return safe
 
-    def run_sdxl_safety_checker(self, images: list[Image.Image]) -> list[bool]:
-        np_images = [np.array(img) for img in images]
+    def filter_images(self, images: list[Image.Image]) -> list[Image.Image]:
+        """PIL version of `filter`, the images have to share one size."""
+        x = torch.stack([torch.from_numpy(np.array(img.convert("RGB"))) for img in images])
+        x = x.permute(0, 3, 1, 2).to(self.device).float() / 127.5 - 1.0
+        return [images[i] for i in self.filter(x)]
 
-        safety_checker_input = self.feature_extractor(images, return_tensors="pt").to(  # type: ignore
-            "cuda"
-        )
-        _, has_nsfw_concept = self.sdxl_safety_checker(
-            images=np_images,
-            clip_input=safety_checker_input.pixel_values.to(torch.float16),
-        )
-        return has_nsfw_concept
 
-    def run_falcon_safety_checker(self, image):
-        with torch.no_grad():
-            inputs = self.falcon_processor(images=image, return_tensors="pt")  # type: ignore
-            outputs = self.falcon_model(**inputs)
-            logits = outputs.logits
-            predicted_label = logits.argmax(-1).item()
-            result = self.falcon_model.config.id2label[predicted_label]
+class EarlyNSFWAbort(Exception):
+    """Raised from `denoise` when the preview of an intermediate latent is flagged."""
 
-        return result == "normal"
+    def __init__(self, step: int, num_steps: int):
+        super().__init__(
+            f"Generated image contained NSFW content (detected at step {step + 1} of {num_steps}). "
+            "Try running it again with a different prompt."
+        )
+        self.step = step
+        self.num_steps = num_steps
+
+
+class EarlySafetyCheck:
+    """
+    `denoise` step callback that runs the safety checker once, on a linear RGB
+    preview of the predicted clean latent `x0 = x - t * v` at `fraction` of the
+    steps, and raises `EarlyNSFWAbort` when every image is flagged. The preview is at
+    latent resolution, so the check costs no decoder pass, and flagged requests free
+    the GPU long before the final check would have rejected them.
+    """
+
+    def __init__(
+        self,
+        safety_checker: SafetyChecker,
+        num_steps: int,
+        height: int,
+        width: int,
+        fraction: float = 0.5,
+    ):
+        self.safety_checker = safety_checker
+        self.num_steps = num_steps
+        self.height = height
+        self.width = width
+        self.check_step = min(num_steps - 1, round(fraction * num_steps))
+
+    def preview(self, t: float, img: torch.Tensor, pred: torch.Tensor) -> torch.Tensor:
+        return latent_to_rgb(predicted_x0(img, pred, t).float(), self.height, self.width)
+
+    def __call__(self, step: int, t: float, img: torch.Tensor, pred: torch.Tensor) -> None:
+        if step != self.check_step:
+            return
+        # a partly flagged batch keeps going, the final check drops the flagged images
+        if all(self.safety_checker.check(self.preview(t, img, pred))):
+            raise EarlyNSFWAbort(step, self.num_steps)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Per-layer quantization sensitivity of the transformer, written out as a policy.
+
+The transformer is loaded with every linear in bf16 and runs full denoising
+loops for every prompt at every aspect ratio inside a `SensitivityScan`: each
+call of each linear is repeated with an FP8, int8 and int4 copy of the layer on
+the same input, and the relative L2 error of its output is recorded. Every layer
+then gets the first method of `--preference` whose largest error stays within
+`--max_error`, or stays bf16. The policy is saved as JSON for
+`QUANTIZATION_POLICY` and `benchmark_quantization.py`.
+
+The errors are per layer, they don't include how an error grows through the
+rest of the network, so check the end-to-end drift of the policy with
+`benchmark_quantization.py` before using it.
+
+    python scan_quantization.py --max_error 0.02 --preference int4,fp8,int8 --output policy.json
+"""
+
+import gc
+
+import torch
+from fire import Fire
+
+from benchmark_utils import parse_list
+from flux.quantization import (
+    BF16_POLICY,
+    SensitivityScan,
+    estimate_weight_bytes,
+    finish_quantization,
+    save_policy,
+)
+from flux.sampling import denoise, get_schedule
+from flux.util import ASPECT_RATIOS
+from predict import FluxDevKontextPredictor, load_kontext_model
+
+DEFAULT_PROMPTS = [
+    "make him into an oil painting, exactly preserving his likeness and facial features",
+    "change the background to a beach at sunset",
+]
+
+
+@torch.inference_mode()
+def main(
+    image: str = "lady.png",
+    prompts: str | None = None,
+    aspect_ratios: str | tuple = "1:1,16:9",
+    num_inference_steps: int = 8,
+    guidance: float = 2.5,
+    seed: int = 42,
+    max_error: float = 0.02,
+    preference: str | tuple = "int4,fp8,int8",
+    output: str = "quantization_policy.json",
+    top: int = 20,
+):
+    if prompts is None:
+        prompt_list = DEFAULT_PROMPTS
+    else:
+        with open(prompts) as f:
+            prompt_list = [line.strip() for line in f if line.strip()]
+    aspect_ratios = parse_list(aspect_ratios)
+    preference = tuple(parse_list(preference))
+
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+    # every linear in bf16, the scan quantizes copies of them. Runs eagerly, the hooks can't be compiled
+    del predictor.model
+    gc.collect()
+    torch.cuda.empty_cache()
+    model = load_kontext_model(device=torch.device("cpu"), policy=BF16_POLICY).to(predictor.device)
+    finish_quantization(model, BF16_POLICY)
+
+    with SensitivityScan(model, methods=preference) as scan:
+        for aspect_ratio in aspect_ratios:
+            width, height = ASPECT_RATIOS[aspect_ratio]
+            for prompt in prompt_list:
+                inp, _, _ = predictor.encoding_stage(
+                    prompt=prompt, img_cond_path=image, seed=seed, target_width=width, target_height=height
+                )
+                timesteps = get_schedule(num_inference_steps, inp["img"].shape[1], shift=True)
+                denoise(model, **inp, timesteps=timesteps, guidance=guidance, precompute_modulation=True)
+            print(f"Scanned {aspect_ratio}")
+
+    max_errors = scan.max_errors()
+    print(f"{'layer':<40}" + "".join(f"{method:>10}" for method in preference))
+    ranked = sorted(max_errors, key=lambda name: min(max_errors[name].values(), default=0.0), reverse=True)
+    for name in ranked[:top]:
+        errors = max_errors[name]
+        print(f"{name:<40}" + "".join(f"{errors[m]:>10.4f}" if m in errors else f"{'-':>10}" for m in preference))
+
+    policy = scan.policy(max_error, preference, name=f"scanned-{max_error}")
+    save_policy(policy, output)
+    methods = policy.resolve(model)
+    counts = {method: list(methods.values()).count(method) for method in sorted(set(methods.values()))}
+    bf16_bytes = estimate_weight_bytes(model, BF16_POLICY.resolve(model))
+    policy_bytes = estimate_weight_bytes(model, methods)
+    print(f"Layers per method: {counts}")
+    print(f"Linear weights: {bf16_bytes / 1024**3:.2f} GB in bf16 -> {policy_bytes / 1024**3:.2f} GB")
+    print(f"Saved policy to {output}")
+
+
+if __name__ == "__main__":
+    Fire(main)
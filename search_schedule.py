@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Search a timestep schedule for a fixed step count and store it in the schedule registry.
+
+The schedule is searched at the resolution of the calibration edits and stored
+before the resolution shift, so other resolutions apply their own shift to it.
+
+Every candidate schedule is scored by how far its final latents are from a
+reference trajectory (many Euler steps on the default schedule) over a few
+calibration edits. The search is a derivative-free coordinate descent that
+moves one interior timestep at a time towards one of its neighbours, so the
+schedule stays strictly decreasing.
+
+    python search_schedule.py --num_steps 12
+"""
+
+import torch
+from fire import Fire
+
+from flux.sampling import denoise, get_schedule, prepare_kontext
+from flux.schedules import save_schedule
+from predict import FluxDevKontextPredictor
+
+CALIBRATION_EDITS = [
+    ("lady.png", "Make the hair blue"),
+    ("lady.png", "make her into an oil painting, exactly preserving her likeness and facial features"),
+    ("lady.png", "remove the background"),
+]
+
+
+@torch.inference_mode()
+def main(
+    num_steps: int,
+    name: str = "optimized",
+    reference_steps: int = 100,
+    iterations: int = 20,
+    sampler: str = "euler",
+    guidance: float = 2.5,
+    seed: int = 42,
+):
+    predictor = FluxDevKontextPredictor()
+    predictor.setup()
+
+    inputs = []
+    for image, prompt in CALIBRATION_EDITS:
+        inp, _, _ = prepare_kontext(
+            t5=predictor.t5,
+            clip=predictor.clip,
+            prompt=prompt,
+            ae=predictor.ae,
+            img_cond_path=image,
+            seed=seed,
+            device=predictor.device,
+            position_cache=predictor.position_cache,
+            prompt_cache=predictor.prompt_cache,
+            keep_orig=False,
+        )
+        inputs.append(inp)
+    image_seq_len = inputs[0]["img"].shape[1]
+
+    def run(inp: dict, timesteps: list[float], sampler: str) -> torch.Tensor:
+        return denoise(predictor.model, **inp, timesteps=timesteps, guidance=guidance, sampler=sampler).float()
+
+    print(f"Computing {reference_steps} step reference trajectories...")
+    reference_schedule = get_schedule(reference_steps, image_seq_len, shift=True)
+    references = [run(inp, reference_schedule, "euler") for inp in inputs]
+
+    def loss(timesteps: list[float]) -> float:
+        errors = [
+            torch.mean((run(inp, timesteps, sampler) - reference) ** 2).item()
+            for inp, reference in zip(inputs, references)
+        ]
+        return sum(errors) / len(errors)
+
+    schedule = get_schedule(num_steps, image_seq_len, shift=True)
+    best = loss(schedule)
+    print(f"Default schedule: loss {best:.6f}")
+
+    # fraction of the distance to the neighbouring timestep a point is moved by
+    delta = 0.5
+    for iteration in range(iterations):
+        improved = False
+        for i in range(1, num_steps):
+            for neighbour in (schedule[i - 1], schedule[i + 1]):
+                candidate = list(schedule)
+                candidate[i] = schedule[i] + delta * (neighbour - schedule[i])
+                candidate_loss = loss(candidate)
+                if candidate_loss < best:
+                    schedule, best, improved = candidate, candidate_loss, True
+                    break
+        print(f"Iteration {iteration}: loss {best:.6f}, step size {delta}")
+        if not improved:
+            delta /= 2
+
+    save_schedule(name, schedule, image_seq_len)
+    print(f"Saved {name} schedule for {num_steps} steps: {schedule}")
+
+
+if __name__ == "__main__":
+    Fire(main)
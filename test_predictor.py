@@ -38,7 +38,7 @@ def main():
     ]
 
     for model_run in model_runs:
-        result = predictor.predict(
+        *_, result = predictor.predict(
             prompt=model_run["prompt"],
             input_image="input_images/" + model_run["input_image"],
             aspect_ratio="match_input_image",
@@ -49,6 +49,15 @@ def main():
             output_quality=80,
             disable_safety_checker=False,
             go_fast=model_run["go_fast"],
+            acceleration_level="default",
+            adaptive_threshold=0.15,
+            taylor_seer_scope="model",
+            taylor_seer_order=1,
+            sampler="euler",
+            early_safety_check=False,
+            num_outputs=1,
+            per_output_guidance="",
+            preview_every=0,
         )
         
         input_image_name = model_run["input_image"].split(".")[0]